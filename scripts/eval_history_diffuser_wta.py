@@ -8,21 +8,26 @@ import torch
 import wandb
 
 from flowbothd.datasets.flow_trajectory import FlowTrajectoryDataModule
-from flowbothd.models.flow_diffuser_dit import (
-    FlowTrajectoryDiffuserInferenceModule_DiT,
+from flowbothd.models.flow_diffuser_dit import FlowTrajectoryDiffuserInferenceModule_DiT
+from flowbothd.models.flow_diffuser_hisdit import (
+    FlowTrajectoryDiffuserInferenceModule_HisDiT,
 )
 from flowbothd.models.flow_diffuser_hispndit import (
     FlowTrajectoryDiffuserInferenceModule_HisPNDiT,
 )
-from flowbothd.models.flow_diffuser_hisdit import (
-    FlowTrajectoryDiffuserInferenceModule_HisDiT,
-)
 from flowbothd.models.flow_diffuser_pndit import (
     FlowTrajectoryDiffuserInferenceModule_PNDiT,
 )
 from flowbothd.models.modules.dit_models import DiT, PN2DiT, PN2HisDiT
 from flowbothd.models.modules.history_encoder import HistoryEncoder
-from flowbothd.utils.script_utils import PROJECT_ROOT, match_fn
+from flowbothd.utils.script_utils import (
+    PROJECT_ROOT,
+    match_fn,
+    precision_parity_report,
+    predict_latency_report,
+    quantization_report,
+    setup_inference_device,
+)
 
 data_module_class = {
     "trajectory": FlowTrajectoryDataModule,
@@ -54,6 +59,9 @@ def main(cfg):
     # Since most of us are training on 3090s+, we can use mixed precision.
     torch.set_float32_matmul_precision("highest")
 
+    # CUDA by default, or CPU (with tuned thread counts) for CPU-only nodes.
+    device = setup_inference_device(cfg.resources)
+
     # Global seed for reproducibility.
     L.seed_everything(42)
 
@@ -103,7 +111,7 @@ def main(cfg):
             "train-test": ["8867", "8983", "8994", "9003", "9263", "9393"],
             "test": ["8867", "8983", "8994", "9003", "9263", "9393"],
         }
-    
+
     # Create History dataset
     fully_closed_datamodule = FlowTrajectoryDataModule(
         root=cfg.dataset.data_dir,
@@ -187,14 +195,14 @@ def main(cfg):
                 hidden_size=128,
                 num_heads=4,
                 learn_sigma=True,
-            ).cuda(),
+            ).to(device),
             "History": HistoryEncoder(
                 history_dim=cfg.model.history_dim,
                 history_len=cfg.model.history_len,
                 batch_norm=cfg.model.batch_norm,
                 transformer=False,
                 repeat_dim=False,
-            ).cuda(),
+            ).to(device),
         }
 
     elif "hisdit" in cfg.model.name:
@@ -205,12 +213,12 @@ def main(cfg):
                 hidden_size=128,
                 num_heads=4,
                 learn_sigma=True,
-            ).cuda(),
+            ).to(device),
             "History": history_network_class[cfg.model.history_model](
                 history_dim=cfg.model.history_dim,
                 history_len=cfg.model.history_len,
                 batch_norm=cfg.model.batch_norm,
-            ).cuda(),
+            ).to(device),
         }
     elif "pndit" in cfg.model.name:
         network = PN2DiT(
@@ -220,7 +228,7 @@ def main(cfg):
             patch_size=1,
             num_heads=4,
             n_points=cfg.dataset.n_points,
-        ).cuda()
+        ).to(device)
     elif "dit" in cfg.model.name:
         network = DiT(
             in_channels=in_channels + 3,
@@ -228,7 +236,7 @@ def main(cfg):
             hidden_size=128,
             num_heads=4,
             learn_sigma=True,
-        ).cuda()
+        ).to(device)
 
     # # Get the checkpoint file. If it's a wandb reference, download.
     # # Otherwise look to disk.
@@ -263,10 +271,9 @@ def main(cfg):
 
     model = inference_module_class[cfg.model.name](
         network, inference_cfg=cfg.inference, model_cfg=cfg.model
-    )
+    ).to(device)
     model.load_from_ckpt(ckpt_file)
     model.eval()
-    model.cuda()
 
     ######################################################################
     # Run the model on the train/val/test sets.
@@ -277,24 +284,45 @@ def main(cfg):
     # function is.
     ######################################################################
 
+    # Several objects are evaluated at once, each with trial_time trials.
+    bsz = cfg.inference.get("wta_batch_size", 1)
     dataloaders = [
         # (datamodule.train_val_dataloader(), "train"),
         # (datamodule.train_val_dataloader(bsz=1), "train"),
-        (fully_closed_datamodule.train_val_dataloader(bsz=1), "train_closed"),
-        (randomly_opened_datamodule.train_val_dataloader(bsz=1), "train_open"),
-        (fully_closed_datamodule.val_dataloader(bsz=1), "val_closed"),
-        (randomly_opened_datamodule.val_dataloader(bsz=1), "val_open"),
-        (fully_closed_datamodule.unseen_dataloader(bsz=1), "door_closed"),
-        (randomly_opened_datamodule.unseen_dataloader(bsz=1), "door_open"),
+        (fully_closed_datamodule.train_val_dataloader(bsz=bsz), "train_closed"),
+        (randomly_opened_datamodule.train_val_dataloader(bsz=bsz), "train_open"),
+        (fully_closed_datamodule.val_dataloader(bsz=bsz), "val_closed"),
+        (randomly_opened_datamodule.val_dataloader(bsz=bsz), "val_open"),
+        (fully_closed_datamodule.unseen_dataloader(bsz=bsz), "door_closed"),
+        (randomly_opened_datamodule.unseen_dataloader(bsz=bsz), "door_open"),
     ]
 
+    if cfg.latency_report:
+        # Time a single-object predict_step, as run once per step in a rollout.
+        latency_batch = next(iter(fully_closed_datamodule.val_dataloader(bsz=1)))
+        print("predict_step latency:")
+        print(predict_latency_report(model, latency_batch))
+
+    if cfg.precision_parity_check:
+        # Same noise in fp32 and bf16, compared with flow_metrics.
+        parity_batch = next(iter(fully_closed_datamodule.val_dataloader(bsz=1)))
+        print("bf16 vs fp32 parity:")
+        print(precision_parity_report(model, parity_batch, precision="bf16"))
+
+    if cfg.quantization_report:
+        # Dynamic int8 vs fp32 flows on the held-out (val) split.
+        print("int8 vs fp32 flows:")
+        print(
+            quantization_report(model, randomly_opened_datamodule.val_dataloader(bsz=1))
+        )
+
     trial_time = 50
 
     all_metrics = []
     all_directions = []
     sample_cnt = 0
     for loader, name in dataloaders:
-        sample_cnt += len(loader)
+        sample_cnt += len(loader.dataset)
 
         metrics, directions = model.predict_wta(
             dataloader=loader, mode="delta", trial_times=trial_time
@@ -31,7 +31,7 @@ from flowbothd.models.flow_trajectory_diffuser import (
 )
 from flowbothd.models.modules.dit_models import DGDiT, DiT, PN2DiT
 from flowbothd.simulations.simulation import trial_with_diffuser
-from flowbothd.utils.script_utils import PROJECT_ROOT, match_fn
+from flowbothd.utils.script_utils import PROJECT_ROOT, match_fn, setup_inference_device
 
 print(PROJECT_ROOT)
 
@@ -88,6 +88,9 @@ def main(cfg):
     # Since most of us are training on 3090s+, we can use mixed precision.
     torch.set_float32_matmul_precision("highest")
 
+    # CUDA by default, or CPU (with tuned thread counts) for CPU-only nodes.
+    device = setup_inference_device(cfg.resources)
+
     # Global seed for reproducibility.
     L.seed_everything(42)
 
@@ -96,8 +99,7 @@ def main(cfg):
     # Should be the same one as in training, but we're gonna use val+test
     # dataloaders.
     ######################################################################
-   
-    
+
     if cfg.dataset.dataset_type == "full-dataset":
         # Full dataset
         toy_dataset = None
@@ -193,7 +195,7 @@ def main(cfg):
             in_channels=in_channels,
             out_channels=3 * trajectory_len,
             p=pnp.PN2DenseParams(),
-        ).cuda()
+        ).to(device)
     elif "dgdit" in cfg.model.name:
         network = DGDiT(
             in_channels=in_channels,
@@ -202,7 +204,7 @@ def main(cfg):
             patch_size=1,
             num_heads=4,
             n_points=cfg.dataset.n_points,
-        ).cuda()
+        ).to(device)
     elif "pndit" in cfg.model.name:
         network = PN2DiT(
             in_channels=in_channels,
@@ -211,7 +213,7 @@ def main(cfg):
             patch_size=1,
             num_heads=4,
             n_points=cfg.dataset.n_points,
-        ).cuda()
+        ).to(device)
     elif "dit" in cfg.model.name:
         network = DiT(
             in_channels=in_channels + 3,
@@ -219,7 +221,7 @@ def main(cfg):
             hidden_size=128,
             num_heads=4,
             learn_sigma=True,
-        ).cuda()
+        ).to(device)
 
     # # Get the checkpoint file. If it's a wandb reference, download.
     # # Otherwise look to disk.
@@ -241,7 +243,7 @@ def main(cfg):
     # )
     model = inference_module_class[cfg.model.name](
         network, inference_cfg=cfg.inference, model_cfg=cfg.model
-    ).cuda()
+    ).to(device)
     model.load_from_ckpt(ckpt_file)
     model.eval()
 
@@ -36,15 +36,10 @@ from flowbothd.models.flow_diffuser_pndit import (
 from flowbothd.models.flow_trajectory_diffuser import (
     FlowTrajectoryDiffuserSimulationModule_PN2,
 )
-from flowbothd.models.modules.dit_models import (
-    DGDiT,
-    DiT,
-    PN2DiT,
-    PN2HisDiT,
-)
+from flowbothd.models.modules.dit_models import DGDiT, DiT, PN2DiT, PN2HisDiT
 from flowbothd.models.modules.history_encoder import HistoryEncoder
 from flowbothd.simulations.simulation import trial_with_diffuser_history
-from flowbothd.utils.script_utils import PROJECT_ROOT, match_fn
+from flowbothd.utils.script_utils import PROJECT_ROOT, match_fn, setup_inference_device
 
 PROJECT_ROOT = "YOUR CURRENT PROJECT DIRECTORY"
 
@@ -104,6 +99,9 @@ def main(cfg):
     # Since most of us are training on 3090s+, we can use mixed precision.
     torch.set_float32_matmul_precision("highest")
 
+    # CUDA by default, or CPU (with tuned thread counts) for CPU-only nodes.
+    device = setup_inference_device(cfg.resources)
+
     # Global seed for reproducibility.
     L.seed_everything(20030208)
     np.random.seed(20030208)
@@ -214,7 +212,7 @@ def main(cfg):
                 in_channels=in_channels,
                 out_channels=3 * trajectory_len,
                 p=pnp.PN2DenseParams(),
-            ).cuda()
+            ).to(device)
         elif "dgdit" in cfg.model.name:
             network = DGDiT(
                 in_channels=in_channels,
@@ -223,7 +221,7 @@ def main(cfg):
                 patch_size=1,
                 num_heads=4,
                 n_points=cfg.dataset.n_points,
-            ).cuda()
+            ).to(device)
         elif "pndit" in cfg.model.name:
             network = PN2DiT(
                 in_channels=in_channels,
@@ -232,7 +230,7 @@ def main(cfg):
                 patch_size=1,
                 num_heads=4,
                 n_points=cfg.dataset.n_points,
-            ).cuda()
+            ).to(device)
         elif "dit" in cfg.model.name:
             network = DiT(
                 in_channels=in_channels + 3,
@@ -240,7 +238,7 @@ def main(cfg):
                 hidden_size=128,
                 num_heads=4,
                 learn_sigma=True,
-            ).cuda()
+            ).to(device)
 
         # # Get the checkpoint file. If it's a wandb reference, download.
         # # Otherwise look to disk.
@@ -261,7 +259,7 @@ def main(cfg):
         # )
         model = inference_module_class[cfg.model.name](
             network, inference_cfg=cfg.inference, model_cfg=cfg.model
-        ).cuda()
+        ).to(device)
         model.load_from_ckpt(ckpt_file)
         model.eval()
 
@@ -275,18 +273,18 @@ def main(cfg):
                 hidden_size=128,
                 num_heads=4,
                 learn_sigma=True,
-            ).cuda(),
+            ).to(device),
             "History": HistoryEncoder(
                 history_dim=cfg.model.history_dim,
                 history_len=cfg.model.history_len,
                 batch_norm=cfg.model.batch_norm,
                 transformer=False,
                 repeat_dim=False,
-            ).cuda(),
+            ).to(device),
         }
         history_model = FlowTrajectoryDiffuserSimulationModule_HisPNDiT(
             network, inference_cfg=cfg.inference, model_cfg=cfg.model
-        ).cuda()
+        ).to(device)
     elif "hisdit" in cfg.model.name:
         network = {
             "DiT": DiT(
@@ -295,15 +293,15 @@ def main(cfg):
                 hidden_size=128,
                 num_heads=4,
                 learn_sigma=True,
-            ).cuda(),
+            ).to(device),
             "History": HistoryEncoder(
                 history_dim=128, history_len=1, batch_norm=False
-            ).cuda(),
+            ).to(device),
         }
         history_model = FlowTrajectoryDiffuserSimulationModule_HisDiT(
             network, inference_cfg=cfg.inference, model_cfg=cfg.model
-        ).cuda()
-        
+        ).to(device)
+
     ckpt_file = "TO BE SPECIFIED"
     history_model.load_from_ckpt(ckpt_file)
     history_model.eval()
@@ -369,6 +367,7 @@ def main(cfg):
             available_joints=available_links,
             consistency_check=cfg.consistency_check,
             history_filter=cfg.history_filter,
+            n_pts=cfg.sim_n_points,
         )
         sim_trajectories += sim_trajectory
         link_names += [f"{obj_id}_{link}" for link in available_links]
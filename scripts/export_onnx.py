@@ -0,0 +1,56 @@
+# Export a trained DiT diffuser to ONNX, for torch-free inference.
+# Writes <onnx_file> (the denoiser) and <onnx_file stem>_diffusion.npz (the sampling
+# schedule of inference.num_inference_timesteps), which is all that
+# flowbothd.models.modules.onnx_sampler.OnnxFlowSampler needs:
+#   python scripts/export_onnx.py model=diffuser_dit checkpoint.reference=<ckpt or artifact>
+
+import os
+
+import hydra
+import torch
+import wandb
+
+from flowbothd.models.flow_diffuser_dit import FlowTrajectoryDiffuserInferenceModule_DiT
+from flowbothd.models.modules.dit_models import DiT
+
+
+@torch.no_grad()
+@hydra.main(config_path="../configs", config_name="eval", version_base="1.3")
+def main(cfg):
+    if cfg.model.name != "diffuser_dit":
+        raise ValueError(
+            f"Only the pure-tensor DiT denoiser can be exported, got {cfg.model.name}"
+        )
+
+    # Get the checkpoint file. If it's a wandb reference, download.
+    # Otherwise look to disk.
+    checkpoint_reference = cfg.checkpoint.reference
+    if checkpoint_reference.startswith(cfg.wandb.entity):
+        artifact = wandb.Api().artifact(checkpoint_reference, type="model")
+        ckpt_file = artifact.get_path("model.ckpt").download(
+            root=cfg.wandb.artifact_dir
+        )
+    else:
+        ckpt_file = checkpoint_reference
+
+    # Same network as in training, exported on CPU.
+    network = DiT(
+        in_channels=3 * cfg.inference.trajectory_len + 3,
+        depth=5,
+        hidden_size=128,
+        num_heads=4,
+        learn_sigma=True,
+    )
+    model = FlowTrajectoryDiffuserInferenceModule_DiT(
+        network, inference_cfg=cfg.inference, model_cfg=cfg.model
+    )
+    model.load_from_ckpt(ckpt_file)
+
+    # Point inference.onnx_file at this file to sample with it from the torch module.
+    onnx_file = os.path.join(cfg.output_dir, "denoiser.onnx")
+    model.export_onnx(onnx_file)
+    print(f"Exported the denoiser to {onnx_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,43 +13,29 @@ from lightning.pytorch.loggers import WandbLogger
 
 from flowbothd.datasets.flow_trajectory import FlowTrajectoryDataModule
 from flowbothd.datasets.flowbot import FlowBotDataModule
-from flowbothd.models.flow_diffuser_dgdit import (
-    FlowTrajectoryDiffusionModule_DGDiT,
-)
-from flowbothd.models.flow_diffuser_dit import (
-    FlowTrajectoryDiffusionModule_DiT,
-)
-from flowbothd.models.flow_diffuser_hisdit import (
-    FlowTrajectoryDiffusionModule_HisDiT,
-)
+from flowbothd.models.flow_diffuser_dgdit import FlowTrajectoryDiffusionModule_DGDiT
+from flowbothd.models.flow_diffuser_dit import FlowTrajectoryDiffusionModule_DiT
+from flowbothd.models.flow_diffuser_hisdit import FlowTrajectoryDiffusionModule_HisDiT
 from flowbothd.models.flow_diffuser_hispndit import (
     FlowTrajectoryDiffusionModule_HisPNDiT,
 )
-from flowbothd.models.flow_diffuser_pndit import (
-    FlowTrajectoryDiffusionModule_PNDiT,
-)
+from flowbothd.models.flow_diffuser_pndit import FlowTrajectoryDiffusionModule_PNDiT
 
 # Regression Models
 from flowbothd.models.flow_predictor import FlowPredictorTrainingModule
 
 # Diffusion Models
-from flowbothd.models.flow_trajectory_diffuser import (
-    FlowTrajectoryDiffusionModule_PN2,
-)
-from flowbothd.models.flow_trajectory_predictor import (
-    FlowTrajectoryTrainingModule,
-)
-from flowbothd.models.modules.dit_models import (
-    DGDiT,
-    DiT,
-    PN2DiT,
-    PN2HisDiT,
-)
+from flowbothd.models.flow_trajectory_diffuser import FlowTrajectoryDiffusionModule_PN2
+from flowbothd.models.flow_trajectory_predictor import FlowTrajectoryTrainingModule
+from flowbothd.models.modules.dit_models import DGDiT, DiT, PN2DiT, PN2HisDiT
 from flowbothd.models.modules.history_encoder import HistoryEncoder
 from flowbothd.utils.script_utils import (
     PROJECT_ROOT,
+    BatchAugmentationCallback,
     LogPredictionSamplesCallback,
+    StepStatsCallback,
     match_fn,
+    setup_training_devices,
 )
 
 data_module_class = {
@@ -96,6 +82,34 @@ def main(cfg):
     # Global seed for reproducibility.
     L.seed_everything(cfg.seed)
 
+    # Single GPU, multi-GPU or multi-process CPU (gloo) DDP.
+    trainer_devices = setup_training_devices(cfg.resources)
+    world_size = trainer_devices.pop("world_size")
+    # The trajectory datamodule shards its loaders itself (every rank reads a
+    # disjoint shard, evaluation samples are not duplicated), can serve its
+    # caches memory-mapped, collate fixed-size batches directly and compose the
+    # training repeats from a smaller pool of cached renders. With augmentation,
+    # its training epochs keep the length of the former 4x flipped caches.
+    trajectory_kwargs = (
+        dict(
+            world_size=world_size,
+            cache_format=cfg.dataset.get("cache_format", "pickle"),
+            dense_batches=cfg.dataset.get("dense_batches", False),
+            repeat_pool=cfg.dataset.get("repeat_pool", None),
+            augmentation=cfg.dataset.augmentation,
+            randomize_size=cfg.dataset.randomize_size,
+        )
+        if cfg.dataset.name == "trajectory"
+        else {}
+    )
+    # DataLoader workers, separate from the cache-generation workers (num_workers).
+    loader_kwargs = dict(
+        loader_workers=cfg.resources.get("loader_workers", 0),
+        pin_memory=cfg.resources.get("pin_memory", False),
+        prefetch_factor=cfg.resources.get("prefetch_factor", 2),
+        persistent_workers=cfg.resources.get("persistent_workers", True),
+    )
+
     ######################################################################
     # Create the datamodule.
     # The datamodule is responsible for all the data loading, including
@@ -106,7 +120,9 @@ def main(cfg):
     ######################################################################
 
     trajectory_len = cfg.training.trajectory_len
-    special_req = cfg.dataset.special_req if cfg.dataset.special_req != "randomly-open" else None
+    special_req = (
+        cfg.dataset.special_req if cfg.dataset.special_req != "randomly-open" else None
+    )
     if cfg.dataset.dataset_type == "full-dataset":
         # Full dataset
         toy_dataset = None
@@ -148,7 +164,6 @@ def main(cfg):
             "test": ["8867", "8983", "8994", "9003", "9263", "9393"],
         }
 
-
     # Create flow dataset
     datamodule = data_module_class[cfg.dataset.name](
         root=cfg.dataset.data_dir,
@@ -157,19 +172,23 @@ def main(cfg):
         n_proc=cfg.resources.n_proc_per_worker,
         seed=cfg.seed,
         history="his" in cfg.model.name,
-        randomize_size=cfg.dataset.randomize_size,
-        augmentation=cfg.dataset.augmentation,
         trajectory_len=trajectory_len,  # Only used when training trajectory model
         special_req=special_req,  # special_req="fully-closed"
         n_repeat=200
         if special_req == "half-half-01"
         else (50 if special_req is None else 100),
         toy_dataset=toy_dataset,
+        **trajectory_kwargs,
+        **loader_kwargs,
     )
     train_loader = datamodule.train_dataloader()
     if "diffuser" in cfg.model.name:
         cfg.training.train_sample_number = len(train_loader)
-    eval_sample_bsz = 1 if cfg.training.wta else cfg.training.batch_size
+    eval_sample_bsz = (
+        cfg.training.get("wta_batch_size", 1)
+        if cfg.training.wta
+        else cfg.training.batch_size
+    )
     train_val_loader = datamodule.train_val_dataloader(bsz=eval_sample_bsz)
 
     if special_req == "half-half" and toy_dataset is not None:  # half-half doors
@@ -183,11 +202,11 @@ def main(cfg):
             n_proc=cfg.resources.n_proc_per_worker,
             seed=cfg.seed,
             history="his" in cfg.model.name,
-            randomize_size=cfg.dataset.randomize_size,
-            augmentation=cfg.dataset.augmentation,
             trajectory_len=trajectory_len,  # Only used when training trajectory model
             special_req=None,  # special_req="fully-closed"
             toy_dataset=toy_dataset,
+            **trajectory_kwargs,
+            **loader_kwargs,
         )
         fully_closed_datamodule = data_module_class[cfg.dataset.name](
             root=cfg.dataset.data_dir,
@@ -196,11 +215,11 @@ def main(cfg):
             n_proc=cfg.resources.n_proc_per_worker,
             seed=cfg.seed,
             history="his" in cfg.model.name,
-            randomize_size=cfg.dataset.randomize_size,
-            augmentation=cfg.dataset.augmentation,
             trajectory_len=trajectory_len,  # Only used when training trajectory model
             special_req="fully-closed",  # special_req="fully-closed"
             toy_dataset=toy_dataset,
+            **trajectory_kwargs,
+            **loader_kwargs,
         )
         val_loader = fully_closed_datamodule.val_dataloader(bsz=eval_sample_bsz)
         unseen_loader = randomly_opened_datamodule.unseen_dataloader(
@@ -244,7 +263,7 @@ def main(cfg):
             in_channels=in_channels,
             out_channels=3 * trajectory_len,
             p=pnp_orig.PN2DenseParams(),
-        ).cuda()
+        )
     elif "dgdit" in cfg.model.name:
         network = DGDiT(
             in_channels=in_channels,
@@ -253,7 +272,7 @@ def main(cfg):
             patch_size=1,
             num_heads=4,
             n_points=cfg.dataset.n_points,
-        ).cuda()
+        )
     elif "hisdit" in cfg.model.name:
         network = {
             "DiT": DiT(
@@ -262,13 +281,13 @@ def main(cfg):
                 hidden_size=128,
                 num_heads=4,
                 learn_sigma=True,
-            ).cuda(),
+            ),
             "History": history_network_class[cfg.model.history_model](
                 history_dim=cfg.model.history_dim,
                 history_len=cfg.model.history_len,
                 batch_norm=cfg.model.batch_norm,
                 repeat_dim=True,
-            ).cuda(),
+            ),
         }
     elif "hispndit" in cfg.model.name:
         network = {
@@ -282,14 +301,14 @@ def main(cfg):
                 # hidden_size=256,
                 # num_heads=4,
                 learn_sigma=True,
-            ).cuda(),
+            ),
             "History": history_network_class[cfg.model.history_model](
                 history_dim=cfg.model.history_dim,
                 history_len=cfg.model.history_len,
                 batch_norm=cfg.model.batch_norm,
                 transformer=False,
                 repeat_dim=False,
-            ).cuda(),
+            ),
         }
     elif "pndit" in cfg.model.name:
         network = PN2DiT(
@@ -310,7 +329,7 @@ def main(cfg):
             # hidden_size=384,
             # num_heads=6,
             learn_sigma=True,
-        ).cuda()
+        )
 
     ######################################################################
     # Create the training module.
@@ -364,14 +383,26 @@ def main(cfg):
     ######################################################################
 
     trainer = L.Trainer(
-        accelerator="gpu",
-        devices=cfg.resources.gpus,
-        # precision="16-mixed",
-        precision="32-true",
+        **trainer_devices,
+        use_distributed_sampler=not trajectory_kwargs,
+        # "bf16-mixed" runs the DiT backbones under bf16 autocast.
+        precision=cfg.training.get("precision", "32-true"),
         max_epochs=cfg.training.epochs,
         logger=logger,
         check_val_every_n_epoch=cfg.training.check_val_every_n_epoch,
         callbacks=[
+            # Random flips / sizes of the training batches, on device (first, so
+            # every other callback sees the augmented batch).
+            *(
+                [
+                    BatchAugmentationCallback(
+                        flip=cfg.dataset.augmentation,
+                        random_size=cfg.dataset.randomize_size,
+                    )
+                ]
+                if cfg.dataset.augmentation or cfg.dataset.randomize_size
+                else []
+            ),
             # Callback which logs whatever visuals (i.e. dataset examples, preds, etc.) we want.
             LogPredictionSamplesCallback(
                 logger=logger,
@@ -382,6 +413,12 @@ def main(cfg):
                     len(unseen_loader),
                 ],
             ),
+            # Step time, data wait and peak memory, e.g. to size batches or loader workers.
+            *(
+                [StepStatsCallback()]
+                if cfg.training.get("log_step_stats", False)
+                else []
+            ),
             # This checkpoint callback saves the latest model during training, i.e. so we can resume if it crashes.
             # It saves everything, and you can load by referencing last.ckpt.
             ModelCheckpoint(
@@ -411,13 +448,14 @@ def main(cfg):
     ######################################################################
 
     # Log the code used to train the model. Make sure not to log too much, because it will be too big.
-    wandb.run.log_code(
-        root=PROJECT_ROOT,
-        include_fn=match_fn(
-            dirs=["configs", "scripts", "src"],
-            extensions=[".py", ".yaml"],
-        ),
-    )
+    if trainer.is_global_zero:  # Only rank 0 has a wandb run.
+        wandb.run.log_code(
+            root=PROJECT_ROOT,
+            include_fn=match_fn(
+                dirs=["configs", "scripts", "src"],
+                extensions=[".py", ".yaml"],
+            ),
+        )
 
     ######################################################################
     # Train the model.
@@ -0,0 +1,54 @@
+"""
+Batch-level augmentation of the flow / history training batches
+Runs on the collated batch, on the training device, with one draw per sample:
+- flips: the 4 flip modes (none, left-right, front-back, both), i.e. a sign per x / y axis
+- random size: a uniform scale in [0.1, 5] of the point positions (not of the flows)
+The caches only hold unaugmented samples.
+"""
+
+import torch
+import torch_geometric.data as tgd
+
+# Flip modes as axis signs (the diagonals of the flip matrices).
+FLIP_SIGNS = torch.tensor(
+    [
+        [1.0, 1.0, 1.0],  # Normal
+        [1.0, -1.0, 1.0],  # Left, right
+        [-1.0, 1.0, 1.0],  # Front, back
+        [-1.0, -1.0, 1.0],  # Front back & left right
+    ]
+)
+
+# Fields with positions (flipped and scaled) and with flows (flipped).
+POSITION_KEYS = ["pos", "point", "history"]
+FLOW_KEYS = ["delta", "flow_history"]
+
+
+def _per_row(batch: tgd.Batch, key: str, values: torch.Tensor) -> torch.Tensor:
+    """Broadcast per-sample values (B, 3) to the rows of batch[key] (rows, ..., 3)."""
+    field = batch[key]
+    sizes = batch._slice_dict[key].diff().to(field.device)
+    rows = values.repeat_interleave(sizes, dim=0)
+    return rows.view(rows.shape[0], *([1] * (field.dim() - 2)), rows.shape[-1])
+
+
+def augment_batch(
+    batch: tgd.Batch, flip: bool = True, random_size: bool = False
+) -> tgd.Batch:
+    """Randomly flip / rescale every sample of a collated batch, in place."""
+    bs = batch.num_graphs
+    device = batch.pos.device
+    signs = torch.ones(bs, 3, device=device)
+    if flip:
+        signs = FLIP_SIGNS.to(device)[torch.randint(0, 4, (bs,), device=device)]
+    scales = signs
+    if random_size:
+        scales = signs * torch.empty(bs, 1, device=device).uniform_(0.1, 5)
+
+    for key in POSITION_KEYS:
+        if key in batch:
+            batch[key] = batch[key] * _per_row(batch, key, scales)
+    for key in FLOW_KEYS:
+        if key in batch:
+            batch[key] = batch[key] * _per_row(batch, key, signs)
+    return batch
@@ -0,0 +1,56 @@
+"""
+Fast collation for the flow / history datasets
+Every sample has the same fields and (in practice) the same number of points, and none
+of the fields needs an index increment, so a batch is one torch.cat per field.
+The result is a regular PyG Batch (batch / ptr vectors, to_data_list() still works),
+the models get their dense (B, N, ...) views by reshaping, as before.
+"""
+
+from typing import List
+
+import torch
+import torch_geometric.data as tgd
+
+
+def collate_dense(data_list: List[tgd.Data]) -> tgd.Batch:
+    """
+    Same batch as tgd.Batch.from_data_list(data_list), without the per-attribute
+    bookkeeping of the generic PyG collation.
+    Falls back to from_data_list for fields that PyG increments (edge indices, faces).
+    """
+    elem = data_list[0]
+    keys = [key for key, _ in elem]
+    if any("index" in key or "face" in key for key in keys):
+        return tgd.Batch.from_data_list(data_list)
+
+    n_graphs = len(data_list)
+    graph_slices = torch.arange(n_graphs + 1)
+    no_incs = torch.zeros(n_graphs, dtype=torch.long)  # What PyG stores, unused
+    batch = tgd.Batch(_base_cls=elem.__class__)
+    slice_dict, inc_dict = {}, {}
+    for key in keys:
+        values = [data[key] for data in data_list]
+        if torch.is_tensor(values[0]):
+            values = [value.view(1) if value.dim() == 0 else value for value in values]
+            batch[key] = torch.cat(values)
+            sizes = torch.tensor([value.shape[0] for value in values])
+            slice_dict[key] = torch.cat(
+                [torch.zeros(1, dtype=torch.long), sizes.cumsum(0)]
+            )
+            inc_dict[key] = no_incs
+        elif isinstance(values[0], (int, float)):  # e.g. K
+            batch[key] = torch.tensor(values)
+            slice_dict[key] = graph_slices
+            inc_dict[key] = no_incs
+        else:  # e.g. id
+            batch[key] = values
+            slice_dict[key] = graph_slices
+            inc_dict[key] = None
+
+    counts = torch.tensor([data.num_nodes for data in data_list])
+    batch.batch = torch.arange(n_graphs).repeat_interleave(counts)
+    batch.ptr = torch.cat([torch.zeros(1, dtype=torch.long), counts.cumsum(0)])
+    batch._num_graphs = n_graphs
+    batch._slice_dict = slice_dict
+    batch._inc_dict = inc_dict
+    return batch
@@ -1,14 +1,111 @@
+import functools
 import os
 
 import lightning as L
+import numpy as np
 import rpad.partnet_mobility_utils.dataset as rpd
+import torch
+import torch.distributed as dist
+import torch_geometric.data as tgd
 import torch_geometric.loader as tgl
 from rpad.pyg.dataset import CachedByKeyDataset
+from torch.utils.data import DataLoader, Sampler
 
+from flowbothd.datasets.dense_batch import collate_dense
 from flowbothd.datasets.flow_history_dataset import FlowHistoryDataset
-from flowbothd.datasets.flow_trajectory_dataset_pyg import (
-    FlowTrajectoryPyGDataset,
-)
+from flowbothd.datasets.flow_trajectory_dataset_pyg import FlowTrajectoryPyGDataset
+from flowbothd.datasets.memmap_cache import memmap_cache
+
+
+class ShardSampler(Sampler):
+    """Disjoint per-rank shard of a dataset, for DDP.
+
+    The rank is read from torch.distributed when iterating (the loaders are built
+    before the process group exists). Training shards are reshuffled every epoch
+    with the same permutation on all ranks, and cut to equal lengths so every rank
+    runs the same number of steps. Evaluation shards are not padded (unlike
+    DistributedSampler), so every sample is evaluated exactly once, and ranks may
+    run different numbers of eval steps: eval metrics are only reduced across
+    ranks at the end of the epoch (on_step=False), never per step.
+    """
+
+    def __init__(self, dataset, world_size, shuffle=False, seed=0, drop_last=False):
+        self.dataset = dataset
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    @staticmethod
+    def rank():
+        return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        if self.drop_last:
+            indices = indices[: len(self) * self.world_size]
+        return iter(indices[self.rank() :: self.world_size])
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.world_size
+        return len(range(self.rank(), len(self.dataset), self.world_size))
+
+
+class VirtualRepeatDataset(tgd.Dataset):
+    """n_repeat samples per object, composed from a smaller cached pool of renders.
+
+    The pool holds pool_size rendered states (camera / joints) per object, laid out
+    like a CachedByKeyDataset (object-major). Repeat r of an object maps to one of
+    its pool states, each state is used equally often and the assignment is fixed
+    by the seed. The variety between repeats of a state then comes from the batch
+    augmentation (see flowbothd.datasets.augmentation).
+    """
+
+    def __init__(self, pool, pool_size, n_repeat, seed=42):
+        super().__init__()
+        assert len(pool) % pool_size == 0, "pool is not object-major"
+        self.pool = pool
+        n_objects = len(pool) // pool_size
+        rng = np.random.default_rng(seed)
+        self.pool_ixs = np.concatenate(
+            [
+                obj * pool_size
+                + rng.permutation(np.resize(np.arange(pool_size), n_repeat))
+                for obj in range(n_objects)
+            ]
+        )
+
+    def len(self) -> int:
+        return len(self.pool_ixs)
+
+    def get(self, idx) -> tgd.Data:
+        return self.pool[int(self.pool_ixs[idx])]
+
+
+def dataloader_kwargs(
+    loader_workers=0, pin_memory=False, prefetch_factor=2, persistent_workers=True
+):
+    """Worker / pinning options of the PyG loaders.
+
+    prefetch_factor and persistent_workers only apply with worker processes
+    (torch rejects them with num_workers=0).
+    """
+    kwargs = dict(num_workers=loader_workers, pin_memory=pin_memory)
+    if loader_workers > 0:
+        kwargs.update(
+            prefetch_factor=prefetch_factor, persistent_workers=persistent_workers
+        )
+    return kwargs
 
 
 # Create FlowBot datamodule
@@ -21,193 +118,174 @@ class FlowTrajectoryDataModule(L.LightningDataModule):
         n_proc,
         history=False,  ## With / without history
         randomize_camera: bool = True,
-        randomize_size: bool = False,
-        augmentation: bool = False,
         trajectory_len: int = 1,
         seed: int = 42,
         special_req: str = None,
         toy_dataset: dict = None,
         n_repeat: int = 100,  # By default, repeat training dataset by 100
+        world_size: int = 1,  # DDP ranks, each loads a disjoint shard
+        cache_format: str = "pickle",  # pickle / memmap (columnar, see memmap_cache)
+        loader_workers: int = 0,  # DataLoader workers (num_workers is for caching)
+        pin_memory: bool = False,
+        prefetch_factor: int = 2,
+        persistent_workers: bool = True,
+        dense_batches: bool = False,  # Collate with collate_dense (one cat per field)
+        repeat_pool: int = None,  # Cache this many renders per object, not n_repeat
+        augmentation: bool = False,  # Batch flips are on: 4x longer training epochs
+        randomize_size: bool = False,  # Batch random sizes are on (see repeat_pool)
     ):
         super().__init__()
         self.batch_size = batch_size
+        self.loader_kwargs = dataloader_kwargs(
+            loader_workers, pin_memory, prefetch_factor, persistent_workers
+        )
+        self.dense_batches = dense_batches
         self.seed = seed
+        self.world_size = world_size
         self.dataset_cls = FlowHistoryDataset if history else FlowTrajectoryPyGDataset
-        if augmentation:  # Augmentation: 4 flip modes
-            n_repeat *= 4
-        print(
-            self.dataset_cls.get_processed_dir(
-                True,
-                randomize_camera,
-                trajectory_len,
-                special_req,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                toy_dataset_id=None if toy_dataset is None else toy_dataset["id"],
+        # The flips used to be cached, as 4 flip modes of every render. They are now
+        # drawn per batch (BatchAugmentationCallback), and every cached render is
+        # served 4 times per epoch instead, so epochs keep their number of steps.
+        epoch_repeat = 4 * n_repeat if augmentation else n_repeat
+        # Virtual repeats: the epoch_repeat training samples per object are drawn
+        # from a cached pool of renders (see VirtualRepeatDataset), repeat_pool of
+        # them if set.
+        cached_repeat = n_repeat if repeat_pool is None else min(repeat_pool, n_repeat)
+        virtual_repeats = cached_repeat < epoch_repeat
+        if cached_repeat < n_repeat and not (augmentation or randomize_size):
+            raise ValueError(
+                "repeat_pool needs augmentation or randomize_size: without batch "
+                "augmentation the repeats drawn from the pool are exact duplicates."
             )
+        if cache_format not in ["pickle", "memmap"]:
+            raise ValueError(f"Unknown cache format: {cache_format}")
+        processed_dirname = self.dataset_cls.get_processed_dir(
+            True,
+            randomize_camera,
+            trajectory_len,
+            special_req,
+            toy_dataset_id=None if toy_dataset is None else toy_dataset["id"],
         )
-        self.train_dset = CachedByKeyDataset(
-            dset_cls=self.dataset_cls,
-            dset_kwargs=dict(
-                root=os.path.join(root, "raw"),
-                split="umpnet-train-train"
-                if toy_dataset is None
-                else toy_dataset["train-train"],
-                randomize_camera=randomize_camera,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                trajectory_len=trajectory_len,
-                special_req=special_req,
-            ),
-            data_keys=rpd.UMPNET_TRAIN_TRAIN_OBJ_IDS
-            if toy_dataset is None
-            else toy_dataset["train-train"],
-            root=root,
-            processed_dirname=self.dataset_cls.get_processed_dir(
-                True,
-                randomize_camera,
-                trajectory_len,
-                special_req,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                toy_dataset_id=None if toy_dataset is None else toy_dataset["id"],
-            ),
-            n_repeat=n_repeat,
-            # n_repeat=1,
-            n_workers=num_workers,
-            n_proc_per_worker=n_proc,
-            seed=seed,
-        )
+        print(processed_dirname)
 
-        self.train_val_dset = CachedByKeyDataset(
-            dset_cls=self.dataset_cls,
-            dset_kwargs=dict(
-                root=os.path.join(root, "raw"),
-                split="umpnet-train-train"
+        def cached_dset(split, n_repeat):
+            """The pickled cache of a split: train-train, train-test or test."""
+            data_keys = (
+                {
+                    "train-train": rpd.UMPNET_TRAIN_TRAIN_OBJ_IDS,
+                    "train-test": rpd.UMPNET_TRAIN_TEST_OBJ_IDS,
+                    "test": rpd.UMPNET_TEST_OBJ_IDS,
+                }[split]
                 if toy_dataset is None
-                else toy_dataset["train-train"],
-                randomize_camera=randomize_camera,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                trajectory_len=trajectory_len,
-                special_req=special_req,
-            ),
-            data_keys=rpd.UMPNET_TRAIN_TRAIN_OBJ_IDS
-            if toy_dataset is None
-            else toy_dataset["train-train"],
-            root=root,
-            processed_dirname=self.dataset_cls.get_processed_dir(
-                True,
-                randomize_camera,
-                trajectory_len,
-                special_req,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                toy_dataset_id=None if toy_dataset is None else toy_dataset["id"],
-            ),
-            n_repeat=1,
-            n_workers=num_workers,
-            n_proc_per_worker=n_proc,
-            seed=seed,
-        )
+                else toy_dataset[split]
+            )
+            return CachedByKeyDataset(
+                dset_cls=self.dataset_cls,
+                dset_kwargs=dict(
+                    root=os.path.join(root, "raw"),
+                    split=f"umpnet-{split}" if toy_dataset is None else data_keys,
+                    randomize_camera=randomize_camera,
+                    trajectory_len=trajectory_len,
+                    special_req=special_req,
+                ),
+                data_keys=data_keys,
+                root=root,
+                processed_dirname=processed_dirname,
+                n_repeat=n_repeat,
+                n_workers=num_workers,
+                n_proc_per_worker=n_proc,
+                seed=seed,
+            )
 
-        self.val_dset = CachedByKeyDataset(
-            dset_cls=self.dataset_cls,
-            dset_kwargs=dict(
-                root=os.path.join(root, "raw"),
-                split="umpnet-train-test"
-                if toy_dataset is None
-                else toy_dataset["train-test"],
-                randomize_camera=randomize_camera,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                trajectory_len=trajectory_len,
-                special_req=special_req,
-            ),
-            data_keys=rpd.UMPNET_TRAIN_TEST_OBJ_IDS
-            if toy_dataset is None
-            else toy_dataset["train-test"],
-            root=root,
-            processed_dirname=self.dataset_cls.get_processed_dir(
-                True,
-                randomize_camera,
-                trajectory_len,
-                special_req,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                toy_dataset_id=None if toy_dataset is None else toy_dataset["id"],
-            ),
-            n_repeat=1,
-            n_workers=num_workers,
-            n_proc_per_worker=n_proc,
-            seed=seed,
+        # Identifies the memmap copies, like processed_dirname for the pickles.
+        params = dict(
+            history=history,
+            randomize_camera=randomize_camera,
+            trajectory_len=trajectory_len,
+            special_req=special_req,
+            toy_dataset_id=None if toy_dataset is None else toy_dataset["id"],
         )
+        for name, split, n in [
+            ("train_dset", "train-train", cached_repeat),
+            ("train_val_dset", "train-train", 1),
+            ("val_dset", "train-test", 1),
+            ("unseen_dset", "test", 1),
+        ]:
+            if cache_format == "pickle":
+                dset = cached_dset(split, n)
+            else:
+                # Opened from the manifest: the pickled cache is only loaded (and
+                # built on first use) when its memmap copy has to be written.
+                dset = memmap_cache(
+                    functools.partial(cached_dset, split, n),
+                    root=root,
+                    processed_dirname=processed_dirname,
+                    split=split,
+                    n_repeat=n,
+                    seed=seed,
+                    params=params,
+                    fields=self.dataset_cls.memmap_fields,
+                )
+            setattr(self, name, dset)
 
-        self.unseen_dset = CachedByKeyDataset(
-            dset_cls=self.dataset_cls,
-            dset_kwargs=dict(
-                root=os.path.join(root, "raw"),
-                split="umpnet-test" if toy_dataset is None else toy_dataset["test"],
-                randomize_camera=randomize_camera,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                trajectory_len=trajectory_len,
-                special_req=special_req,
-            ),
-            data_keys=rpd.UMPNET_TEST_OBJ_IDS
-            if toy_dataset is None
-            else toy_dataset["test"],
-            root=root,
-            processed_dirname=self.dataset_cls.get_processed_dir(
-                True,
-                randomize_camera,
-                trajectory_len,
-                special_req,
-                randomize_size=randomize_size,
-                augmentation=augmentation,
-                toy_dataset_id=None if toy_dataset is None else toy_dataset["id"],
-            ),
-            n_repeat=1,
-            n_workers=num_workers,
-            n_proc_per_worker=n_proc,
-            seed=seed,
+        if virtual_repeats:
+            self.train_dset = VirtualRepeatDataset(
+                self.train_dset, cached_repeat, epoch_repeat, seed=seed
+            )
+
+    def shard_sampler(self, dset, train=False):
+        if self.world_size == 1:
+            return None
+        return ShardSampler(
+            dset, self.world_size, shuffle=train, seed=self.seed, drop_last=train
         )
 
+    def dataloader(self, dset, bsz, **kwargs):
+        if self.dense_batches:
+            return DataLoader(
+                dset, bsz, collate_fn=collate_dense, **kwargs, **self.loader_kwargs
+            )
+        return tgl.DataLoader(dset, bsz, **kwargs, **self.loader_kwargs)
+
     def train_dataloader(self):
         L.seed_everything(self.seed)
-        return tgl.DataLoader(
-            self.train_dset, self.batch_size, shuffle=True, num_workers=0
+        sampler = self.shard_sampler(self.train_dset, train=True)
+        return self.dataloader(
+            self.train_dset,
+            self.batch_size,
+            shuffle=sampler is None,
+            sampler=sampler,
         )
 
     def train_val_dataloader(self, bsz=None):
         bsz = self.batch_size if bsz is None else bsz
-        return tgl.DataLoader(
+        return self.dataloader(
             self.train_val_dset,
             bsz,
             shuffle=False,
-            num_workers=0
+            sampler=self.shard_sampler(self.train_val_dset),
             # self.train_val_dset, 1, shuffle=False, num_workers=0
         )
 
     def val_dataloader(self, bsz=None):
         bsz = self.batch_size if bsz is None else bsz
-        return tgl.DataLoader(
+        return self.dataloader(
             self.val_dset,
             bsz,
             # 1,   # TODO: change back!
             shuffle=False,
-            num_workers=0
+            sampler=self.shard_sampler(self.val_dset),
             # self.val_dset, 1, shuffle=False, num_workers=0
         )
 
     def unseen_dataloader(self, bsz=None):
         bsz = self.batch_size if bsz is None else bsz
-        return tgl.DataLoader(
+        return self.dataloader(
             self.unseen_dset,
             # self.batch_size,
             bsz,
             # 1,  # TODO: change back!
             shuffle=False,
-            num_workers=0
+            sampler=self.shard_sampler(self.unseen_dset),
             # self.unseen_dset, self.batch_size, shuffle=False, num_workers=0
         )
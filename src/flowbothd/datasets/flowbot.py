@@ -6,6 +6,8 @@ import torch_geometric.loader as tgl
 from flowbot3d.datasets.flow_dataset_pyg import Flowbot3DPyGDataset
 from rpad.pyg.dataset import CachedByKeyDataset
 
+from flowbothd.datasets.flow_trajectory import dataloader_kwargs
+
 
 class FlowBotDataModule(L.LightningDataModule):
     def __init__(
@@ -16,10 +18,17 @@ class FlowBotDataModule(L.LightningDataModule):
         n_proc,
         randomize_camera: bool = True,
         seed=42,
+        loader_workers: int = 0,  # DataLoader workers (num_workers is for caching)
+        pin_memory: bool = False,
+        prefetch_factor: int = 2,
+        persistent_workers: bool = True,
         **kwargs,
     ):
         super().__init__()
         self.batch_size = batch_size
+        self.loader_kwargs = dataloader_kwargs(
+            loader_workers, pin_memory, prefetch_factor, persistent_workers
+        )
         self.seed = seed
 
         self.train_dset = CachedByKeyDataset(
@@ -102,21 +111,21 @@ class FlowBotDataModule(L.LightningDataModule):
         if shuffle:
             L.seed_everything(self.seed)
         return tgl.DataLoader(
-            self.train_dset, self.batch_size, shuffle=shuffle, num_workers=0
+            self.train_dset, self.batch_size, shuffle=shuffle, **self.loader_kwargs
         )
 
     def train_val_dataloader(self):
         L.seed_everything(self.seed)
         return tgl.DataLoader(
-            self.train_val_dset, self.batch_size, shuffle=False, num_workers=0
+            self.train_val_dset, self.batch_size, shuffle=False, **self.loader_kwargs
         )
 
     def val_dataloader(self):
         return tgl.DataLoader(
-            self.val_dset, self.batch_size, shuffle=False, num_workers=0
+            self.val_dset, self.batch_size, shuffle=False, **self.loader_kwargs
         )
 
     def unseen_dataloader(self):
         return tgl.DataLoader(
-            self.unseen_dset, self.batch_size, shuffle=False, num_workers=0
+            self.unseen_dset, self.batch_size, shuffle=False, **self.loader_kwargs
         )
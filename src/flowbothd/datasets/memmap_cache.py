@@ -0,0 +1,135 @@
+"""
+Memory-mapped columnar format for the processed flow / history caches
+- One .npy file per field (pos, delta, mask, ...), fixed width: (n_samples, *sample_shape)
+- Object ids in id.npy, a fixed-width string column
+- A manifest.json in the cache dir, one entry per (split, n_repeat, seed), with the
+  get_processed_dir() parameters and the shape / dtype of every column
+Samples are served as views of np.memmap arrays (copy-on-write), so loading a sample
+only reads its pages, there is no per-sample unpickling.
+"""
+
+import json
+import os
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+import torch
+import torch_geometric.data as tgd
+import tqdm
+
+
+def _sample_columns(data: tgd.Data, fields: Sequence[str]) -> Dict[str, np.ndarray]:
+    columns = {}
+    for field in fields:
+        value = data[field]
+        if torch.is_tensor(value):
+            value = value.numpy()
+        columns[field] = np.asarray(value)
+    return columns
+
+
+def write_memmap_cache(dset, out_dir: str, fields: Sequence[str]) -> Dict:
+    """
+    Write every sample of dset (in order) to fixed-width column files in out_dir.
+    The fields must have the same shape in every sample, otherwise keep the
+    pickled cache for this dataset.
+    Returns the column layout, {field: {"dtype", "shape"}}.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    n = len(dset)
+    first = dset[0]
+    layout = {
+        field: {"dtype": value.dtype.str, "shape": list(value.shape)}
+        for field, value in _sample_columns(first, fields).items()
+    }
+    arrays = {
+        field: np.lib.format.open_memmap(
+            os.path.join(out_dir, f"{field}.npy"),
+            mode="w+",
+            dtype=np.dtype(spec["dtype"]),
+            shape=(n, *spec["shape"]),
+        )
+        for field, spec in layout.items()
+    }
+    ids: List[str] = []
+    for ix in tqdm.tqdm(range(n), desc=f"Writing {out_dir}"):
+        data = first if ix == 0 else dset[ix]
+        for field, value in _sample_columns(data, fields).items():
+            if list(value.shape) != layout[field]["shape"]:
+                raise ValueError(
+                    f"{field} of sample {ix} has shape {list(value.shape)}, expected "
+                    f"{layout[field]['shape']}: not a fixed-width field."
+                )
+            arrays[field][ix] = value
+        ids.append(data.id)
+    for array in arrays.values():
+        array.flush()
+    np.save(os.path.join(out_dir, "id.npy"), np.array(ids))
+    return layout
+
+
+class MemmapFlowDataset(tgd.Dataset):
+    """Serves the samples of a cache written by write_memmap_cache()."""
+
+    def __init__(self, cache_dir: str, layout: Dict):
+        super().__init__()
+        self.cache_dir = cache_dir
+        # Copy-on-write maps: writable views for torch.from_numpy, nothing is
+        # read before a sample is accessed and nothing is ever written back.
+        self.columns = {
+            field: np.load(os.path.join(cache_dir, f"{field}.npy"), mmap_mode="c")
+            for field in layout
+        }
+        self.ids = np.load(os.path.join(cache_dir, "id.npy"), mmap_mode="r")
+
+    def len(self) -> int:
+        return len(self.ids)
+
+    def get(self, idx) -> tgd.Data:
+        data = tgd.Data(id=str(self.ids[idx]))
+        for field, column in self.columns.items():
+            value = column[idx]
+            # Scalar fields (e.g. K) are plain numbers in the pickled samples.
+            data[field] = value.item() if value.ndim == 0 else torch.from_numpy(value)
+        return data
+
+
+def memmap_cache(
+    make_dset: Callable[[], tgd.Dataset],
+    root: str,
+    processed_dirname: str,
+    split: str,
+    n_repeat: int,
+    seed: int,
+    params: Dict,
+    fields: Sequence[str],
+) -> MemmapFlowDataset:
+    """
+    The memory-mapped version of a CachedByKeyDataset, written on first use to
+    root/<processed_dirname>_memmap/<split>_<n_repeat>_<seed>/.
+    The manifest records the get_processed_dir() parameters of every entry, an
+    entry whose parameters don't match is rewritten.
+    :param make_dset: builds the (pickled) dataset. Only called when the entry has
+        to be written, a cached entry is opened from the manifest alone.
+    """
+    cache_root = os.path.join(root, f"{processed_dirname}_memmap")
+    manifest_file = os.path.join(cache_root, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    key = f"{split}_{n_repeat}_{seed}"
+    entry = dict(params=params, n_repeat=n_repeat, seed=seed, fields=list(fields))
+    cached = manifest.get(key)
+    if cached is None or {k: cached.get(k) for k in entry} != entry:
+        dset = make_dset()
+        entry["n_samples"] = len(dset)
+        entry["columns"] = write_memmap_cache(
+            dset, os.path.join(cache_root, key), fields
+        )
+        manifest[key] = entry
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        cached = entry
+    return MemmapFlowDataset(os.path.join(cache_root, key), cached["columns"])
@@ -1,12 +1,22 @@
 import torch
 
 
-def normalize_trajectory(pred):  # pred: bs * 1200, traj_len, 3
-    pred = pred.reshape(-1, 1200, pred.shape[1], pred.shape[2])
-    norm = pred.norm(p=2, dim=-1)
-    norm = torch.max(norm, dim=1).values + 1e-6
-    pred = pred / norm[:, None, :, None]
-    return torch.flatten(pred, start_dim=0, end_dim=1)  # bs * 1200, traj_len, 3
+def normalize_trajectory(
+    pred, batch=None, n_points=1200
+):  # pred: total points, traj_len, 3
+    # Scale each point cloud so that its longest flow (per trajectory step) has norm 1.
+    # batch: the cloud index of every point (PyG batch), so clouds can differ in size.
+    # Without it, pred is consecutive clouds of n_points points.
+    pred = pred.float()  # Always normalize in fp32
+    norm = pred.norm(p=2, dim=-1)  # total points, traj_len
+    if batch is None:
+        batch = torch.arange(
+            pred.shape[0] // n_points, device=pred.device
+        ).repeat_interleave(n_points)
+    max_norm = norm.new_zeros(int(batch.max()) + 1, norm.shape[1]).scatter_reduce(
+        0, batch[:, None].expand_as(norm), norm, reduce="amax", include_self=False
+    )
+    return pred / (max_norm[batch] + 1e-6)[:, :, None]  # total points, traj_len, 3
 
 
 def flow_metrics(
@@ -60,3 +70,72 @@ def artflownet_loss(
 
     else:
         return raw_se
+
+
+def _masked_mean(values, weights):
+    # values: trial_times, bs, ...; weights: 1, bs, ... -> trial_times, bs
+    weights = weights.expand_as(values).flatten(2).float()
+    return (values.flatten(2) * weights).sum(-1) / weights.sum(-1).clamp(min=1)
+
+
+# The {mode}_wta/ metrics logged by the training modules' predict_wta().
+WTA_LOG_KEYS = [
+    "flow_loss",
+    "rmse",
+    "cosine_similarity",
+    "mag_error",
+    "multimodal",
+    "pos@0.7",
+    "neg@0.7",
+]
+
+
+def valid_mean(values, valid):
+    """Mean of per-object values over the valid objects, 0 if none is valid."""
+    values = torch.where(valid, values.float(), torch.zeros_like(values.float()))
+    return values.sum() / valid.sum().clamp(min=1)
+
+
+def wta_metrics(f_pred, f_target, mask, trial_times, bs=1):
+    """Winner-take-all metrics of trial_times predictions for bs point clouds.
+
+    f_pred: trial_times * bs * N, traj_len, 3 normalized predictions, stacked trial-major.
+    f_target: bs * N, traj_len, 3 normalized target.
+    mask: bs * N, the points to compute the flow metrics on.
+
+    Everything is reduced per object. Returns a dict with the per-trial "flow_loss"
+    (trial_times, bs), the "chosen_id" (bs) of the trial with the smallest flow loss,
+    the per-trial "rmse", "cos_dist", "mag_error" (trial_times, bs) on the masked
+    points, "pos@0.7", "neg@0.7", "multimodal" (bs) and "valid" (bs), whether the
+    object has any masked point. Masked metrics of invalid objects are zero.
+    """
+    f_pred = f_pred.reshape(trial_times, bs, -1, *f_pred.shape[1:])
+    f_target = f_target.reshape(1, bs, -1, *f_target.shape[1:])
+    f_ix = mask.bool().reshape(1, bs, -1, 1)  # broadcast over traj_len
+
+    flow_loss = artflownet_loss(f_pred, f_target, None, reduce=False)
+    flow_loss = flow_loss.flatten(2).mean(-1)  # trial_times, bs
+    # Choose the one with smallest flow loss for each object
+    chosen_id = torch.min(flow_loss, 0)[1]  # index
+
+    # Compute some metrics on flow-only regions, same as flow_metrics.
+    with torch.no_grad():
+        rmse = (f_pred - f_target).norm(p=2, dim=-1)
+        cos_dist = torch.cosine_similarity(f_pred, f_target, dim=-1)
+        mag_error = (f_pred.norm(p=2, dim=-1) - f_target.norm(p=2, dim=-1)).abs()
+    nonzero_gt = f_target.norm(dim=-1) != 0.0
+    cos_dist = _masked_mean(cos_dist, f_ix & nonzero_gt)
+
+    pos_cosine = torch.sum((cos_dist - 0.7) > 0, dim=0) / trial_times
+    neg_cosine = torch.sum((cos_dist + 0.7) < 0, dim=0) / trial_times
+    return {
+        "flow_loss": flow_loss,
+        "chosen_id": chosen_id,
+        "rmse": _masked_mean(rmse, f_ix),
+        "cos_dist": cos_dist,
+        "mag_error": _masked_mean(mag_error, f_ix),
+        "pos@0.7": pos_cosine,
+        "neg@0.7": neg_cosine,
+        "multimodal": ((pos_cosine != 0) & (neg_cosine != 0)).float(),
+        "valid": f_ix[0].flatten(1).any(-1),
+    }
@@ -3,6 +3,9 @@
 #     ADM:   https://github.com/openai/guided-diffusion/blob/main/guided_diffusion
 #     IDDPM: https://github.com/openai/improved-diffusion/blob/main/improved_diffusion/gaussian_diffusion.py
 
+import torch
+import torch_geometric.data as tgd
+
 from . import gaussian_diffusion as gd
 from .respace import SpacedDiffusion, space_timesteps
 
@@ -44,3 +47,70 @@ def create_diffusion(
         loss_type=loss_type
         # rescale_timesteps=rescale_timesteps,
     )
+
+
+def backbone_autocast(device, precision="32"):
+    """
+    Autocast context for running the denoiser at the given precision.
+    "32" runs in full fp32, "bf16" runs the backbone under bf16 autocast (also on
+    CPU). GaussianDiffusion casts the model output back to fp32.
+    """
+    return torch.autocast(
+        device_type=torch.device(device).type,
+        dtype=torch.bfloat16,
+        enabled=str(precision) == "bf16",
+    )
+
+
+def has_uniform_point_count(batch):
+    """Whether all point clouds of a PyG batch have the same number of points."""
+    counts = batch.ptr[1:] - batch.ptr[:-1]
+    return bool((counts == counts[0]).all())
+
+
+def uniform_point_count(batch, n_points=None):
+    """
+    The number of points of every point cloud of a PyG batch, for the paths that
+    sample dense (B, C, L) tensors. Raises a ValueError if the clouds differ in size
+    (split the batch with split_by_point_count()), or if they don't have n_points
+    points when given (the fixed-size training modules).
+    """
+    counts = (batch.ptr[1:] - batch.ptr[:-1]).tolist()
+    if len(set(counts)) != 1 or (n_points is not None and counts[0] != n_points):
+        expected = "the same number of" if n_points is None else f"{n_points}"
+        raise ValueError(
+            f"Expected point clouds of {expected} points, got {sorted(set(counts))}"
+        )
+    return counts[0]
+
+
+def split_by_point_count(batch):
+    """
+    The sub-batches of a PyG batch that group its point clouds by number of points
+    (the batch itself if they all have the same).
+    """
+    if has_uniform_point_count(batch):
+        yield batch
+        return
+    data_list = batch.to_data_list()
+    for n in sorted({data.num_nodes for data in data_list}):
+        yield tgd.Batch.from_data_list([d for d in data_list if d.num_nodes == n])
+
+
+def predict_by_point_count(predict_step, batch, **kwargs):
+    """
+    Run predict_step on a PyG batch whose point clouds differ in size: clouds with
+    the same number of points are sampled together, and the per-point predictions
+    are returned in the batch's point order.
+    The denoisers take dense (B, C, L) inputs, so every distinct point count costs
+    its own sampling loop: mixed-size batches are supported, not fast.
+    """
+    data_list = batch.to_data_list()
+    counts = [data.num_nodes for data in data_list]
+    preds = [None] * len(data_list)
+    for n in sorted(set(counts)):
+        ids = [i for i, count in enumerate(counts) if count == n]
+        group = tgd.Batch.from_data_list([data_list[i] for i in ids])
+        for i, pred in zip(ids, predict_step(group, 0, **kwargs).split(n)):
+            preds[i] = pred
+    return torch.cat(preds)
@@ -175,6 +175,7 @@ class GaussianDiffusion:
 
         # calculations for diffusion q(x_t | x_{t-1}) and others
         self.sqrt_alphas_cumprod = np.sqrt(self.alphas_cumprod)
+        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
         self.sqrt_one_minus_alphas_cumprod = np.sqrt(1.0 - self.alphas_cumprod)
         self.log_one_minus_alphas_cumprod = np.log(1.0 - self.alphas_cumprod)
         self.sqrt_recip_alphas_cumprod = np.sqrt(1.0 / self.alphas_cumprod)
@@ -200,6 +201,32 @@ class GaussianDiffusion:
             / (1.0 - self.alphas_cumprod)
         )
 
+        # model variances, see p_mean_variance()
+        self.log_betas = np.log(betas)
+        # for fixedlarge, we set the initial (log-)variance like so
+        # to get a better decoder log likelihood.
+        self.fixed_large_variance = np.append(self.posterior_variance[1], betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+
+        # Tensor copies of the tables above, keyed by (name, device). See _extract().
+        self._tables = {}
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        Like _extract_into_tensor(), for one of this diffusion's schedule tables.
+        The table is copied to the timesteps' device (as float32) on first use
+        and cached, instead of being converted from numpy on every call.
+        :param name: the attribute name of the 1-D numpy table.
+        """
+        key = (name, timesteps.device)
+        table = self._tables.get(key)
+        if table is None:
+            table = th.from_numpy(getattr(self, name)).to(
+                device=timesteps.device, dtype=th.float32
+            )
+            self._tables[key] = table
+        return _extract_into_tensor(table, timesteps, broadcast_shape)
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -207,13 +234,9 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        )
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
-        )
+        mean = self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+        variance = self._extract("one_minus_alphas_cumprod", t, x_start.shape)
+        log_variance = self._extract("log_one_minus_alphas_cumprod", t, x_start.shape)
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, noise=None):
@@ -229,9 +252,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
-            * noise
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape) * noise
         )
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
@@ -241,12 +263,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -288,33 +310,31 @@ class GaussianDiffusion:
             model_output, extra = model_output
         else:
             extra = None
+        # The model may run under bf16 autocast, the schedule math stays in fp32.
+        model_output = model_output.float()
 
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
             model_output, model_var_values = th.split(model_output, C, dim=1)
-            min_log = _extract_into_tensor(
-                self.posterior_log_variance_clipped, t, x.shape
-            )
-            max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+            min_log = self._extract("posterior_log_variance_clipped", t, x.shape)
+            max_log = self._extract("log_betas", t, x.shape)
             # The model_var_values is [-1, 1] for [min_var, max_var].
             frac = (model_var_values + 1) / 2
             model_log_variance = frac * max_log + (1 - frac) * min_log
             model_variance = th.exp(model_log_variance)
         else:
             model_variance, model_log_variance = {
-                # for fixedlarge, we set the initial (log-)variance like so
-                # to get a better decoder log likelihood.
                 ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+                    "fixed_large_variance",
+                    "fixed_large_log_variance",
                 ),
                 ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
+                    "posterior_variance",
+                    "posterior_log_variance_clipped",
                 ),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -347,15 +367,14 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t - pred_xstart
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def condition_mean(self, cond_fn, p_mean_var, x, t, model_kwargs=None):
         """
@@ -379,7 +398,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(x, t, **model_kwargs)
@@ -400,6 +419,7 @@ class GaussianDiffusion:
         denoised_fn=None,
         cond_fn=None,
         model_kwargs=None,
+        noise_buffer=None,
     ):
         """
         Sample x_{t-1} from the model at the given timestep.
@@ -413,6 +433,8 @@ class GaussianDiffusion:
                         similarly to the model.
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
+        :param noise_buffer: if not None, a tensor shaped like x that the noise
+            is drawn into (owned by the calling sampling loop).
         :return: a dict containing the following keys:
                  - 'sample': a random sample from the model.
                  - 'pred_xstart': a prediction of x_0.
@@ -425,7 +447,8 @@ class GaussianDiffusion:
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
         )
-        noise = th.randn_like(x)
+        # normal_() draws the same values th.randn_like(x) would.
+        noise = th.randn_like(x) if noise_buffer is None else noise_buffer.normal_()
         nonzero_mask = (
             (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
         )  # no noise when t == 0
@@ -433,7 +456,10 @@ class GaussianDiffusion:
             out["mean"] = self.condition_mean(
                 cond_fn, out, x, t, model_kwargs=model_kwargs
             )
-        sample = out["mean"] + nonzero_mask * th.exp(0.5 * out["log_variance"]) * noise
+        # The sample is written into the (freshly computed) mean rather than a
+        # shared output buffer, since callers may keep the returned samples.
+        std = out["log_variance"].mul(0.5).exp_().mul_(nonzero_mask)
+        sample = out["mean"].addcmul_(std, noise)
         return {"sample": sample, "pred_xstart": out["pred_xstart"]}
 
     def p_sample_loop(
@@ -447,6 +473,9 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        intermediate_stride=0,
+        intermediate_steps=None,
+        intermediate_key="sample",
     ):
         """
         Generate samples from the model.
@@ -464,23 +493,68 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
-        :return: a non-differentiable batch of samples.
+        :param intermediate_stride: if > 0, keep every intermediate_stride-th
+                                    intermediate (and the final one). The
+                                    default 0 keeps none.
+        :param intermediate_steps: if specified, a collection of step indices
+                                   (0 is the first denoising step) to keep,
+                                   instead of a stride.
+        :param intermediate_key: the p_sample() output to keep for the kept
+                                 steps, "sample" or "pred_xstart".
+        :return: a tuple (non-differentiable batch of samples, list of kept
+                 intermediates). When keeping strided samples, the list starts
+                 with the initial noise.
+        """
+        return self._collect_intermediates(
+            self.p_sample_loop_progressive(
+                model,
+                shape,
+                noise=noise,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                cond_fn=cond_fn,
+                model_kwargs=model_kwargs,
+                device=device,
+                progress=progress,
+            ),
+            noise,
+            intermediate_stride=intermediate_stride,
+            intermediate_steps=intermediate_steps,
+            intermediate_key=intermediate_key,
+        )
+
+    def _collect_intermediates(
+        self,
+        progressive,
+        noise,
+        intermediate_stride=0,
+        intermediate_steps=None,
+        intermediate_key="sample",
+    ):
+        """
+        Run a progressive sampling loop and keep only the requested
+        intermediates, so that unused steps can be freed as soon as the next
+        one is computed.
+        :return: a tuple (final sample, list of kept intermediates).
         """
         final = None
-        results = [noise]
-        for sample in self.p_sample_loop_progressive(
-            model,
-            shape,
-            noise=noise,
-            clip_denoised=clip_denoised,
-            denoised_fn=denoised_fn,
-            cond_fn=cond_fn,
-            model_kwargs=model_kwargs,
-            device=device,
-            progress=progress,
-        ):
+        results = []
+        if intermediate_steps is not None:
+            intermediate_steps = set(intermediate_steps)
+        elif intermediate_stride > 0 and intermediate_key == "sample":
+            results.append(noise)
+        for k, sample in enumerate(progressive):
             final = sample
-            results.append(final["sample"])
+            if intermediate_steps is not None:
+                keep = k in intermediate_steps
+            elif intermediate_stride > 0:
+                keep = (k + 1) % intermediate_stride == 0 or (
+                    k == self.num_timesteps - 1
+                )
+            else:
+                keep = False
+            if keep:
+                results.append(final[intermediate_key])
 
         return final["sample"], results
 
@@ -511,6 +585,7 @@ class GaussianDiffusion:
         else:
             img = th.randn(*shape, device=device)
         indices = list(range(self.num_timesteps))[::-1]
+        timesteps = th.arange(self.num_timesteps, device=device)
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
@@ -518,8 +593,11 @@ class GaussianDiffusion:
 
             # indices = tqdm(indices)
 
+        # Scratch tensor for the step noise, local to this loop so that
+        # concurrent loops on the same diffusion don't share it.
+        noise_buffer = th.empty_like(img)
         for i in indices:
-            t = th.tensor([i] * shape[0], device=device)
+            t = timesteps[i].expand(shape[0])
             with th.no_grad():
                 out = self.p_sample(
                     model,
@@ -529,6 +607,7 @@ class GaussianDiffusion:
                     denoised_fn=denoised_fn,
                     cond_fn=cond_fn,
                     model_kwargs=model_kwargs,
+                    noise_buffer=noise_buffer,
                 )
                 yield out
                 img = out["sample"]
@@ -565,8 +644,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -612,10 +691,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (
@@ -684,6 +763,7 @@ class GaussianDiffusion:
         else:
             img = th.randn(*shape, device=device)
         indices = list(range(self.num_timesteps))[::-1]
+        timesteps = th.arange(self.num_timesteps, device=device)
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
@@ -692,7 +772,7 @@ class GaussianDiffusion:
             # indices = tqdm(indices)
 
         for i in indices:
-            t = th.tensor([i] * shape[0], device=device)
+            t = timesteps[i].expand(shape[0])
             with th.no_grad():
                 out = self.ddim_sample(
                     model,
@@ -707,6 +787,202 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        intermediate_stride=0,
+        intermediate_steps=None,
+        intermediate_key="sample",
+    ):
+        """
+        Generate samples from the model using DPM-Solver++(2M).
+        Same usage (and return value) as p_sample_loop().
+        """
+        return self._collect_intermediates(
+            self.dpm_solver_sample_loop_progressive(
+                model,
+                shape,
+                noise=noise,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                cond_fn=cond_fn,
+                model_kwargs=model_kwargs,
+                device=device,
+                progress=progress,
+            ),
+            noise,
+            intermediate_stride=intermediate_stride,
+            intermediate_steps=intermediate_steps,
+            intermediate_key=intermediate_key,
+        )
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+    ):
+        """
+        Use the multistep DPM-Solver++(2M) ODE solver (Lu et al., 2022) to sample
+        from the model and yield intermediate samples from each timestep.
+        The solver works on the data prediction, so it applies to any
+        model_mean_type / model_var_type; learned variances are ignored.
+        Each step goes from timestep i to i - 1 of this diffusion, so respace
+        it (e.g. SpacedDiffusion with 10 steps) to sample in a few steps.
+        Same usage as p_sample_loop_progressive().
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        indices = list(range(self.num_timesteps))[::-1]
+        timesteps = th.arange(self.num_timesteps, device=device)
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        prev_pred_xstart = None
+        prev_h = None
+        for i in indices:
+            t = timesteps[i].expand(shape[0])
+            with th.no_grad():
+                out = self.p_mean_variance(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                )
+                if cond_fn is not None:
+                    out = self.condition_score(
+                        cond_fn, out, img, t, model_kwargs=model_kwargs
+                    )
+                pred_xstart = out["pred_xstart"]
+
+                if self.alphas_cumprod_prev[i] == 1.0:
+                    # Last step: sigma is 0, the solution is the data prediction.
+                    sample = pred_xstart
+                else:
+                    alpha_s = self.sqrt_alphas_cumprod[i]
+                    sigma_s = self.sqrt_one_minus_alphas_cumprod[i]
+                    alpha_t = np.sqrt(self.alphas_cumprod_prev[i])
+                    sigma_t = np.sqrt(1.0 - self.alphas_cumprod_prev[i])
+                    # Step size in half-log-SNR lambda = log(alpha / sigma).
+                    h = np.log(alpha_t / sigma_t) - np.log(alpha_s / sigma_s)
+                    if prev_pred_xstart is None or i == 1:
+                        # First order (DDIM) for the first step, and for the last
+                        # one with sigma > 0 (lower_order_final): it ends at the
+                        # first timestep of the base schedule, so it spans most of
+                        # the lambda range and the 2M extrapolation is unstable
+                        # there, whatever the number of steps.
+                        d = pred_xstart
+                    else:
+                        r = prev_h / h
+                        d = (1.0 + 0.5 / r) * pred_xstart - (0.5 / r) * prev_pred_xstart
+                    sample = (sigma_t / sigma_s) * img - alpha_t * np.expm1(-h) * d
+                    prev_h = h
+                prev_pred_xstart = pred_xstart
+
+                out = {"sample": sample, "pred_xstart": pred_xstart}
+                yield out
+                img = out["sample"]
+
+    def sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        sampler="ddpm",
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        eta=0.0,
+        intermediate_stride=0,
+        intermediate_steps=None,
+        intermediate_key="sample",
+    ):
+        """
+        Generate samples from the model with the given sampler.
+        Same usage as p_sample_loop() (including intermediate retention),
+        with the extra arguments:
+        :param sampler: "ddpm" for ancestral sampling, "ddim" for DDIM,
+                        "dpm_solver++" for DPM-Solver++(2M). All run over this
+                        diffusion's (possibly respaced) timesteps.
+        :param eta: the DDIM noise scale, ignored by the other samplers.
+        :return: a tuple (final sample, list of kept intermediates).
+        """
+        if sampler == "ddpm":
+            progressive = self.p_sample_loop_progressive(
+                model,
+                shape,
+                noise=noise,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                cond_fn=cond_fn,
+                model_kwargs=model_kwargs,
+                device=device,
+                progress=progress,
+            )
+        elif sampler == "ddim":
+            progressive = self.ddim_sample_loop_progressive(
+                model,
+                shape,
+                noise=noise,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                cond_fn=cond_fn,
+                model_kwargs=model_kwargs,
+                device=device,
+                progress=progress,
+                eta=eta,
+            )
+        elif sampler == "dpm_solver++":
+            progressive = self.dpm_solver_sample_loop_progressive(
+                model,
+                shape,
+                noise=noise,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                cond_fn=cond_fn,
+                model_kwargs=model_kwargs,
+                device=device,
+                progress=progress,
+            )
+        else:
+            raise NotImplementedError(f"unknown sampler: {sampler}")
+
+        return self._collect_intermediates(
+            progressive,
+            noise,
+            intermediate_stride=intermediate_stride,
+            intermediate_steps=intermediate_steps,
+            intermediate_key=intermediate_key,
+        )
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
@@ -772,7 +1048,7 @@ class GaussianDiffusion:
             if self.loss_type == LossType.RESCALED_KL:
                 terms["loss"] *= self.num_timesteps
         elif self.loss_type == LossType.MSE or self.loss_type == LossType.RESCALED_MSE:
-            model_output = model(x_t, t, **model_kwargs)
+            model_output = model(x_t, t, **model_kwargs).float()
 
             if self.model_var_type in [
                 ModelVarType.LEARNED,
@@ -889,14 +1165,18 @@ class GaussianDiffusion:
 
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
-    Extract values from a 1-D numpy array for a batch of indices.
-    :param arr: the 1-D numpy array.
+    Extract values from a 1-D numpy array (or tensor) for a batch of indices.
+    :param arr: the 1-D numpy array, or a 1-D tensor on the timesteps' device.
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
-    res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
+    if isinstance(arr, th.Tensor):
+        res = arr[timesteps]
+    else:
+        res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
-    return res + th.zeros(broadcast_shape, device=timesteps.device)
+    # expand() broadcasts without allocating; the result must not be written to.
+    return res.expand(broadcast_shape)
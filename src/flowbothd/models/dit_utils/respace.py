@@ -85,6 +85,7 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        self._wrapped_model = None
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -105,7 +106,12 @@ class SpacedDiffusion(GaussianDiffusion):
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel):
             return model
-        return _WrappedModel(model, self.timestep_map, self.original_num_steps)
+        # Reuse the wrapper (and its cached map tensor) across sampling steps.
+        if self._wrapped_model is None or self._wrapped_model.model is not model:
+            self._wrapped_model = _WrappedModel(
+                model, self.timestep_map, self.original_num_steps
+            )
+        return self._wrapped_model
 
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
@@ -118,9 +124,14 @@ class _WrappedModel:
         self.timestep_map = timestep_map
         # self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.map_tensors = {}
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        key = (ts.device, ts.dtype)
+        map_tensor = self.map_tensors.get(key)
+        if map_tensor is None:
+            map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+            self.map_tensors[key] = map_tensor
         new_ts = map_tensor[ts]
         # if self.rescale_timesteps:
         #     new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
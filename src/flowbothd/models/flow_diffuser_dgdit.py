@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import lightning as L
 import plotly.express as px
@@ -13,11 +13,24 @@ from torch import optim
 
 # from flowbothd.models.modules.dit_models import DiT
 from flowbothd.metrics.trajectory import (
+    WTA_LOG_KEYS,
     artflownet_loss,
     flow_metrics,
     normalize_trajectory,
 )
-from flowbothd.models.dit_utils import create_diffusion
+from flowbothd.models.dit_utils import (
+    backbone_autocast,
+    create_diffusion,
+    uniform_point_count,
+)
+from flowbothd.models.dit_utils.timestep_sampler import (
+    LossAwareSampler,
+    create_named_schedule_sampler,
+)
+from flowbothd.models.modules.dit_models import (
+    build_conditioning_table,
+    enable_activation_checkpointing,
+)
 
 
 # Flow predictor with DGCNN + DiT
@@ -46,6 +59,12 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
         self.diffusion = create_diffusion(
             timestep_respacing=None, diffusion_steps=self.num_train_timesteps
         )
+        # "uniform" or "loss-second-moment" (importance sampling of timesteps).
+        self.schedule_sampler = create_named_schedule_sampler(
+            training_cfg.get("schedule_sampler", "uniform"), self.diffusion
+        )
+        if training_cfg.get("activation_checkpointing", False):
+            enable_activation_checkpointing(self.backbone)
 
         self.cosine_distribution_cache = {"x": [], "y": [], "colors": []}
 
@@ -55,15 +74,23 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
             .reshape(-1, 30, 40, 3 * self.traj_len)
             .permute(0, 3, 1, 2)
             .float()
-            .cuda()
+            .to(self.device)
+        )
+        pos = (
+            batch.pos.reshape(-1, self.sample_size, 3 * self.traj_len)
+            .float()
+            .to(self.device)
         )
-        pos = batch.pos.reshape(-1, self.sample_size, 3 * self.traj_len).float().cuda()
 
         model_kwargs = dict(pos=pos, context=batch)
         loss_dict = self.diffusion.training_losses(
             self.backbone, x, batch.timesteps, model_kwargs
         )
-        loss = loss_dict["loss"].mean()
+        if isinstance(self.schedule_sampler, LossAwareSampler):
+            self.schedule_sampler.update_with_local_losses(
+                batch.timesteps, loss_dict["loss"].detach()
+            )
+        loss = (loss_dict["loss"] * batch.timestep_weights).mean()
 
         self.log_dict(
             {
@@ -84,7 +111,11 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
         bs = batch.delta.shape[0] // self.sample_size
         z = torch.randn(bs, 3 * self.traj_len, 30, 40, device=self.device)  # .float()
 
-        pos = batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len).float().cuda()
+        pos = (
+            batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len)
+            .float()
+            .to(self.device)
+        )
         model_kwargs = dict(pos=pos, context=batch)
 
         samples, results = self.diffusion.p_sample_loop(
@@ -107,7 +138,7 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
 
         # Compute the loss.
         # mask = batch.mask == 1
-        # mask = mask.reshape(-1, self.sample_size).to("cuda")
+        # mask = mask.reshape(-1, self.sample_size).to(self.device)
 
         n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
         f_ix = batch.mask.bool()
@@ -122,11 +153,12 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
         # print(f_pred[f_ix], batch.delta[f_ix])
         loss = artflownet_loss(f_pred, f_target, n_nodes)
 
-        if torch.sum(f_ix) == 0:  # No point
-            return f_pred, loss
-
-        # Compute some metrics on flow-only regions.
-        rmse, cos_dist, mag_error = flow_metrics(f_pred[f_ix], f_target[f_ix])
+        has_flow = bool(f_ix.any())
+        if has_flow:
+            # Compute some metrics on flow-only regions.
+            rmse, cos_dist, mag_error = flow_metrics(f_pred[f_ix], f_target[f_ix])
+        else:  # No point, logged with zero weight
+            rmse = cos_dist = mag_error = torch.zeros_like(loss)
 
         self.log_dict(
             {
@@ -136,7 +168,12 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
                 f"{mode}/mag_error": mag_error,
             },
             add_dataloader_idx=False,
-            batch_size=len(batch),
+            # Reduced across DDP ranks once per epoch (weighted by batch_size), the
+            # eval shards differ in length. Every rank has to log every key.
+            sync_dist=True,
+            on_step=False,
+            on_epoch=True,
+            batch_size=len(batch) if has_flow else 0,
         )
         return f_pred, loss
 
@@ -149,7 +186,11 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
 
         z = torch.randn(bs, 3 * self.traj_len, 30, 40, device=self.device)  # .float()
 
-        pos = batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len).float().cuda()
+        pos = (
+            batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len)
+            .float()
+            .to(self.device)
+        )
         model_kwargs = dict(pos=pos, context=batch)
 
         samples, results = self.diffusion.p_sample_loop(
@@ -172,7 +213,7 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
 
         # Compute the loss.
         mask = batch.mask == 1
-        mask = mask.reshape(-1, self.sample_size).to("cuda")
+        mask = mask.reshape(-1, self.sample_size).to(self.device)
 
         n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
         f_ix = batch.mask.bool()
@@ -190,6 +231,15 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
         chosen_id = torch.min(flow_loss, 0)[1]  # index
 
         if torch.sum(f_ix) == 0:  # No point
+            # Logged with zero weight, every DDP rank has to log every key.
+            self.log_dict(
+                {f"{mode}_wta/{key}": 0.0 for key in WTA_LOG_KEYS},
+                add_dataloader_idx=False,
+                sync_dist=True,
+                on_step=False,
+                on_epoch=True,
+                batch_size=0,
+            )
             return (
                 f_pred.reshape(bs, self.sample_size, self.traj_len, 3)[chosen_id],
                 loss[chosen_id],
@@ -222,6 +272,11 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
                 f"{mode}_wta/neg@0.7": neg_cosine.item(),
             },
             add_dataloader_idx=False,
+            # Reduced across DDP ranks once per epoch (weighted by batch_size), the
+            # eval shards differ in length. Every rank has to log every key.
+            sync_dist=True,
+            on_step=False,
+            on_epoch=True,
             batch_size=len(batch),
         )
         return (
@@ -244,21 +299,21 @@ class FlowTrajectoryDiffusionModule_DGDiT(L.LightningModule):
 
     def training_step(self, batch: tgd.Batch, batch_id):  # type: ignore
         self.train()
-        bs = batch.delta.shape[0] // self.sample_size
+        # Training and validation sample dense clouds of sample_size points.
+        bs = batch.num_graphs
+        uniform_point_count(batch, self.sample_size)
 
         # batch.delta = normalize_trajectory(batch.delta)
-        batch.timesteps = torch.randint(
-            0,
-            self.num_train_timesteps,
-            (bs,),
-            device=self.device,
-        ).long()
+        batch.timesteps, batch.timestep_weights = self.schedule_sampler.sample(
+            bs, self.device
+        )
 
         _, loss = self(batch, "train")
         return loss
 
     def validation_step(self, batch: tgd.Batch, batch_id, dataloader_idx=0):  # type: ignore
         self.eval()
+        uniform_point_count(batch, self.sample_size)
 
         # Clean cache for a new eval dataloader
         if batch_id == 0:
@@ -379,14 +434,29 @@ class FlowTrajectoryDiffuserInferenceModule_DGDiT(L.LightningModule):
         # Diffuser params
         self.sample_size = 1200
         self.backbone = network
-        self.num_inference_timesteps = model_cfg.num_train_timesteps
+        self.num_inference_timesteps = inference_cfg.get(
+            "num_inference_timesteps", model_cfg.num_inference_timesteps
+        )
+        self.sampler = inference_cfg.get("sampler", "ddpm")
+        # "32" or "bf16" (the backbone runs under bf16 autocast).
+        self.inference_precision = str(inference_cfg.get("precision", "32"))
+        # Precompute the timestep conditioning of the sampling steps at load time.
+        self.timestep_table = inference_cfg.get("timestep_table", False)
+        # DGCNN kNN: query chunk size (bounds memory), reuse the position graph.
+        self.backbone.x_embedder.knn_chunk_size = inference_cfg.get(
+            "knn_chunk_size", None
+        )
+        self.backbone.x_embedder.static_graph = inference_cfg.get("static_graph", False)
         self.diffusion = create_diffusion(
-            timestep_respacing=None, diffusion_steps=self.num_inference_timesteps
+            timestep_respacing=[self.num_inference_timesteps],
+            diffusion_steps=model_cfg.num_train_timesteps,
         )
 
     def load_from_ckpt(self, ckpt_file):
-        ckpt = torch.load(ckpt_file)
+        ckpt = torch.load(ckpt_file, map_location=self.device)
         self.load_state_dict(ckpt["state_dict"])
+        if self.timestep_table:
+            build_conditioning_table(self.backbone, self.diffusion.timestep_map)
 
     def forward(self, data) -> torch.Tensor:  # type: ignore
         print(
@@ -396,7 +466,7 @@ class FlowTrajectoryDiffuserInferenceModule_DGDiT(L.LightningModule):
 
     def predict(self, P_world) -> torch.Tensor:  # From pure point cloud
         data = tgd.Data(
-            pos=torch.from_numpy(P_world).float().cuda(),
+            pos=torch.from_numpy(P_world).float().to(self.device),
             # mask=torch.ones(P_world.shape[0]).float(),
         )
         batch = tgd.Batch.from_data_list([data])
@@ -410,24 +480,35 @@ class FlowTrajectoryDiffuserInferenceModule_DGDiT(L.LightningModule):
         return trajectory.cpu()
 
     @torch.no_grad()
-    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = 0) -> torch.Tensor:  # type: ignore
+    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = 0, *, sampler: Optional[str] = None) -> torch.Tensor:  # type: ignore
         # torch.eval()
         self.eval()
-        bs = batch.pos.shape[0] // self.sample_size
+        # The DGCNN encoder is built for clouds of sample_size points.
+        uniform_point_count(batch, self.sample_size)
+        bs = batch.num_graphs
         z = torch.randn(bs, 3 * self.traj_len, 30, 40, device=self.device)  # .float()
 
-        pos = batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len).float().cuda()
-        model_kwargs = dict(pos=pos, context=batch)
-
-        samples, results = self.diffusion.p_sample_loop(
-            self.backbone,
-            z.shape,
-            z,
-            clip_denoised=False,
-            model_kwargs=model_kwargs,
-            progress=True,
-            device=self.device,
+        pos = (
+            batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len)
+            .float()
+            .to(self.device)
         )
+        # The kNN graph of the point cloud is the same at every denoising step.
+        model_kwargs = dict(
+            pos=pos, context=batch, graph=self.backbone.build_graph(pos)
+        )
+
+        with backbone_autocast(self.device, self.inference_precision):
+            samples, results = self.diffusion.sample_loop(
+                self.backbone,
+                z.shape,
+                z,
+                sampler=self.sampler if sampler is None else sampler,
+                clip_denoised=False,
+                model_kwargs=model_kwargs,
+                progress=True,
+                device=self.device,
+            )
 
         f_pred = (
             torch.flatten(samples, start_dim=2, end_dim=3)
@@ -440,7 +521,9 @@ class FlowTrajectoryDiffuserInferenceModule_DGDiT(L.LightningModule):
 
     # For winner takes it all evaluation
     @torch.inference_mode()
-    def predict_wta(self, dataloader, mode="delta", trial_times=50):
+    def predict_wta(
+        self, dataloader, mode="delta", trial_times=50, sampler: Optional[str] = None
+    ):
         all_rmse = 0
         all_cos_dist = 0
         all_mag_error = 0
@@ -451,7 +534,8 @@ class FlowTrajectoryDiffuserInferenceModule_DGDiT(L.LightningModule):
         valid_sample_cnt = 0
 
         for id, orig_sample in tqdm.tqdm(enumerate(dataloader)):
-            bs = orig_sample.delta.shape[0] // self.sample_size
+            uniform_point_count(orig_sample, self.sample_size)
+            bs = orig_sample.num_graphs
             assert bs == 1, f"batch size should be 1, now is {bs}"
 
             # batch every sample into bsz of trial_times
@@ -468,17 +552,21 @@ class FlowTrajectoryDiffuserInferenceModule_DGDiT(L.LightningModule):
                 .float()
                 .to(self.device)
             )
-            model_kwargs = dict(pos=pos, context=batch)
-
-            samples, results = self.diffusion.p_sample_loop(
-                self.backbone,
-                z.shape,
-                z,
-                clip_denoised=False,
-                model_kwargs=model_kwargs,
-                progress=True,
-                device=self.device,
-            )
+            # All trials share the point cloud, so build its kNN graph once.
+            graph = self.backbone.build_graph(pos[:1]).repeat(bs, 1, 1)
+            model_kwargs = dict(pos=pos, context=batch, graph=graph)
+
+            with backbone_autocast(self.device, self.inference_precision):
+                samples, results = self.diffusion.sample_loop(
+                    self.backbone,
+                    z.shape,
+                    z,
+                    sampler=self.sampler if sampler is None else sampler,
+                    clip_denoised=False,
+                    model_kwargs=model_kwargs,
+                    progress=True,
+                    device=self.device,
+                )
 
             f_pred = (
                 torch.flatten(samples, start_dim=2, end_dim=3)
@@ -490,7 +578,7 @@ class FlowTrajectoryDiffuserInferenceModule_DGDiT(L.LightningModule):
 
             # Compute the loss.
             mask = batch.mask == 1
-            mask = mask.reshape(-1, self.sample_size).to("cuda")
+            mask = mask.reshape(-1, self.sample_size).to(self.device)
 
             n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
             f_ix = batch.mask.bool().to(self.device)
@@ -576,7 +664,7 @@ class FlowTrajectoryDiffuserSimulationModule_DGDiT(L.LightningModule):
         rgb, depth, seg, P_cam, P_world, pc_seg, segmap = data
 
         data = tgd.Data(
-            pos=torch.from_numpy(P_world).float().cuda(),
+            pos=torch.from_numpy(P_world).float().to(self.device),
             # mask=torch.ones(P_world.shape[0]).float(),
         )
         batch = tgd.Batch.from_data_list([data])
@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import lightning as L
 import numpy as np
@@ -14,11 +14,28 @@ from torch import optim
 
 # from flowbothd.models.modules.dit_models import DiT
 from flowbothd.metrics.trajectory import (
+    WTA_LOG_KEYS,
     artflownet_loss,
     flow_metrics,
     normalize_trajectory,
 )
-from flowbothd.models.dit_utils import create_diffusion
+from flowbothd.models.dit_utils import (
+    backbone_autocast,
+    create_diffusion,
+    has_uniform_point_count,
+    predict_by_point_count,
+    uniform_point_count,
+)
+from flowbothd.models.dit_utils.timestep_sampler import (
+    LossAwareSampler,
+    create_named_schedule_sampler,
+)
+from flowbothd.models.modules.dit_models import (
+    build_conditioning_table,
+    compile_trunk,
+    enable_activation_checkpointing,
+    quantize_trunk,
+)
 
 
 # Flow predictor with DiT
@@ -52,6 +69,12 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
         self.diffusion = create_diffusion(
             timestep_respacing=None, diffusion_steps=self.num_train_timesteps
         )
+        # "uniform" or "loss-second-moment" (importance sampling of timesteps).
+        self.schedule_sampler = create_named_schedule_sampler(
+            training_cfg.get("schedule_sampler", "uniform"), self.diffusion
+        )
+        if training_cfg.get("activation_checkpointing", False):
+            enable_activation_checkpointing(self.backbone)
 
         self.cosine_distribution_cache = {"x": [], "y": [], "colors": []}
 
@@ -60,7 +83,7 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
             batch.delta.reshape(-1, self.sample_size, 3 * self.traj_len)
             .permute(0, 2, 1)
             .float()
-            .cuda()
+            .to(self.device)
         )  # Ground truth, for loss calculation
         history_embed = self.history_encoder(batch).permute(
             0, 2, 1
@@ -70,7 +93,7 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
                 batch.pos.reshape(-1, self.sample_size, 3 * self.traj_len)
                 .permute(0, 2, 1)
                 .float()
-                .cuda(),
+                .to(self.device),
                 history_embed,  # Concat history embedding
             ],
             dim=1,
@@ -79,7 +102,11 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
         loss_dict = self.diffusion.training_losses(
             self.backbone, x, batch.timesteps, model_kwargs
         )
-        loss = loss_dict["loss"].mean()
+        if isinstance(self.schedule_sampler, LossAwareSampler):
+            self.schedule_sampler.update_with_local_losses(
+                batch.timesteps, loss_dict["loss"].detach()
+            )
+        loss = (loss_dict["loss"] * batch.timestep_weights).mean()
 
         self.log_dict(
             {
@@ -108,7 +135,7 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
                 batch.pos.reshape(-1, self.sample_size, 3 * self.traj_len)
                 .permute(0, 2, 1)
                 .float()
-                .cuda(),
+                .to(self.device),
                 history_embed,  # Concat history embedding
             ],
             dim=1,
@@ -130,7 +157,7 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
 
         # Compute the loss.
         mask = batch.mask == 1
-        mask = mask.reshape(-1, self.sample_size).to("cuda")
+        mask = mask.reshape(-1, self.sample_size).to(self.device)
 
         n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
         f_ix = batch.mask.bool()
@@ -146,13 +173,14 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
         # print(f_pred[f_ix], batch.delta[f_ix])
         loss = artflownet_loss(f_pred, f_target, n_nodes)
 
-        if torch.sum(f_ix) == 0:  # No point
-            return f_pred, loss
-
-        # Compute some metrics on flow-only regions.
-        rmse, cos_dist, mag_error = flow_metrics(f_pred[f_ix], f_target[f_ix])
-        if torch.isnan(cos_dist):
-            breakpoint()
+        has_flow = bool(f_ix.any())
+        if has_flow:
+            # Compute some metrics on flow-only regions.
+            rmse, cos_dist, mag_error = flow_metrics(f_pred[f_ix], f_target[f_ix])
+            if torch.isnan(cos_dist):
+                breakpoint()
+        else:  # No point, logged with zero weight
+            rmse = cos_dist = mag_error = torch.zeros_like(loss)
 
         self.log_dict(
             {
@@ -162,7 +190,12 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
                 f"{mode}/mag_error": mag_error,
             },
             add_dataloader_idx=False,
-            batch_size=len(batch),
+            # Reduced across DDP ranks once per epoch (weighted by batch_size), the
+            # eval shards differ in length. Every rank has to log every key.
+            sync_dist=True,
+            on_step=False,
+            on_epoch=True,
+            batch_size=len(batch) if has_flow else 0,
         )
         return f_pred, loss
 
@@ -183,7 +216,7 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
                 batch.pos.reshape(-1, self.sample_size, 3 * self.traj_len)
                 .permute(0, 2, 1)
                 .float()
-                .cuda(),
+                .to(self.device),
                 history_embed,  # Concat history embedding
             ],
             dim=1,
@@ -205,7 +238,7 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
 
         # Compute the loss.
         # mask = batch.mask == 1
-        # mask = mask.reshape(-1, self.sample_size).to("cuda")
+        # mask = mask.reshape(-1, self.sample_size).to(self.device)
 
         n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
         f_ix = batch.mask.bool()
@@ -224,6 +257,15 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
         chosen_id = torch.min(flow_loss, 0)[1]  # index
 
         if torch.sum(f_ix) == 0:  # No point
+            # Logged with zero weight, every DDP rank has to log every key.
+            self.log_dict(
+                {f"{mode}_wta/{key}": 0.0 for key in WTA_LOG_KEYS},
+                add_dataloader_idx=False,
+                sync_dist=True,
+                on_step=False,
+                on_epoch=True,
+                batch_size=0,
+            )
             return (
                 f_pred.reshape(bs, self.sample_size, self.traj_len, 3)[chosen_id],
                 loss[chosen_id],
@@ -257,6 +299,11 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
                 f"{mode}_wta/neg@0.7": neg_cosine.item(),
             },
             add_dataloader_idx=False,
+            # Reduced across DDP ranks once per epoch (weighted by batch_size), the
+            # eval shards differ in length. Every rank has to log every key.
+            sync_dist=True,
+            on_step=False,
+            on_epoch=True,
             batch_size=len(batch),
         )
         return (
@@ -279,21 +326,21 @@ class FlowTrajectoryDiffusionModule_HisDiT(L.LightningModule):
 
     def training_step(self, batch: tgd.Batch, batch_id):  # type: ignore
         self.train()
-        bs = batch.delta.shape[0] // self.sample_size
+        # Training and validation sample dense clouds of sample_size points.
+        bs = batch.num_graphs
+        uniform_point_count(batch, self.sample_size)
 
         batch.delta = normalize_trajectory(batch.delta)
-        batch.timesteps = torch.randint(
-            0,
-            self.num_train_timesteps,
-            (bs,),
-            device=self.device,
-        ).long()
+        batch.timesteps, batch.timestep_weights = self.schedule_sampler.sample(
+            bs, self.device
+        )
 
         _, loss = self(batch, "train")
         return loss
 
     def validation_step(self, batch: tgd.Batch, batch_id, dataloader_idx=0):  # type: ignore
         self.eval()
+        uniform_point_count(batch, self.sample_size)
 
         # Clean cache for a new eval dataloader
         if batch_id == 0:
@@ -413,19 +460,69 @@ class FlowTrajectoryDiffuserInferenceModule_HisDiT(L.LightningModule):
         self.traj_len = inference_cfg.trajectory_len
 
         # Diffuser params
+        # Default point count (compile warm-up, export), predict_step follows the input.
         self.sample_size = 1200
 
         self.history_encoder = history_encoder
         self.history_len = self.history_encoder.history_len
         self.backbone = network
-        self.num_inference_timesteps = model_cfg.num_train_timesteps
+        self.num_inference_timesteps = inference_cfg.get(
+            "num_inference_timesteps", model_cfg.num_inference_timesteps
+        )
+        self.sampler = inference_cfg.get("sampler", "ddpm")
+        # "32" or "bf16" (the backbone runs under bf16 autocast).
+        self.inference_precision = str(inference_cfg.get("precision", "32"))
+        # Dynamic int8 quantization of the trunk at load time (CPU only).
+        self.quantize = inference_cfg.get("quantize", False)
+        # Precompute the timestep conditioning of the sampling steps at load time.
+        self.timestep_table = inference_cfg.get("timestep_table", False)
+        # Compile the denoiser trunk when the checkpoint is loaded.
+        self.use_compile = inference_cfg.get("compile", False)
+        self.compile_cache_dir = (
+            inference_cfg.get("compile_cache_dir", None) if self.use_compile else None
+        )
         self.diffusion = create_diffusion(
-            timestep_respacing=None, diffusion_steps=self.num_inference_timesteps
+            timestep_respacing=[self.num_inference_timesteps],
+            diffusion_steps=model_cfg.num_train_timesteps,
         )
 
     def load_from_ckpt(self, ckpt_file):
-        ckpt = torch.load(ckpt_file)
+        ckpt = torch.load(ckpt_file, map_location=self.device)
         self.load_state_dict(ckpt["state_dict"])
+        if self.quantize:
+            self.quantize_backbone()
+        if self.timestep_table:
+            build_conditioning_table(self.backbone, self.diffusion.timestep_map)
+        if self.use_compile:
+            self.compile_backbone()
+
+    def quantize_backbone(self):
+        """Quantize the backbone's trunk to dynamic int8, see quantize_trunk()."""
+        if self.device.type != "cpu" or self.inference_precision != "32":
+            raise ValueError("Dynamic int8 quantization needs fp32 inference on CPU.")
+        quantize_trunk(self.backbone)
+
+    def compile_backbone(self):
+        """
+        Compile the backbone's transformer trunk (see compile_trunk()) and warm it
+        up at the shapes of single-object and batched (WTA) predictions, so that
+        the first predictions don't pay the compile cost. Move the module to its
+        device first.
+        """
+        compile_trunk(self.backbone, cache_dir=self.compile_cache_dir)
+        hidden_size = self.backbone.final_layer.linear.in_features
+        dtype = torch.bfloat16 if self.inference_precision == "bf16" else torch.float32
+        # Batch size 1 (one object) is specialized, 2 covers every larger batch
+        # (e.g. the trial_times clouds of predict_wta) with the dynamic trunk.
+        for bs in [1, 2]:
+            x = torch.zeros(
+                bs, self.sample_size, hidden_size, device=self.device, dtype=dtype
+            )
+            t = torch.zeros(bs, dtype=torch.long, device=self.device)
+            with torch.no_grad(), backbone_autocast(
+                self.device, self.inference_precision
+            ):
+                self.backbone.trunk(x, t)
 
     def forward(self, data) -> torch.Tensor:  # type: ignore
         print(
@@ -442,11 +539,11 @@ class FlowTrajectoryDiffuserInferenceModule_HisDiT(L.LightningModule):
             history_flow = np.zeros_like(P_world)
             K = 0
         data = tgd.Data(
-            pos=torch.from_numpy(P_world).float().cuda(),
-            history=torch.from_numpy(history_pcd).float().cuda(),
-            flow_history=torch.from_numpy(history_flow).float().cuda(),
+            pos=torch.from_numpy(P_world).float().to(self.device),
+            history=torch.from_numpy(history_pcd).float().to(self.device),
+            flow_history=torch.from_numpy(history_flow).float().to(self.device),
             K=K,
-            lengths=self.sample_size
+            lengths=history_pcd.shape[0],
             # mask=torch.ones(P_world.shape[0]).float(),
         )
         batch = tgd.Batch.from_data_list([data])
@@ -460,46 +557,52 @@ class FlowTrajectoryDiffuserInferenceModule_HisDiT(L.LightningModule):
         return trajectory.cpu()
 
     @torch.no_grad()
-    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = 0) -> torch.Tensor:  # type: ignore
+    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = 0, *, sampler: Optional[str] = None) -> torch.Tensor:  # type: ignore
         # torch.eval()
         self.eval()
-        bs = batch.pos.shape[0] // self.sample_size
-        z = torch.randn(
-            bs, 3 * self.traj_len, self.sample_size, device=self.device
-        )  # .float()
+        if not has_uniform_point_count(batch):
+            # Clouds of different sizes are sampled in same-size groups.
+            return predict_by_point_count(self.predict_step, batch, sampler=sampler)
+        bs = batch.num_graphs
+        n_points = batch.pos.shape[0] // bs
+        z = torch.randn(bs, 3 * self.traj_len, n_points, device=self.device)  # .float()
 
         history_embed = self.history_encoder(batch).permute(
             0, 2, 1
         )  # History embedding
         pos = torch.concat(
             [
-                batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len)
+                batch.pos.reshape(bs, n_points, 3 * self.traj_len)
                 .permute(0, 2, 1)
                 .float()
-                .cuda(),
+                .to(self.device),
                 history_embed,  # Concat history embedding
             ],
             dim=1,
         )
         model_kwargs = dict(pos=pos)
 
-        samples, results = self.diffusion.p_sample_loop(
-            self.backbone,
-            z.shape,
-            z,
-            clip_denoised=False,
-            model_kwargs=model_kwargs,
-            progress=True,
-            device=self.device,
-        )
+        with backbone_autocast(self.device, self.inference_precision):
+            samples, results = self.diffusion.sample_loop(
+                self.backbone,
+                z.shape,
+                z,
+                sampler=self.sampler if sampler is None else sampler,
+                clip_denoised=False,
+                model_kwargs=model_kwargs,
+                progress=True,
+                device=self.device,
+            )
 
         f_pred = samples.permute(0, 2, 1).reshape(-1, 3 * self.traj_len).unsqueeze(1)
-        f_pred = normalize_trajectory(f_pred)
+        f_pred = normalize_trajectory(f_pred, n_points=n_points)
         return f_pred
 
     # For winner takes it all evaluation
     @torch.inference_mode()
-    def predict_wta(self, dataloader, mode="delta", trial_times=50):
+    def predict_wta(
+        self, dataloader, mode="delta", trial_times=50, sampler: Optional[str] = None
+    ):
         all_rmse = 0
         all_cos_dist = 0
         all_mag_error = 0
@@ -510,8 +613,9 @@ class FlowTrajectoryDiffuserInferenceModule_HisDiT(L.LightningModule):
         valid_sample_cnt = 0
 
         for id, orig_sample in tqdm.tqdm(enumerate(dataloader)):
-            bs = orig_sample.delta.shape[0] // self.sample_size
+            bs = orig_sample.num_graphs
             assert bs == 1, f"batch size should be 1, now is {bs}"
+            n_points = orig_sample.num_nodes
 
             # batch every sample into bsz of trial_times
             bs = trial_times
@@ -519,7 +623,7 @@ class FlowTrajectoryDiffuserInferenceModule_HisDiT(L.LightningModule):
             batch = tgd.Batch.from_data_list(data_list)
 
             z = torch.randn(
-                bs, 3 * self.traj_len, self.sample_size, device=self.device
+                bs, 3 * self.traj_len, n_points, device=self.device
             )  # .float()
 
             history_embed = self.history_encoder(batch).permute(
@@ -527,34 +631,36 @@ class FlowTrajectoryDiffuserInferenceModule_HisDiT(L.LightningModule):
             )  # History embedding
             pos = torch.concat(
                 [
-                    batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len)
+                    batch.pos.reshape(bs, n_points, 3 * self.traj_len)
                     .permute(0, 2, 1)
                     .float()
-                    .cuda(),
+                    .to(self.device),
                     history_embed,  # Concat history embedding
                 ],
                 dim=1,
             )
             model_kwargs = dict(pos=pos)
 
-            samples, results = self.diffusion.p_sample_loop(
-                self.backbone,
-                z.shape,
-                z,
-                clip_denoised=False,
-                model_kwargs=model_kwargs,
-                progress=True,
-                device=self.device,
-            )
+            with backbone_autocast(self.device, self.inference_precision):
+                samples, results = self.diffusion.sample_loop(
+                    self.backbone,
+                    z.shape,
+                    z,
+                    sampler=self.sampler if sampler is None else sampler,
+                    clip_denoised=False,
+                    model_kwargs=model_kwargs,
+                    progress=True,
+                    device=self.device,
+                )
 
             f_pred = (
                 samples.permute(0, 2, 1).reshape(-1, 3 * self.traj_len).unsqueeze(1)
             )
-            f_pred = normalize_trajectory(f_pred)
+            f_pred = normalize_trajectory(f_pred, n_points=n_points)
 
             # Compute the loss.
             mask = batch.mask == 1
-            mask = mask.reshape(-1, self.sample_size).to("cuda")
+            mask = mask.reshape(-1, n_points).to(self.device)
 
             n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
             f_ix = batch.mask.bool().to(self.device)
@@ -568,7 +674,7 @@ class FlowTrajectoryDiffuserInferenceModule_HisDiT(L.LightningModule):
                 f_target = batch.point.to(self.device)
 
             f_target = f_target  # .float()
-            f_target = normalize_trajectory(f_target)
+            f_target = normalize_trajectory(f_target, n_points=n_points)
 
             # print(f_pred[f_ix], batch.delta[f_ix])
             flow_loss = artflownet_loss(f_pred, f_target, n_nodes, reduce=False)
@@ -645,11 +751,11 @@ class FlowTrajectoryDiffuserSimulationModule_HisDiT(L.LightningModule):
             history_flow = np.zeros_like(P_world)
             K = 0
         data = tgd.Data(
-            pos=torch.from_numpy(P_world).float().cuda(),
-            history=torch.from_numpy(history_pcd).float().cuda(),
-            flow_history=torch.from_numpy(history_flow).float().cuda(),
+            pos=torch.from_numpy(P_world).float().to(self.device),
+            history=torch.from_numpy(history_pcd).float().to(self.device),
+            flow_history=torch.from_numpy(history_flow).float().to(self.device),
             K=K,
-            lengths=self.sample_size
+            lengths=history_pcd.shape[0],
             # mask=torch.ones(P_world.shape[0]).float(),
         )
         # breakpoint()
@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import lightning as L
 import plotly.express as px
@@ -16,8 +16,27 @@ from flowbothd.metrics.trajectory import (
     artflownet_loss,
     flow_metrics,
     normalize_trajectory,
+    valid_mean,
+    wta_metrics,
+)
+from flowbothd.models.dit_utils import (
+    backbone_autocast,
+    create_diffusion,
+    has_uniform_point_count,
+    predict_by_point_count,
+    split_by_point_count,
+    uniform_point_count,
+)
+from flowbothd.models.dit_utils.timestep_sampler import (
+    LossAwareSampler,
+    create_named_schedule_sampler,
+)
+from flowbothd.models.modules.dit_models import (
+    build_conditioning_table,
+    compile_trunk,
+    enable_activation_checkpointing,
+    quantize_trunk,
 )
-from flowbothd.models.dit_utils import create_diffusion
 
 
 # Flow predictor with PN++ + DiT
@@ -46,6 +65,14 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
         self.diffusion = create_diffusion(
             timestep_respacing=None, diffusion_steps=self.num_train_timesteps
         )
+        # "uniform" or "loss-second-moment" (importance sampling of timesteps).
+        self.schedule_sampler = create_named_schedule_sampler(
+            training_cfg.get("schedule_sampler", "uniform"), self.diffusion
+        )
+        if training_cfg.get("activation_checkpointing", False):
+            enable_activation_checkpointing(self.backbone)
+        # (noise, t) draws per training sample, sharing its conditioning.
+        self.noise_draws = training_cfg.get("noise_draws", 1)
 
         self.cosine_distribution_cache = {"x": [], "y": [], "colors": []}
 
@@ -55,15 +82,31 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
             .reshape(-1, 30, 40, 3 * self.traj_len)
             .permute(0, 3, 1, 2)
             .float()
-            .cuda()
+            .to(self.device)
+        )
+        pos = (
+            batch.pos.reshape(-1, self.sample_size, 3 * self.traj_len)
+            .float()
+            .to(self.device)
         )
-        pos = batch.pos.reshape(-1, self.sample_size, 3 * self.traj_len).float().cuda()
 
-        model_kwargs = dict(pos=pos, context=batch.cuda())
+        model_kwargs = dict(pos=pos, context=batch.to(self.device))
+        if self.noise_draws > 1:
+            # Several (noise, t) per sample: the PointNet++ geometry is computed
+            # once and tiled, like sample_wta(). Only the targets are expanded.
+            geometry = self.backbone.build_geometry(batch).repeat(self.noise_draws)
+            context = tgd.Data(pos=geometry.pos, batch=geometry.batch)
+            x = x.repeat(self.noise_draws, 1, 1, 1)
+            pos = pos.repeat(self.noise_draws, 1, 1)
+            model_kwargs = dict(pos=pos, context=context, geometry=geometry)
         loss_dict = self.diffusion.training_losses(
             self.backbone, x, batch.timesteps, model_kwargs
         )
-        loss = loss_dict["loss"].mean()
+        if isinstance(self.schedule_sampler, LossAwareSampler):
+            self.schedule_sampler.update_with_local_losses(
+                batch.timesteps, loss_dict["loss"].detach()
+            )
+        loss = (loss_dict["loss"] * batch.timestep_weights).mean()
 
         self.log_dict(
             {
@@ -84,8 +127,17 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
         bs = batch.delta.shape[0] // self.sample_size
         z = torch.randn(bs, 3 * self.traj_len, 30, 40, device=self.device)  # .float()
 
-        pos = batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len).float().cuda()
-        model_kwargs = dict(pos=pos, context=batch)
+        pos = (
+            batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len)
+            .float()
+            .to(self.device)
+        )
+        model_kwargs = dict(
+            pos=pos,
+            context=batch,
+            # The PointNet++ geometry is the same at every denoising step.
+            geometry=self.backbone.build_geometry(batch),
+        )
 
         samples, results = self.diffusion.p_sample_loop(
             self.backbone,
@@ -107,7 +159,7 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
 
         # Compute the loss.
         # mask = batch.mask == 1
-        # mask = mask.reshape(-1, self.sample_size).to("cuda")
+        # mask = mask.reshape(-1, self.sample_size).to(self.device)
 
         n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
         f_ix = batch.mask.bool()
@@ -122,11 +174,12 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
         # print(f_pred[f_ix], batch.delta[f_ix])
         loss = artflownet_loss(f_pred, f_target, n_nodes)
 
-        if torch.sum(f_ix) == 0:  # No point
-            return f_pred, loss
-
-        # Compute some metrics on flow-only regions.
-        rmse, cos_dist, mag_error = flow_metrics(f_pred[f_ix], f_target[f_ix])
+        has_flow = bool(f_ix.any())
+        if has_flow:
+            # Compute some metrics on flow-only regions.
+            rmse, cos_dist, mag_error = flow_metrics(f_pred[f_ix], f_target[f_ix])
+        else:  # No point, logged with zero weight
+            rmse = cos_dist = mag_error = torch.zeros_like(loss)
 
         self.log_dict(
             {
@@ -136,23 +189,47 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
                 f"{mode}/mag_error": mag_error,
             },
             add_dataloader_idx=False,
-            batch_size=len(batch),
+            # Reduced across DDP ranks once per epoch (weighted by batch_size), the
+            # eval shards differ in length. Every rank has to log every key.
+            sync_dist=True,
+            on_step=False,
+            on_epoch=True,
+            batch_size=len(batch) if has_flow else 0,
         )
         return f_pred, loss
 
-    def predict_wta(self, orig_batch: tgd.Batch, mode):
-        bs = orig_batch.delta.shape[0] // self.sample_size
-        assert bs == 1, "Only support bsz = 1 for winner take all evaluation"
-        bs = self.wta_trial_times
-        data_list = orig_batch.to_data_list() * bs
-        batch = tgd.Batch.from_data_list(data_list)
-
-        z = torch.randn(bs, 3 * self.traj_len, 30, 40, device=self.device)  # .float()
-
-        pos = batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len).float().cuda()
-        model_kwargs = dict(pos=pos, context=batch)
+    @torch.no_grad()
+    def sample_wta(self, orig_batch: tgd.Batch, trial_times):
+        """
+        Sample trial_times flows for each point cloud in orig_batch.
+
+        The conditioning (PointNet++ geometry) is computed once and shared by all
+        trials, only the noise is drawn per trial.
+        Trials are stacked trial-major, like
+        Batch.from_data_list(orig_batch.to_data_list() * trial_times).
+
+        Returns the normalized predictions, (trial_times * bs * sample_size, 1, 3 * traj_len).
+        """
+        orig_batch = orig_batch.to(self.device)
+        bs = orig_batch.pos.shape[0] // self.sample_size
+        z = torch.randn(
+            trial_times * bs, 3 * self.traj_len, 30, 40, device=self.device
+        )  # .float()
+
+        geometry = self.backbone.build_geometry(orig_batch).repeat(trial_times)
+        context = tgd.Data(
+            pos=geometry.pos,
+            batch=geometry.batch,
+        )
+        pos = (
+            orig_batch.pos.reshape(-1, self.sample_size, 3 * self.traj_len)
+            .permute(0, 2, 1)
+            .float()
+            .repeat(trial_times, 1, 1)
+        )
+        model_kwargs = dict(pos=pos, context=context, geometry=geometry)
 
-        samples, results = self.diffusion.p_sample_loop(
+        samples, _ = self.diffusion.p_sample_loop(
             self.backbone,
             z.shape,
             z,
@@ -168,67 +245,58 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
             .reshape(-1, 3 * self.traj_len)
             .unsqueeze(1)
         )
-        f_pred = normalize_trajectory(f_pred)
+        return normalize_trajectory(f_pred)
 
-        # Compute the loss.
-        mask = batch.mask == 1
-        mask = mask.reshape(-1, self.sample_size).to("cuda")
+    def predict_wta(self, orig_batch: tgd.Batch, mode):
+        bs = orig_batch.delta.shape[0] // self.sample_size
+        trial_times = self.wta_trial_times
+        f_pred = self.sample_wta(orig_batch, trial_times)
 
-        n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
-        f_ix = batch.mask.bool()
         if self.mode == "delta":
-            f_target = batch.delta
+            f_target = orig_batch.delta
         elif self.mode == "point":
-            f_target = batch.point
-
-        f_target = f_target  # .float()
+            f_target = orig_batch.point
         f_target = normalize_trajectory(f_target)
 
-        # print(f_pred[f_ix], batch.delta[f_ix])
-        loss = artflownet_loss(f_pred, f_target, n_nodes, reduce=False)
-        flow_loss = loss.reshape(bs, -1).mean(-1)
-        chosen_id = torch.min(flow_loss, 0)[1]  # index
-
-        if torch.sum(f_ix) == 0:  # No point
-            return (
-                f_pred.reshape(bs, self.sample_size, self.traj_len, 3)[chosen_id],
-                loss[chosen_id],
-                [],
-            )
-
-        # Compute some metrics on flow-only regions.
-        rmse, cos_dist, mag_error = flow_metrics(
-            f_pred[f_ix], f_target[f_ix], reduce=False
-        )
-
-        # Aggregate the results
-        # Choose the one with smallest flow loss
-        rmse = rmse.reshape(bs, -1).mean(-1)
-        cos_dist = cos_dist.reshape(bs, -1).mean(-1)
-        mag_error = mag_error.reshape(bs, -1).mean(-1)
-
-        pos_cosine = torch.sum((cos_dist - 0.7) > 0) / bs
-        neg_cosine = torch.sum((cos_dist + 0.7) < 0) / bs
-        multimodal = 1 if (pos_cosine != 0 and neg_cosine != 0) else 0
-
+        metrics = wta_metrics(f_pred, f_target, orig_batch.mask, trial_times, bs)
+        chosen_id, valid = metrics["chosen_id"], metrics["valid"]
+        objects = torch.arange(bs, device=chosen_id.device)
+        chosen = {
+            name: metrics[name][chosen_id, objects]
+            for name in ["flow_loss", "rmse", "cos_dist", "mag_error"]
+        }
+        f_pred = f_pred.reshape(trial_times, bs, self.sample_size, self.traj_len, 3)[
+            chosen_id, objects
+        ].flatten(0, 1)
+        # Trial cosines of each object, empty if the object has no point
+        cosines = [
+            metrics["cos_dist"][:, i].tolist() if valid[i] else [] for i in range(bs)
+        ]
+
+        # Without valid objects (no point), the zeros are logged with zero weight.
         self.log_dict(
             {
-                f"{mode}_wta/flow_loss": flow_loss[chosen_id].item(),
-                f"{mode}_wta/rmse": rmse[chosen_id].item(),
-                f"{mode}_wta/cosine_similarity": cos_dist[chosen_id].item(),
-                f"{mode}_wta/mag_error": mag_error[chosen_id].item(),
-                f"{mode}_wta/multimodal": multimodal,
-                f"{mode}_wta/pos@0.7": pos_cosine.item(),
-                f"{mode}_wta/neg@0.7": neg_cosine.item(),
+                f"{mode}_wta/flow_loss": valid_mean(chosen["flow_loss"], valid).item(),
+                f"{mode}_wta/rmse": valid_mean(chosen["rmse"], valid).item(),
+                f"{mode}_wta/cosine_similarity": valid_mean(
+                    chosen["cos_dist"], valid
+                ).item(),
+                f"{mode}_wta/mag_error": valid_mean(chosen["mag_error"], valid).item(),
+                f"{mode}_wta/multimodal": valid_mean(
+                    metrics["multimodal"], valid
+                ).item(),
+                f"{mode}_wta/pos@0.7": valid_mean(metrics["pos@0.7"], valid).item(),
+                f"{mode}_wta/neg@0.7": valid_mean(metrics["neg@0.7"], valid).item(),
             },
             add_dataloader_idx=False,
-            batch_size=len(batch),
-        )
-        return (
-            f_pred.reshape(bs, self.sample_size, self.traj_len, 3)[chosen_id],
-            loss[chosen_id],
-            cos_dist.tolist(),
+            # Reduced across DDP ranks once per epoch (weighted by batch_size), the
+            # eval shards differ in length. Every rank has to log every key.
+            sync_dist=True,
+            on_step=False,
+            on_epoch=True,
+            batch_size=valid.sum().item(),
         )
+        return f_pred, chosen["flow_loss"].mean(), cosines
 
     def configure_optimizers(self):
         optimizer = optim.AdamW(self.parameters(), lr=self.lr, weight_decay=1e-5)
@@ -244,21 +312,21 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
 
     def training_step(self, batch: tgd.Batch, batch_id):  # type: ignore
         self.train()
-        bs = batch.delta.shape[0] // self.sample_size
+        # Training and validation sample dense clouds of sample_size points.
+        bs = batch.num_graphs
+        uniform_point_count(batch, self.sample_size)
 
         # batch.delta = normalize_trajectory(batch.delta)
-        batch.timesteps = torch.randint(
-            0,
-            self.num_train_timesteps,
-            (bs,),
-            device=self.device,
-        ).long()
+        batch.timesteps, batch.timestep_weights = self.schedule_sampler.sample(
+            bs * self.noise_draws, self.device
+        )
 
         _, loss = self(batch, "train")
         return loss
 
     def validation_step(self, batch: tgd.Batch, batch_id, dataloader_idx=0):  # type: ignore
         self.eval()
+        uniform_point_count(batch, self.sample_size)
 
         # Clean cache for a new eval dataloader
         if batch_id == 0:
@@ -273,11 +341,15 @@ class FlowTrajectoryDiffusionModule_PNDiT(L.LightningModule):
             # print("predict:", f_pred.shape)
             if self.wta:
                 f_pred, loss, cosines = self.predict_wta(batch, name)
-                self.cosine_distribution_cache["x"] += [batch_id] * len(cosines)
-                self.cosine_distribution_cache["y"] += cosines
-                self.cosine_distribution_cache["colors"] += [
-                    "blue" if batch_id % 2 == 0 else "red"
-                ] * len(cosines)
+                for i, obj_cosines in enumerate(cosines):
+                    # Objects of the same batch are spread within its column
+                    self.cosine_distribution_cache["x"] += [
+                        batch_id + i / len(cosines)
+                    ] * len(obj_cosines)
+                    self.cosine_distribution_cache["y"] += obj_cosines
+                    self.cosine_distribution_cache["colors"] += [
+                        "blue" if batch_id % 2 == 0 else "red"
+                    ] * len(obj_cosines)
         # breakpoint()
         return {
             "preds": f_pred,
@@ -377,16 +449,66 @@ class FlowTrajectoryDiffuserInferenceModule_PNDiT(L.LightningModule):
         self.traj_len = inference_cfg.trajectory_len
 
         # Diffuser params
+        # Default point count (compile warm-up, export), predict_step follows the input.
         self.sample_size = 1200
         self.backbone = network
-        self.num_inference_timesteps = model_cfg.num_train_timesteps
+        self.num_inference_timesteps = inference_cfg.get(
+            "num_inference_timesteps", model_cfg.num_inference_timesteps
+        )
+        self.sampler = inference_cfg.get("sampler", "ddpm")
+        # "32" or "bf16" (the backbone runs under bf16 autocast).
+        self.inference_precision = str(inference_cfg.get("precision", "32"))
+        # Dynamic int8 quantization of the trunk at load time (CPU only).
+        self.quantize = inference_cfg.get("quantize", False)
+        # Precompute the timestep conditioning of the sampling steps at load time.
+        self.timestep_table = inference_cfg.get("timestep_table", False)
+        # Compile the denoiser trunk when the checkpoint is loaded.
+        self.use_compile = inference_cfg.get("compile", False)
+        self.compile_cache_dir = (
+            inference_cfg.get("compile_cache_dir", None) if self.use_compile else None
+        )
         self.diffusion = create_diffusion(
-            timestep_respacing=None, diffusion_steps=self.num_inference_timesteps
+            timestep_respacing=[self.num_inference_timesteps],
+            diffusion_steps=model_cfg.num_train_timesteps,
         )
 
     def load_from_ckpt(self, ckpt_file):
-        ckpt = torch.load(ckpt_file)
+        ckpt = torch.load(ckpt_file, map_location=self.device)
         self.load_state_dict(ckpt["state_dict"])
+        if self.quantize:
+            self.quantize_backbone()
+        if self.timestep_table:
+            build_conditioning_table(self.backbone, self.diffusion.timestep_map)
+        if self.use_compile:
+            self.compile_backbone()
+
+    def quantize_backbone(self):
+        """Quantize the backbone's trunk to dynamic int8, see quantize_trunk()."""
+        if self.device.type != "cpu" or self.inference_precision != "32":
+            raise ValueError("Dynamic int8 quantization needs fp32 inference on CPU.")
+        quantize_trunk(self.backbone)
+
+    def compile_backbone(self):
+        """
+        Compile the backbone's transformer trunk (see compile_trunk()) and warm it
+        up at the shapes of single-object and batched (WTA) predictions, so that
+        the first predictions don't pay the compile cost. Move the module to its
+        device first.
+        """
+        compile_trunk(self.backbone, cache_dir=self.compile_cache_dir)
+        hidden_size = self.backbone.final_layer.linear.in_features
+        dtype = torch.bfloat16 if self.inference_precision == "bf16" else torch.float32
+        # Batch size 1 (one object) is specialized, 2 covers every larger batch
+        # (e.g. the trial_times clouds of predict_wta) with the dynamic trunk.
+        for bs in [1, 2]:
+            x = torch.zeros(
+                bs, self.sample_size, hidden_size, device=self.device, dtype=dtype
+            )
+            t = torch.zeros(bs, dtype=torch.long, device=self.device)
+            with torch.no_grad(), backbone_autocast(
+                self.device, self.inference_precision
+            ):
+                self.backbone.trunk(x, t)
 
     def forward(self, data) -> torch.Tensor:  # type: ignore
         print(
@@ -396,7 +518,7 @@ class FlowTrajectoryDiffuserInferenceModule_PNDiT(L.LightningModule):
 
     def predict(self, P_world) -> torch.Tensor:  # From pure point cloud
         data = tgd.Data(
-            pos=torch.from_numpy(P_world).float().cuda(),
+            pos=torch.from_numpy(P_world).float().to(self.device),
             # mask=torch.ones(P_world.shape[0]).float(),
         )
         batch = tgd.Batch.from_data_list([data])
@@ -410,24 +532,96 @@ class FlowTrajectoryDiffuserInferenceModule_PNDiT(L.LightningModule):
         return trajectory.cpu()
 
     @torch.no_grad()
-    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = 0) -> torch.Tensor:  # type: ignore
+    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = 0, *, sampler: Optional[str] = None) -> torch.Tensor:  # type: ignore
         # torch.eval()
         self.eval()
-        bs = batch.pos.shape[0] // self.sample_size
-        z = torch.randn(bs, 3 * self.traj_len, 30, 40, device=self.device)  # .float()
+        if not has_uniform_point_count(batch):
+            # Clouds of different sizes are sampled in same-size groups.
+            return predict_by_point_count(self.predict_step, batch, sampler=sampler)
+        bs = batch.num_graphs
+        n_points = batch.pos.shape[0] // bs
+        z = torch.randn(
+            bs, 3 * self.traj_len, n_points, 1, device=self.device
+        )  # .float()
+
+        pos = batch.pos.reshape(bs, n_points, 3 * self.traj_len).float().to(self.device)
+        context = batch.to(self.device)
+        model_kwargs = dict(
+            pos=pos,
+            context=context,
+            # The PointNet++ geometry is the same at every denoising step.
+            geometry=self.backbone.build_geometry(context),
+        )
 
-        pos = batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len).float().cuda()
-        model_kwargs = dict(pos=pos, context=batch.cuda())
+        with backbone_autocast(self.device, self.inference_precision):
+            samples, results = self.diffusion.sample_loop(
+                self.backbone,
+                z.shape,
+                z,
+                sampler=self.sampler if sampler is None else sampler,
+                clip_denoised=False,
+                model_kwargs=model_kwargs,
+                progress=True,
+                device=self.device,
+            )
 
-        samples, results = self.diffusion.p_sample_loop(
-            self.backbone,
-            z.shape,
-            z,
-            clip_denoised=False,
-            model_kwargs=model_kwargs,
-            progress=True,
-            device=self.device,
+        f_pred = (
+            torch.flatten(samples, start_dim=2, end_dim=3)
+            .permute(0, 2, 1)
+            .reshape(-1, 3 * self.traj_len)
+            .unsqueeze(1)
         )
+        f_pred = normalize_trajectory(f_pred, n_points=n_points)
+        return f_pred
+
+    @torch.no_grad()
+    def sample_wta(
+        self, orig_batch: tgd.Batch, trial_times, sampler: Optional[str] = None
+    ):
+        """
+        Sample trial_times flows for each point cloud in orig_batch.
+
+        The conditioning (PointNet++ geometry) is computed once and shared by all
+        trials, only the noise is drawn per trial.
+        Trials are stacked trial-major, like
+        Batch.from_data_list(orig_batch.to_data_list() * trial_times).
+
+        The point clouds must have the same number of points n_points, see
+        split_by_point_count().
+
+        Returns the normalized predictions, (trial_times * bs * n_points, 1, 3 * traj_len).
+        """
+        orig_batch = orig_batch.to(self.device)
+        bs = orig_batch.num_graphs
+        n_points = uniform_point_count(orig_batch)
+        z = torch.randn(
+            trial_times * bs, 3 * self.traj_len, n_points, 1, device=self.device
+        )  # .float()
+
+        geometry = self.backbone.build_geometry(orig_batch).repeat(trial_times)
+        context = tgd.Data(
+            pos=geometry.pos,
+            batch=geometry.batch,
+        )
+        pos = (
+            orig_batch.pos.reshape(-1, n_points, 3 * self.traj_len)
+            .permute(0, 2, 1)
+            .float()
+            .repeat(trial_times, 1, 1)
+        )
+        model_kwargs = dict(pos=pos, context=context, geometry=geometry)
+
+        with backbone_autocast(self.device, self.inference_precision):
+            samples, _ = self.diffusion.sample_loop(
+                self.backbone,
+                z.shape,
+                z,
+                sampler=self.sampler if sampler is None else sampler,
+                clip_denoised=False,
+                model_kwargs=model_kwargs,
+                progress=True,
+                device=self.device,
+            )
 
         f_pred = (
             torch.flatten(samples, start_dim=2, end_dim=3)
@@ -435,12 +629,13 @@ class FlowTrajectoryDiffuserInferenceModule_PNDiT(L.LightningModule):
             .reshape(-1, 3 * self.traj_len)
             .unsqueeze(1)
         )
-        f_pred = normalize_trajectory(f_pred)
-        return f_pred
+        return normalize_trajectory(f_pred, n_points=n_points)
 
     # For winner takes it all evaluation
     @torch.inference_mode()
-    def predict_wta(self, dataloader, mode="delta", trial_times=50):
+    def predict_wta(
+        self, dataloader, mode="delta", trial_times=50, sampler: Optional[str] = None
+    ):
         all_rmse = 0
         all_cos_dist = 0
         all_mag_error = 0
@@ -450,98 +645,54 @@ class FlowTrajectoryDiffuserInferenceModule_PNDiT(L.LightningModule):
         all_neg_cosine = 0
         valid_sample_cnt = 0
 
-        for id, orig_sample in tqdm.tqdm(enumerate(dataloader)):
-            bs = orig_sample.delta.shape[0] // self.sample_size
-            assert bs == 1, f"batch size should be 1, now is {bs}"
-
-            # batch every sample into bsz of trial_times
-            bs = trial_times
-            data_list = orig_sample.to_data_list() * bs
-            batch = tgd.Batch.from_data_list(data_list)
-
-            z = torch.randn(
-                bs, 3 * self.traj_len, 30, 40, device=self.device
-            )  # .float()
-
-            pos = (
-                batch.pos.reshape(bs, self.sample_size, 3 * self.traj_len)
-                .float()
-                .to(self.device)
-            )
-            model_kwargs = dict(pos=pos, context=batch)
-            # breakpoint()
-            samples, results = self.diffusion.p_sample_loop(
-                self.backbone,
-                z.shape,
-                z,
-                clip_denoised=False,
-                model_kwargs=model_kwargs,
-                progress=True,
-                device=self.device,
-            )
-
-            f_pred = (
-                torch.flatten(samples, start_dim=2, end_dim=3)
-                .permute(0, 2, 1)
-                .reshape(-1, 3 * self.traj_len)
-                .unsqueeze(1)
-            )
-            f_pred = normalize_trajectory(f_pred)
+        all_directions = []
 
-            # Compute the loss.
-            mask = batch.mask == 1
-            mask = mask.reshape(-1, self.sample_size).to("cuda")
+        # Objects are sampled together when they have the same number of points.
+        groups = (
+            group
+            for orig_sample in dataloader
+            for group in split_by_point_count(orig_sample)
+        )
+        for id, orig_sample in tqdm.tqdm(enumerate(groups)):
+            bs = orig_sample.num_graphs
 
-            n_nodes = torch.as_tensor([d.num_nodes for d in batch.to_data_list()]).to(self.device)  # type: ignore
-            f_ix = batch.mask.bool().to(self.device)
+            f_ix = orig_sample.mask.bool().to(self.device)
             if torch.sum(f_ix) == 0:
                 continue
 
-            valid_sample_cnt += 1
+            f_pred = self.sample_wta(orig_sample, trial_times, sampler=sampler)
+
+            # Compute the loss.
             if mode == "delta":
-                f_target = batch.delta.to(self.device)
+                f_target = orig_sample.delta.to(self.device)
             elif mode == "point":
-                f_target = batch.point.to(self.device)
+                f_target = orig_sample.point.to(self.device)
 
             f_target = f_target  # .float()
-            f_target = normalize_trajectory(f_target)
-
-            # print(f_pred[f_ix], batch.delta[f_ix])
-            # print(f_pred.device, f_target.device)
-            flow_loss = artflownet_loss(f_pred, f_target, n_nodes, reduce=False)
-
-            # Compute some metrics on flow-only regions.
-            rmse, cos_dist, mag_error = flow_metrics(
-                f_pred[f_ix], f_target[f_ix], reduce=False
-            )
-
-            # Aggregate the results
-            # Choose the one with smallest flow loss
-            flow_loss = flow_loss.reshape(bs, -1).mean(-1)
-            rmse = rmse.reshape(bs, -1).mean(-1)
-            cos_dist = cos_dist.reshape(bs, -1).mean(-1)
-            mag_error = mag_error.reshape(bs, -1).mean(-1)
-
-            chosen_id = torch.min(flow_loss, 0)[1]  # index
-            pos_cosine = torch.sum((cos_dist - 0.7) > 0) / bs
-            neg_cosine = torch.sum((cos_dist + 0.7) < 0) / bs
-            multimodal = 1 if (pos_cosine != 0 and neg_cosine != 0) else 0
-
-            print(
-                multimodal,
-                rmse[chosen_id],
-                cos_dist[chosen_id],
-                mag_error[chosen_id],
-                flow_loss[chosen_id],
-            )
-
-            all_multimodal += multimodal
-            all_pos_cosine += pos_cosine.item()
-            all_neg_cosine += neg_cosine.item()
-            all_rmse += rmse[chosen_id].item()
-            all_cos_dist += cos_dist[chosen_id].item()
-            all_mag_error += mag_error[chosen_id].item()
-            all_flow_loss += flow_loss[chosen_id].item()
+            f_target = normalize_trajectory(f_target, orig_sample.batch.to(self.device))
+
+            metrics = wta_metrics(f_pred, f_target, f_ix, trial_times, bs)
+            chosen_id, valid = metrics["chosen_id"], metrics["valid"]
+            objects = torch.arange(bs, device=chosen_id.device)
+            flow_loss = metrics["flow_loss"][chosen_id, objects][valid]
+            rmse = metrics["rmse"][chosen_id, objects][valid]
+            cos_dist = metrics["cos_dist"][chosen_id, objects][valid]
+            mag_error = metrics["mag_error"][chosen_id, objects][valid]
+            pos_cosine = metrics["pos@0.7"][valid]
+            neg_cosine = metrics["neg@0.7"][valid]
+            multimodal = metrics["multimodal"][valid]
+
+            print(multimodal, rmse, cos_dist, mag_error, flow_loss)
+
+            valid_sample_cnt += valid.sum().item()
+            all_multimodal += multimodal.sum().item()
+            all_pos_cosine += pos_cosine.sum().item()
+            all_neg_cosine += neg_cosine.sum().item()
+            all_rmse += rmse.sum().item()
+            all_cos_dist += cos_dist.sum().item()
+            all_mag_error += mag_error.sum().item()
+            all_flow_loss += flow_loss.sum().item()
+            all_directions += metrics["cos_dist"][:, valid].T.flatten().tolist()
 
         metric_dict = {
             f"flow_loss": all_flow_loss / valid_sample_cnt,  # / len(dataloader),
@@ -556,9 +707,9 @@ class FlowTrajectoryDiffuserInferenceModule_PNDiT(L.LightningModule):
         self.log_dict(
             metric_dict,
             add_dataloader_idx=False,
-            batch_size=len(batch),
+            batch_size=valid_sample_cnt,
         )
-        return metric_dict, cos_dist.tolist()  # dataloader * trial_times
+        return metric_dict, all_directions  # valid objects * trial_times
 
 
 class FlowTrajectoryDiffuserSimulationModule_PNDiT(L.LightningModule):
@@ -576,7 +727,7 @@ class FlowTrajectoryDiffuserSimulationModule_PNDiT(L.LightningModule):
         rgb, depth, seg, P_cam, P_world, pc_seg, segmap = data
 
         data = tgd.Data(
-            pos=torch.from_numpy(P_world).float().cuda(),
+            pos=torch.from_numpy(P_world).float().to(self.device),
             # mask=torch.ones(P_world.shape[0]).float(),
         )
         batch = tgd.Batch.from_data_list([data])
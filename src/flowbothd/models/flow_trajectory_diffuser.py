@@ -451,7 +451,7 @@ class FlowTrajectoryDiffuserInferenceModule_PN2(L.LightningModule):
         )
 
     def load_from_ckpt(self, ckpt_file):
-        ckpt = torch.load(ckpt_file)
+        ckpt = torch.load(ckpt_file, map_location=self.device)
         self.load_state_dict(ckpt["state_dict"])
 
     def forward(self, data) -> torch.Tensor:  # type: ignore
@@ -675,7 +675,7 @@ class FlowTrajectoryDiffuserSimulationModule_PN2(L.LightningModule):
         rgb, depth, seg, P_cam, P_world, pc_seg, segmap = data
 
         data = tgd.Data(
-            pos=torch.from_numpy(P_world).float().cuda(),
+            pos=torch.from_numpy(P_world).float().to(self.device),
             # mask=torch.ones(P_world.shape[0]).float(),
         )
         batch = tgd.Batch.from_data_list([data])
@@ -235,7 +235,7 @@ class FlowTrajectoryInferenceModule(L.LightningModule):
         return trajectory
 
     def load_from_ckpt(self, ckpt_file):
-        ckpt = torch.load(ckpt_file)
+        ckpt = torch.load(ckpt_file, map_location=self.device)
         self.load_state_dict(ckpt["state_dict"])
 
     def predict(self, P_world) -> torch.Tensor:  # type: ignore
@@ -300,7 +300,7 @@ class FlowSimulationInferenceModule(L.LightningModule):
             self.mask_input_channel = mask_input_channel
 
     def load_from_ckpt(self, ckpt_file):
-        ckpt = torch.load(ckpt_file)
+        ckpt = torch.load(ckpt_file, map_location=self.device)
         self.load_state_dict(ckpt["state_dict"])
 
     def forward(self, data) -> torch.Tensor:  # type: ignore
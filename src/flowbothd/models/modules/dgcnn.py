@@ -20,20 +20,45 @@ from diffusers.utils import BaseOutput
 # from .util import quat2mat
 
 
-def knn(x, k):
-    inner = -2 * torch.matmul(x.transpose(2, 1).contiguous(), x)
-    xx = torch.sum(x**2, dim=1, keepdim=True)
-    pairwise_distance = -xx - inner - xx.transpose(2, 1).contiguous()
-
-    idx = pairwise_distance.topk(k=k, dim=-1)[1]  # (batch_size, num_points, k)
-    return idx
+def knn(x, k, chunk_size=None):
+    """
+    k nearest neighbours of every point of x: (batch_size, num_dims, num_points).
+    With chunk_size, the distances are computed for chunk_size query points at a
+    time, so memory is (batch_size, chunk_size, num_points) instead of quadratic.
+    """
+    num_points = x.shape[2]
+    if chunk_size is None or chunk_size >= num_points:
+        inner = -2 * torch.matmul(x.transpose(2, 1).contiguous(), x)
+        xx = torch.sum(x**2, dim=1, keepdim=True)
+        pairwise_distance = -xx - inner - xx.transpose(2, 1).contiguous()
+
+        idx = pairwise_distance.topk(k=k, dim=-1)[1]  # (batch_size, num_points, k)
+        return idx
+
+    xx = torch.sum(x**2, dim=1, keepdim=True)  # (batch_size, 1, num_points)
+    idx = []
+    for start in range(0, num_points, chunk_size):
+        query = x[:, :, start : start + chunk_size]  # (batch_size, num_dims, c)
+        inner = -2 * torch.matmul(
+            query.transpose(2, 1), x
+        )  # (batch_size, c, num_points)
+        pairwise_distance = (
+            -xx - inner - xx[:, :, start : start + chunk_size].transpose(2, 1)
+        )
+        idx.append(pairwise_distance.topk(k=k, dim=-1)[1])
+    return torch.cat(idx, dim=1)  # (batch_size, num_points, k)
 
 
-def get_graph_feature(x, k=20):
+def get_graph_feature(x, k=20, idx=None, chunk_size=None):
+    """
+    EdgeConv features of x over its kNN graph, or over a precomputed graph idx
+    (batch_size, num_points, k), see DGCNN.build_graph().
+    """
     # x = x.squeeze()
-    idx = knn(x, k=k)  # (batch_size, num_points, k)
+    if idx is None:
+        idx = knn(x, k=k, chunk_size=chunk_size)  # (batch_size, num_points, k)
     batch_size, num_points, _ = idx.size()
-    device = torch.device("cuda")
+    device = x.device
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1) * num_points
 
@@ -137,18 +162,34 @@ class DGCNN(ModelMixin, ConfigMixin):
         self.bn4 = nn.Identity()  # nn.BatchNorm2d(256)
         self.bn5 = nn.Identity()  # nn.BatchNorm2d(emb_dims)
 
+        # Runtime options (not part of the config):
+        # kNN query chunk, bounds the distance matrix to (B, knn_chunk_size, N).
+        self.knn_chunk_size = None
+        # Use the position-space graph of the context for the feature EdgeConv
+        # too, instead of a kNN in feature space (which changes every step).
+        self.static_graph = False
+
+    def build_graph(self, context, k=20):
+        """
+        kNN graph of the context point cloud (B, 3, N), which is the same at every
+        denoising step. Pass it to forward() as `graph`.
+        """
+        return knn(context, k=k, chunk_size=self.knn_chunk_size)
+
     def forward(
         self,
         x,
         timestep,
         context,
         return_dict: bool = True,
+        graph=None,
     ):
         """
         Args:
             x:  Point clouds and flows at some timestep t, (B, 3+3, N).
             timestep:     Time. (B, ).
-            context: None.
+            context: The point cloud, (B, 3, N).
+            graph: Optional precomputed kNN graph of context, see build_graph().
         """
 
         # time embedding
@@ -174,7 +215,9 @@ class DGCNN(ModelMixin, ConfigMixin):
         # goal embedding
         batch_size, num_dims, num_points = x.size()
         goal_pcd = context
-        goal_x = get_graph_feature(goal_pcd)
+        if graph is None:
+            graph = self.build_graph(goal_pcd)
+        goal_x = get_graph_feature(goal_pcd, idx=graph)
         goal_x = F.relu(self.goal_conv1(goal_x))
         goal_x1 = goal_x.max(dim=-1, keepdim=True)[0]
 
@@ -191,7 +234,9 @@ class DGCNN(ModelMixin, ConfigMixin):
         emb = emb.view(batch_size, -1, 1).repeat(1, 1, num_points)
         x = torch.cat((x, goal_emb, emb), dim=1)  # (B, d+64+64, N)
 
-        x = get_graph_feature(x)  # (B, (d+64+64)*2, N, k)
+        x = get_graph_feature(
+            x, idx=graph if self.static_graph else None, chunk_size=self.knn_chunk_size
+        )  # (B, (d+64+64)*2, N, k)
         # emb = emb.view(batch_size, -1, 1, 1).repeat(1, 1, num_points, 20)
         # x = torch.cat((x, emb), dim=1) # B, d*2 + 64, N, k)
         # x = get_graph_feature(x) # (B, d*2+64, N, k)
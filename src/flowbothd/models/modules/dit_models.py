@@ -10,11 +10,14 @@
 # --------------------------------------------------------
 
 import math
+import os
+import warnings
 
 import numpy as np
 import rpad.pyg.nets.pointnet2 as pnp_original
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from timm.models.vision_transformer import Attention, Mlp
 
 import flowbothd.models.modules.pn2 as pnp
@@ -116,6 +119,16 @@ class RotaryPositionEncoding(nn.Module):
 
         self.feature_dim = feature_dim
         self.pe_type = pe_type
+        # Constant, so computed once and moved along with the module (not saved).
+        self.register_buffer(
+            "div_term", self.frequencies(feature_dim).view(1, 1, -1), persistent=False
+        )
+
+    @staticmethod
+    def frequencies(dim):
+        return torch.exp(
+            torch.arange(0, dim, 2, dtype=torch.float) * (-math.log(10000.0) / dim)
+        )
 
     @staticmethod
     def embed_rotary(x, cos, sin):
@@ -127,13 +140,7 @@ class RotaryPositionEncoding(nn.Module):
 
     def forward(self, x_position):
         bsize, npoint = x_position.shape
-        div_term = torch.exp(
-            torch.arange(
-                0, self.feature_dim, 2, dtype=torch.float, device=x_position.device
-            )
-            * (-math.log(10000.0) / (self.feature_dim))
-        )
-        div_term = div_term.view(1, 1, -1)  # [1, 1, d]
+        div_term = self.div_term  # [1, 1, d]
 
         sinx = torch.sin(x_position * div_term)  # [B, N, d]
         cosx = torch.cos(x_position * div_term)
@@ -153,6 +160,7 @@ class RotaryPositionEncoding(nn.Module):
 class RotaryPositionEncoding3D(RotaryPositionEncoding):
     def __init__(self, feature_dim, pe_type="Rotary3D"):
         super().__init__(feature_dim, pe_type)
+        self.div_term = self.frequencies(feature_dim // 3).view(1, 1, -1)
 
     @torch.no_grad()
     def forward(self, XYZ):
@@ -162,13 +170,7 @@ class RotaryPositionEncoding3D(RotaryPositionEncoding):
         """
         bsize, npoint, _ = XYZ.shape
         x_position, y_position, z_position = XYZ[..., 0:1], XYZ[..., 1:2], XYZ[..., 2:3]
-        div_term = torch.exp(
-            torch.arange(
-                0, self.feature_dim // 3, 2, dtype=torch.float, device=XYZ.device
-            )
-            * (-math.log(10000.0) / (self.feature_dim // 3))
-        )
-        div_term = div_term.view(1, 1, -1)  # [1, 1, d//6]
+        div_term = self.div_term  # [1, 1, d//6]
 
         sinx = torch.sin(x_position * div_term)  # [B, N, d//6]
         cosx = torch.cos(x_position * div_term)
@@ -225,7 +227,12 @@ class DiTBlock(nn.Module):
             nn.SiLU(), nn.Linear(hidden_size, 6 * hidden_size, bias=True)
         )
 
-    def forward(self, x, c):
+    def forward(self, x, c, mod=None):
+        """
+        mod: optional precomputed adaLN_modulation(c), see TimestepConditioningTable.
+        """
+        if mod is None:
+            mod = self.adaLN_modulation(c)
         (
             shift_msa,
             scale_msa,
@@ -233,7 +240,7 @@ class DiTBlock(nn.Module):
             shift_mlp,
             scale_mlp,
             gate_mlp,
-        ) = self.adaLN_modulation(c).chunk(6, dim=1)
+        ) = mod.chunk(6, dim=1)
         x = x + gate_msa.unsqueeze(1) * self.attn(
             modulate(self.norm1(x), shift_msa, scale_msa)
         )
@@ -258,8 +265,10 @@ class FinalLayer(nn.Module):
             nn.SiLU(), nn.Linear(hidden_size, 2 * hidden_size, bias=True)
         )
 
-    def forward(self, x, c):
-        shift, scale = self.adaLN_modulation(c).chunk(2, dim=1)
+    def forward(self, x, c, mod=None):
+        if mod is None:
+            mod = self.adaLN_modulation(c)
+        shift, scale = mod.chunk(2, dim=1)
         # print("shift: ", shift)
         # print("scale: ", scale)
         # print("After norm:", self.norm_final(x)[0, 0, :])
@@ -268,6 +277,84 @@ class FinalLayer(nn.Module):
         return x
 
 
+class TimestepConditioningTable(nn.Module):
+    """
+    The adaLN modulation of every DiT block and of the final layer, precomputed
+    for a fixed set of diffusion timesteps. The conditioning only depends on t,
+    so at sampling time the timestep MLP and the adaLN linears can be read from
+    this table instead of being run at every denoising step.
+    Rebuild it whenever the weights change, see build_conditioning_table().
+    """
+
+    @torch.no_grad()
+    def __init__(self, model, timesteps):
+        super().__init__()
+        device = next(model.parameters()).device
+        t = torch.as_tensor(timesteps, dtype=torch.long, device=device)
+        # Timestep -> row of the table.
+        index = torch.full((int(t.max()) + 1,), -1, dtype=torch.long, device=device)
+        index[t] = torch.arange(len(t), device=device)
+        c = model.t_embedder(t)  # (T, D)
+        self.register_buffer("index", index, persistent=False)
+        self.register_buffer(
+            "block_mods",
+            torch.stack([block.adaLN_modulation(c) for block in model.blocks]),
+            persistent=False,
+        )  # (depth, T, 6D)
+        self.register_buffer(
+            "final_mod", model.final_layer.adaLN_modulation(c), persistent=False
+        )  # (T, 2D)
+
+    def covers(self, t):
+        """Whether every timestep of t has a row in the table."""
+        if int(t.min()) < 0 or int(t.max()) >= len(self.index):
+            return False
+        return bool((self.index[t] >= 0).all())
+
+    def forward(self, t):
+        """
+        t: (N,) tensor of diffusion timesteps, all of them in the table (see covers())
+        returns the (depth, N, 6D) block and the (N, 2D) final layer modulations
+        """
+        rows = self.index[t]
+        return self.block_mods[:, rows], self.final_mod[rows]
+
+
+def build_conditioning_table(model, timesteps):
+    """
+    Precompute the timestep conditioning of a DiT variant for the given timesteps
+    (the ones the sampler feeds the model, e.g. SpacedDiffusion.timestep_map). In
+    eval mode the model then reads it instead of running t_embedder / adaLN.
+    """
+    model.cond_table = TimestepConditioningTable(model, timesteps)
+    return model.cond_table
+
+
+def conditioned_blocks(model, x, t):
+    """
+    Timestep embedding, DiT blocks and final layer, shared by the DiT variants.
+    x: (N, T, D) tensor of embedded points
+    t: (N,) tensor of diffusion timesteps
+    """
+    # Timesteps outside the table (e.g. another respacing) run the timestep MLP.
+    if model.cond_table is None or model.training or not model.cond_table.covers(t):
+        c = model.t_embedder(t)  # (N, D)
+        checkpointing = (
+            model.grad_checkpointing and model.training and torch.is_grad_enabled()
+        )
+        for block in model.blocks:
+            if checkpointing:
+                x = torch.utils.checkpoint.checkpoint(block, x, c, use_reentrant=False)
+            else:
+                x = block(x, c)  # (N, T, D)
+        return model.final_layer(x, c)  # (N, T, patch_size ** 2 * out_channels)
+
+    block_mods, final_mod = model.cond_table(t)
+    for block, mod in zip(model.blocks, block_mods):
+        x = block(x, None, mod=mod)
+    return model.final_layer(x, None, mod=final_mod)
+
+
 class PN2DiT(nn.Module):
     """
     Diffusion model with a Transformer backbone.
@@ -330,6 +417,8 @@ class PN2DiT(nn.Module):
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels)
         self.initialize_weights()
         self.pos_embed_freq_L = pos_embed_freq_L
+        self.cond_table = None  # See build_conditioning_table()
+        self.grad_checkpointing = False  # See enable_activation_checkpointing()
 
     def initialize_weights(self):
         # Initialize transformer layers:
@@ -363,15 +452,17 @@ class PN2DiT(nn.Module):
         nn.init.constant_(self.final_layer.linear.weight, 0)
         nn.init.constant_(self.final_layer.linear.bias, 0)
 
-    def unpatchify(self, x):
+    def unpatchify(self, x, h=None, w=None):
         """
         x: (N, T, patch_size**2 * C)
+        h, w: the spatial shape of the input, input_size by default
         imgs: (N, H, W, C)
         """
         c = self.out_channels
         p = self.patch_size
         # h = w = int(x.shape[1] ** 0.5)
-        h, w = self.h, self.w
+        if h is None:
+            h, w = self.h, self.w
         assert h * w == x.shape[1]
 
         x = x.reshape(shape=(x.shape[0], h, w, p, p, c))
@@ -379,49 +470,33 @@ class PN2DiT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], c, h * p, w * p))
         return imgs
 
-    def pcd_positional_encoding(self, xyz):
+    def build_geometry(self, context):
         """
-        Apply sinusoidal positional encoding to the given 3D coordinates.
-
-        :param xyz: A numpy array of shape (N, 3), where N is the number of points, and each point has x, y, z coordinates.
-        :return: A numpy array of shape (N, 6*L) containing the positional embeddings.
+        Precompute the PointNet++ sampling hierarchy of the context point cloud,
+        which is the same at every denoising step. Pass it to forward() as `geometry`.
         """
+        return pnp.dense_geometry(self.x_embedder, context.pos, context.batch)
 
-        L = self.pos_embed_freq_L
-
-        # Initialize an array to hold the positional encodings
-        embeddings = np.zeros((xyz.shape[0], 6 * L))
-
-        # Frequencies: 2^0, 2^1, ..., 2^(L-1)
-        frequencies = 2 ** np.arange(L)
-
-        # Apply sinusoidal encoding
-        for i, freq in enumerate(frequencies):
-            for j, func in enumerate([np.sin, np.cos]):
-                embeddings[:, (6 * i + 2 * j) : (6 * i + 2 * j + 3)] = func(
-                    2 * np.pi * xyz.detach().cpu().numpy() * freq
-                )
-
-        return torch.from_numpy(embeddings).float().cuda()
-
-    def forward(self, x, t, pos, context):
+    def forward(self, x, t, pos, context, geometry=None):
         """
         Forward pass of DiT.
-        x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
+        x: (N, C, H, W) tensor of spatial inputs, any H*W points per cloud (e.g. (N, C, n_points, 1))
         t: (N,) tensor of diffusion timesteps
         pos: (N, H*W, C)
+        geometry: optional precomputed PointNet++ geometry of context, see build_geometry()
         """
-        # # 0) Takes original point cloud
-        # pos_embed = self.pcd_positional_encoding(torch.flatten(pos, start_dim=0, end_dim=1))  # N*T * D
-        # x = torch.flatten(x, start_dim=2, end_dim=3).permute(0, 2, 1)  # (N, H*W, C)
-        # x = torch.concat((x, pos_embed.reshape(x.shape[0], x.shape[1], -1)), dim=-1)
-        # x = self.x_embedder(x.reshape(x.shape[0], -1, 30, 40))
         # 1) Take pointnet++ encoded point cloud
         context.x = (
             torch.flatten(x, start_dim=2, end_dim=3).permute(0, 2, 1).reshape(-1, 3)
         )
-        encoded_pcd = self.x_embedder(context.cuda())
-        x = encoded_pcd.reshape(x.shape[0], 1200, -1)
+        if geometry is None:
+            encoded_pcd = self.x_embedder(context.to(x.device))
+        else:
+            encoded_pcd = pnp.dense_forward(
+                self.x_embedder, context.x, context.pos, context.batch, geometry
+            )
+        h, w = x.shape[2], x.shape[3]
+        x = encoded_pcd.reshape(x.shape[0], h * w, -1)
 
         # # 2) Take DGCNN encoded point cloud
         # # print(torch.flatten(x, start_dim=2, end_dim=3).shape, pos.permute(0, 2, 1).shape)
@@ -431,19 +506,19 @@ class PN2DiT(nn.Module):
         # encoded_pcd = self.x_embedder(x, t, pos.permute(0, 2, 1)).sample
         # x = encoded_pcd.permute(0, 2, 1)
 
-        t = self.t_embedder(t)  # (N, D)
-
-        # print("x", x.shape, "t", t.shape)
+        x = self.trunk(x, t)  # (N, T, patch_size ** 2 * out_channels)
+        x = self.unpatchify(x, h, w)  # (N, out_channels, H, W)
+        return x
 
+    def trunk(self, x, t):
+        """
+        The transformer part of forward(), on fixed-shape dense tensors only (no
+        PyG batch), so that it can be compiled, see compile_trunk().
+        x: (N, T, D) tensor of encoded points
+        t: (N,) tensor of diffusion timesteps
+        """
         # y = self.y_embedder(y, self.training)    # (N, D)
-        c = t
-        # print("c", c.shape)                              # (N, D)
-        for block in self.blocks:
-            x = block(x, c)  # (N, T, D)
-        x = self.final_layer(x, c)  # (N, T, patch_size ** 2 * out_channels)
-        # print("after final layer:", x.shape)
-        x = self.unpatchify(x)  # (N, out_channels, H, W)
-        return x
+        return conditioned_blocks(self, x, t)  # (N, T, patch_size ** 2 * out_channels)
 
     def forward_with_cfg(self, x, t, cfg_scale, pos, context):
         """
@@ -523,6 +598,8 @@ class PN2HisDiT(nn.Module):  # With history latent everywhere version
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels)
         self.initialize_weights()
         self.pos_embed_freq_L = pos_embed_freq_L
+        self.cond_table = None  # See build_conditioning_table()
+        self.grad_checkpointing = False  # See enable_activation_checkpointing()
 
     def initialize_weights(self):
         # Initialize transformer layers:
@@ -556,15 +633,17 @@ class PN2HisDiT(nn.Module):  # With history latent everywhere version
         nn.init.constant_(self.final_layer.linear.weight, 0)
         nn.init.constant_(self.final_layer.linear.bias, 0)
 
-    def unpatchify(self, x):
+    def unpatchify(self, x, h=None, w=None):
         """
         x: (N, T, patch_size**2 * C)
+        h, w: the spatial shape of the input, input_size by default
         imgs: (N, H, W, C)
         """
         c = self.out_channels
         p = self.patch_size
         # h = w = int(x.shape[1] ** 0.5)
-        h, w = self.h, self.w
+        if h is None:
+            h, w = self.h, self.w
         assert h * w == x.shape[1]
 
         x = x.reshape(shape=(x.shape[0], h, w, p, p, c))
@@ -572,49 +651,30 @@ class PN2HisDiT(nn.Module):  # With history latent everywhere version
         imgs = x.reshape(shape=(x.shape[0], c, h * p, w * p))
         return imgs
 
-    def pcd_positional_encoding(self, xyz):
+    def build_geometry(self, context):
         """
-        Apply sinusoidal positional encoding to the given 3D coordinates.
-
-        :param xyz: A numpy array of shape (N, 3), where N is the number of points, and each point has x, y, z coordinates.
-        :return: A numpy array of shape (N, 6*L) containing the positional embeddings.
+        Precompute the PointNet++ sampling hierarchy of the context point cloud,
+        which is the same at every denoising step. Pass it to forward() as `geometry`.
         """
+        return pnp.dense_geometry(self.x_embedder, context.pos, context.batch)
 
-        L = self.pos_embed_freq_L
-
-        # Initialize an array to hold the positional encodings
-        embeddings = np.zeros((xyz.shape[0], 6 * L))
-
-        # Frequencies: 2^0, 2^1, ..., 2^(L-1)
-        frequencies = 2 ** np.arange(L)
-
-        # Apply sinusoidal encoding
-        for i, freq in enumerate(frequencies):
-            for j, func in enumerate([np.sin, np.cos]):
-                embeddings[:, (6 * i + 2 * j) : (6 * i + 2 * j + 3)] = func(
-                    2 * np.pi * xyz.detach().cpu().numpy() * freq
-                )
-
-        return torch.from_numpy(embeddings).float().cuda()
-
-    def forward(self, x, t, pos, context):
+    def forward(self, x, t, pos, context, geometry=None):
         """
         Forward pass of DiT.
-        x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
+        x: (N, C, H, W) tensor of spatial inputs, any H*W points per cloud (e.g. (N, C, n_points, 1))
         t: (N,) tensor of diffusion timesteps
         pos: (N, H*W, C)
+        geometry: optional precomputed PointNet++ geometry of context, see build_geometry()
         """
-        # # 0) Takes original point cloud
-        # pos_embed = self.pcd_positional_encoding(torch.flatten(pos, start_dim=0, end_dim=1))  # N*T * D
-        # x = torch.flatten(x, start_dim=2, end_dim=3).permute(0, 2, 1)  # (N, H*W, C)
-        # x = torch.concat((x, pos_embed.reshape(x.shape[0], x.shape[1], -1)), dim=-1)
-        # x = self.x_embedder(x.reshape(x.shape[0], -1, 30, 40))
         # 1) Take pointnet++ encoded point cloud
         context.x = (
             torch.flatten(x, start_dim=2, end_dim=3).permute(0, 2, 1).reshape(-1, 3)
         )
-        encoded_pcd = self.x_embedder(context.cuda(), latents=context.history_embed)
-        x = encoded_pcd.reshape(x.shape[0], 1200, -1)
+        encoded_pcd = self.x_embedder(
+            context.to(x.device), latents=context.history_embed, geometry=geometry
+        )
+        h, w = x.shape[2], x.shape[3]
+        x = encoded_pcd.reshape(x.shape[0], h * w, -1)
 
         # # 2) Take DGCNN encoded point cloud
         # # print(torch.flatten(x, start_dim=2, end_dim=3).shape, pos.permute(0, 2, 1).shape)
@@ -624,19 +684,19 @@ class PN2HisDiT(nn.Module):  # With history latent everywhere version
         # encoded_pcd = self.x_embedder(x, t, pos.permute(0, 2, 1)).sample
         # x = encoded_pcd.permute(0, 2, 1)
 
-        t = self.t_embedder(t)  # (N, D)
-
-        # print("x", x.shape, "t", t.shape)
+        x = self.trunk(x, t)  # (N, T, patch_size ** 2 * out_channels)
+        x = self.unpatchify(x, h, w)  # (N, out_channels, H, W)
+        return x
 
+    def trunk(self, x, t):
+        """
+        The transformer part of forward(), on fixed-shape dense tensors only (no
+        PyG batch), so that it can be compiled, see compile_trunk().
+        x: (N, T, D) tensor of encoded points
+        t: (N,) tensor of diffusion timesteps
+        """
         # y = self.y_embedder(y, self.training)    # (N, D)
-        c = t
-        # print("c", c.shape)                              # (N, D)
-        for block in self.blocks:
-            x = block(x, c)  # (N, T, D)
-        x = self.final_layer(x, c)  # (N, T, patch_size ** 2 * out_channels)
-        # print("after final layer:", x.shape)
-        x = self.unpatchify(x)  # (N, out_channels, H, W)
-        return x
+        return conditioned_blocks(self, x, t)  # (N, T, patch_size ** 2 * out_channels)
 
     def forward_with_cfg(self, x, t, cfg_scale, pos, context):
         """
@@ -723,6 +783,8 @@ class DGDiT(nn.Module):
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels)
         self.initialize_weights()
         self.pos_embed_freq_L = pos_embed_freq_L
+        self.cond_table = None  # See build_conditioning_table()
+        self.grad_checkpointing = False  # See enable_activation_checkpointing()
 
     def initialize_weights(self):
         # Initialize transformer layers:
@@ -772,43 +834,21 @@ class DGDiT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], c, h * p, w * p))
         return imgs
 
-    def pcd_positional_encoding(self, xyz):
+    def build_graph(self, pos):
         """
-        Apply sinusoidal positional encoding to the given 3D coordinates.
-
-        :param xyz: A numpy array of shape (N, 3), where N is the number of points, and each point has x, y, z coordinates.
-        :return: A numpy array of shape (N, 6*L) containing the positional embeddings.
+        Precompute the DGCNN kNN graph of pos (N, H*W, C), which is the same at
+        every denoising step. Pass it to forward() as `graph`.
         """
+        return self.x_embedder.build_graph(pos.permute(0, 2, 1))
 
-        L = self.pos_embed_freq_L
-
-        # Initialize an array to hold the positional encodings
-        embeddings = np.zeros((xyz.shape[0], 6 * L))
-
-        # Frequencies: 2^0, 2^1, ..., 2^(L-1)
-        frequencies = 2 ** np.arange(L)
-
-        # Apply sinusoidal encoding
-        for i, freq in enumerate(frequencies):
-            for j, func in enumerate([np.sin, np.cos]):
-                embeddings[:, (6 * i + 2 * j) : (6 * i + 2 * j + 3)] = func(
-                    2 * np.pi * xyz.detach().cpu().numpy() * freq
-                )
-
-        return torch.from_numpy(embeddings).float().cuda()
-
-    def forward(self, x, t, pos, context):
+    def forward(self, x, t, pos, context, graph=None):
         """
         Forward pass of DiT.
         x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
         t: (N,) tensor of diffusion timesteps
         pos: (N, H*W, C)
+        graph: optional precomputed kNN graph of pos, see build_graph()
         """
-        # # 0) Takes original point cloud
-        # pos_embed = self.pcd_positional_encoding(torch.flatten(pos, start_dim=0, end_dim=1))  # N*T * D
-        # x = torch.flatten(x, start_dim=2, end_dim=3).permute(0, 2, 1)  # (N, H*W, C)
-        # x = torch.concat((x, pos_embed.reshape(x.shape[0], x.shape[1], -1)), dim=-1)
-        # x = self.x_embedder(x.reshape(x.shape[0], -1, 30, 40))
 
         # # 1) Take pointnet++ encoded point cloud
         # context.x = torch.flatten(x, start_dim=2, end_dim=3).permute(0, 2, 1).reshape(-1, 3)
@@ -820,19 +860,11 @@ class DGDiT(nn.Module):
         x = torch.cat(
             (torch.flatten(x, start_dim=2, end_dim=3), pos.permute(0, 2, 1)), dim=1
         )
-        encoded_pcd = self.x_embedder(x, t, pos.permute(0, 2, 1)).sample
+        encoded_pcd = self.x_embedder(x, t, pos.permute(0, 2, 1), graph=graph).sample
         x = encoded_pcd.permute(0, 2, 1)
 
-        t = self.t_embedder(t)  # (N, D)
-
-        # print("x", x.shape, "t", t.shape)
-
         # y = self.y_embedder(y, self.training)    # (N, D)
-        c = t
-        # print("c", c.shape)                              # (N, D)
-        for block in self.blocks:
-            x = block(x, c)  # (N, T, D)
-        x = self.final_layer(x, c)  # (N, T, patch_size ** 2 * out_channels)
+        x = conditioned_blocks(self, x, t)  # (N, T, patch_size ** 2 * out_channels)
         # print("after final layer:", x.shape)
         x = self.unpatchify(x)  # (N, out_channels, H, W)
         return x
@@ -887,6 +919,8 @@ class DiT(nn.Module):
         # functionally setting patch size to 1 for a point cloud
         self.final_layer = FinalLayer(hidden_size, 1, self.out_channels)
         self.initialize_weights()
+        self.cond_table = None  # See build_conditioning_table()
+        self.grad_checkpointing = False  # See enable_activation_checkpointing()
 
     def initialize_weights(self):
         # Initialize transformer layers:
@@ -931,11 +965,15 @@ class DiT(nn.Module):
         # print(x.shape, pos.shape)
         x = torch.cat((x, pos), dim=1)
         x = torch.transpose(self.x_embedder(x), -1, -2)
-        t = self.t_embedder(t)  # (N, D)
-        c = t  # (N, D)
-        for block in self.blocks:
-            x = block(x, c)  # (N, L, D)
-        x = self.final_layer(x, c)  # (N, L, patch_size ** 2 * out_channels)
+        return self.trunk(x, t)
+
+    def trunk(self, x, t):
+        """
+        The transformer part of forward(), see compile_trunk().
+        x: (N, L, D) tensor of embedded points
+        t: (N,) tensor of diffusion timesteps
+        """
+        x = conditioned_blocks(self, x, t)  # (N, L, patch_size ** 2 * out_channels)
         # transpose back to (N, out_channels, L)
         x = torch.transpose(x, -1, -2)
         return x
@@ -977,6 +1015,8 @@ class RoPEDiT(nn.Module):
         # functionally setting patch size to 1 for a point cloud
         self.final_layer = FinalLayer(hidden_size, 1, self.out_channels)
         self.initialize_weights()
+        self.cond_table = None  # See build_conditioning_table()
+        self.grad_checkpointing = False  # See enable_activation_checkpointing()
 
     def initialize_weights(self):
         # Initialize transformer layers:
@@ -1017,21 +1057,80 @@ class RoPEDiT(nn.Module):
         """
         # NOTE: the patchify/unpatchify layers handle the dimension swapping, so we need to manually do that here
 
-        # concat x and pos
-        # print(x.shape, pos.shape)
-        x = self.x_embedder(x)
-        x += self.rope_embedder(pos)
+        x = self.x_embedder(x)  # (N, D, L)
+        # Sinusoidal code of each axis at the rope_embedder frequencies: the sines
+        # on the even features and the cosines on the odd ones.
+        cos_sin = self.rope_embedder(torch.transpose(pos, -1, -2))  # (N, L, D, 2)
+        pos_code = cos_sin[..., 1].clone()
+        pos_code[..., 1::2] = cos_sin[..., 1::2, 0]
+        x = x + torch.transpose(pos_code, -1, -2)  # (N, D, L)
         x = torch.transpose(x, -1, -2)
-        t = self.t_embedder(t)  # (N, D)
-        c = t  # (N, D)
-        for block in self.blocks:
-            x = block(x, c)  # (N, L, D)
-        x = self.final_layer(x, c)  # (N, L, patch_size ** 2 * out_channels)
+        x = conditioned_blocks(self, x, t)  # (N, L, patch_size ** 2 * out_channels)
         # transpose back to (N, out_channels, L)
         x = torch.transpose(x, -1, -2)
         return x
 
 
+def enable_activation_checkpointing(model):
+    """
+    Train a DiT variant with activation checkpointing: the DiT blocks (and the
+    SA / FP stages of a PN2HisDiT encoder) keep only their inputs and recompute
+    their activations in backward. Trades about one extra forward for memory.
+    """
+    model.grad_checkpointing = True
+    if hasattr(model.x_embedder, "grad_checkpointing"):
+        model.x_embedder.grad_checkpointing = True
+    return model
+
+
+def compile_trunk(model, cache_dir=None, mode=None, dynamic=True):
+    """
+    Compile the transformer trunk of a DiT / PN2DiT / PN2HisDiT in place with
+    torch.compile. The PointNet++ encoder of PN2DiT / PN2HisDiT works on PyG
+    batches and stays eager.
+    :param cache_dir: if set, inductor keeps its compiled kernels there, so later
+        jobs don't pay the kernel compile cost again. Inductor reads the directory
+        once, at its first compile: if something was compiled earlier in the
+        process, set TORCHINDUCTOR_CACHE_DIR before starting it instead. Reusing
+        the traced graphs as well (the FX graph cache) needs torch >= 2.1, on
+        older versions only the kernels are cached.
+    :param dynamic: compile the batch (and point) dimension symbolically, so the
+        winner-take-all batches (trial_times clouds per object) don't recompile
+        for every new size. Size 1 is still specialized, see compile_backbone().
+    """
+    if cache_dir is not None:
+        os.makedirs(os.path.expanduser(cache_dir), exist_ok=True)
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.expanduser(cache_dir))
+    import torch._inductor.config as inductor_config
+
+    if hasattr(inductor_config, "fx_graph_cache"):  # torch >= 2.1
+        inductor_config.fx_graph_cache = True
+    elif cache_dir is not None:
+        warnings.warn(
+            "torch < 2.1 has no FX graph cache: only the compiled kernels are "
+            f"persisted in {cache_dir}, the trunk is still traced every job."
+        )
+    model.trunk = torch.compile(model.trunk, dynamic=dynamic, mode=mode)
+    return model
+
+
+def quantize_trunk(model):
+    """
+    Post-training dynamic int8 quantization of the linear layers of a DiT / PN2DiT /
+    PN2HisDiT trunk (attention, MLP, adaLN modulation and timestep MLP), in place.
+    Weights are quantized once, activations per call. CPU only.
+    """
+    for name in ["t_embedder", "blocks", "final_layer"]:
+        setattr(
+            model,
+            name,
+            torch.ao.quantization.quantize_dynamic(
+                getattr(model, name), {nn.Linear}, dtype=torch.qint8
+            ),
+        )
+    return model
+
+
 #################################################################################
 #                   Sine/Cosine Positional Embedding Functions                  #
 #################################################################################
@@ -4,6 +4,8 @@ import torch
 import torch.nn as nn
 import torch_geometric.data as tgd
 
+from flowbothd.models.dit_utils import has_uniform_point_count
+
 
 # Yishu's old old old version - history : grasp point & direction & outcome
 class PDOHistoryEncoder(nn.Module):
@@ -79,6 +81,35 @@ def get_history_batch(batch):
     return no_history_ids, has_history_ids, tgd.Batch.from_data_list(history_datas)
 
 
+def has_dense_history(batch):
+    """Whether every sample holds one N-point history frame (zeros when K == 0) and
+    all samples share N, i.e. the history can be read as a (B, N, 3) view."""
+    return (
+        batch.history.dim() == 2
+        and batch.history.shape[0] == batch.pos.shape[0]
+        and has_uniform_point_count(batch)
+    )
+
+
+def get_dense_history_batch(batch):
+    """get_history_batch() for has_dense_history() batches, without to_data_list()."""
+    bs = batch.num_graphs
+    n_points = batch.pos.shape[0] // bs
+    has_history = batch.K.view(-1) != 0
+    has_history_ids = has_history.nonzero().flatten()
+    no_history_ids = (~has_history).nonzero().flatten()
+    if len(has_history_ids) == 0:
+        return no_history_ids, has_history_ids, None  # No has_history batch
+    history_batch = tgd.Data(
+        x=batch.flow_history.view(bs, n_points, 3)[has_history_ids].reshape(-1, 3),
+        pos=batch.history.view(bs, n_points, 3)[has_history_ids].reshape(-1, 3),
+        batch=torch.arange(
+            len(has_history_ids), device=batch.pos.device
+        ).repeat_interleave(n_points),
+    )
+    return no_history_ids, has_history_ids, history_batch
+
+
 def history_latents_to_nested_list(batch, history_latents):
     """Converting history latents from stacked form to nested list"""
     datas = batch.to_data_list()
@@ -103,7 +134,6 @@ class HistoryEncoder(L.LightningModule):
         repeat_dim=True,
     ):
         super(HistoryEncoder, self).__init__()
-        self.point_cnts = 1200
         self.history_len = history_len
         assert self.history_len == 1, "currently only supports 1 previous step history"
         self.history_dim = history_dim
@@ -127,7 +157,13 @@ class HistoryEncoder(L.LightningModule):
         history_embeds = torch.zeros(len(batch.lengths), self.history_dim).to(
             self.device
         )  # Also add the no history batch
-        no_history_ids, has_history_ids, history_batch = get_history_batch(batch)
+        dense = has_dense_history(batch)
+        if dense:  # Fixed-size batches (see collate_dense), no per-sample split
+            no_history_ids, has_history_ids, history_batch = get_dense_history_batch(
+                batch
+            )
+        else:
+            no_history_ids, has_history_ids, history_batch = get_history_batch(batch)
         # print("bsz = ", len(batch.lengths))
         if len(has_history_ids) != 0:  # Has history samples
             history_batch = history_batch.to(self.device)
@@ -137,10 +173,15 @@ class HistoryEncoder(L.LightningModule):
             history_embeds[no_history_ids] += self.no_history_embedding
 
         if self.transformer:
-            history_nested_list = history_latents_to_nested_list(batch, history_embeds)
-            src_padded = nn.utils.rnn.pad_sequence(
-                history_nested_list, batch_first=False, padding_value=0
-            )
+            if dense:  # One history step per sample: the padded sequence is (1, B, E)
+                src_padded = history_embeds.unsqueeze(0)
+            else:
+                history_nested_list = history_latents_to_nested_list(
+                    batch, history_embeds
+                )
+                src_padded = nn.utils.rnn.pad_sequence(
+                    history_nested_list, batch_first=False, padding_value=0
+                )
             # Create a mask for the padded sequences.
             src_mask = (src_padded == 0.0).all(dim=-1)
 
@@ -160,7 +201,9 @@ class HistoryEncoder(L.LightningModule):
             embeddings = history_embeds
 
         if self.repeat_dim == True:  # To point-wise features to concat to DiT
-            embeddings = embeddings.unsqueeze(1).repeat(1, self.point_cnts, 1)
+            # The clouds of a batch share one point count, see predict_by_point_count().
+            point_cnts = batch.pos.shape[0] // batch.num_graphs
+            embeddings = embeddings.unsqueeze(1).repeat(1, point_cnts, 1)
         else:
             embeddings = embeddings.unsqueeze(1)
         return embeddings
@@ -0,0 +1,102 @@
+# ONNX export of the pure-tensor DiT denoisers (DiT / RoPEDiT), and an onnxruntime
+# session that can stand in for the torch backbone in GaussianDiffusion's sampling loops.
+# save_diffusion_tables() writes the sampling schedule next to the graph, so that
+# onnx_sampler.OnnxFlowSampler can run inference without torch or the checkpoint.
+# Needs the optional "onnx" dependencies: pip install -e ".[onnx]"
+
+import os
+
+import numpy as np
+import torch
+
+# The schedule tables used by the DDPM / DDIM steps of the sampling loops.
+DIFFUSION_TABLES = [
+    "timestep_map",
+    "alphas_cumprod",
+    "alphas_cumprod_prev",
+    "sqrt_recip_alphas_cumprod",
+    "sqrt_recipm1_alphas_cumprod",
+    "posterior_mean_coef1",
+    "posterior_mean_coef2",
+    "posterior_log_variance_clipped",
+    "log_betas",
+]
+
+
+def diffusion_tables_file(onnx_file):
+    """The default path of the schedule tables of an exported graph."""
+    return f"{os.path.splitext(onnx_file)[0]}_diffusion.npz"
+
+
+def save_diffusion_tables(diffusion, tables_file):
+    """
+    Save the (respaced) schedule tables of a SpacedDiffusion, see DIFFUSION_TABLES.
+    The tables are indexed by the sampling step, timestep_map gives the trained
+    timestep of every step (the t input of the graph).
+    """
+    np.savez(
+        tables_file,
+        **{name: np.asarray(getattr(diffusion, name)) for name in DIFFUSION_TABLES},
+    )
+    return tables_file
+
+
+def export_denoiser_onnx(model, onnx_file, n_points=1200, opset_version=17):
+    """
+    Export a DiT / RoPEDiT denoiser, including its timestep embedder, to ONNX.
+    The graph takes x: (N, 3, L) float32, t: (N,) int64 and pos: (N, 3, L) float32,
+    and returns the (N, out_channels, L) model output. N and L are dynamic.
+    :param model: the denoiser, in eval mode.
+    :param onnx_file: the path of the exported graph.
+    :param n_points: the number of points L of the example input used for tracing.
+    """
+    device = next(model.parameters()).device
+    x = torch.zeros(1, 3, n_points, device=device)
+    t = torch.zeros(1, dtype=torch.long, device=device)
+    pos = torch.zeros(1, 3, n_points, device=device)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (x, t, pos),
+            onnx_file,
+            input_names=["x", "t", "pos"],
+            output_names=["out"],
+            dynamic_axes={
+                "x": {0: "batch", 2: "points"},
+                "t": {0: "batch"},
+                "pos": {0: "batch", 2: "points"},
+                "out": {0: "batch", 2: "points"},
+            },
+            opset_version=opset_version,
+        )
+    return onnx_file
+
+
+class OnnxDenoiser:
+    """
+    Runs an exported denoiser (see export_denoiser_onnx()) with onnxruntime. It is
+    called like the torch model, model(x, t, pos=pos), so it can be passed to
+    GaussianDiffusion.p_sample_loop / sample_loop in place of the backbone.
+    """
+
+    def __init__(self, onnx_file, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            onnx_file, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, x, t, pos):
+        (out,) = self.session.run(
+            None,
+            {
+                "x": x.detach().float().cpu().numpy(),
+                "t": t.detach().long().cpu().numpy(),
+                "pos": pos.detach().float().cpu().numpy(),
+            },
+        )
+        return torch.from_numpy(out).to(x.device)
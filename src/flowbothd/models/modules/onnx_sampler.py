@@ -0,0 +1,127 @@
+# Torch-free inference with an exported denoiser: the graph written by
+# export_denoiser_onnx() and the schedule tables written by save_diffusion_tables().
+# Only needs numpy and onnxruntime, e.g. for CPU workers without torch or checkpoints.
+# Export both files with scripts/export_onnx.py.
+
+import os
+
+import numpy as np
+
+
+class OnnxFlowSampler:
+    """
+    DDPM / DDIM sampling of the flow of a point cloud, in numpy, with the denoiser
+    run by an onnxruntime session. Same steps as GaussianDiffusion.p_sample_loop
+    and ddim_sample_loop (epsilon prediction, learned variance, no clipping).
+    """
+
+    def __init__(self, session, tables):
+        """
+        :param session: an onnxruntime InferenceSession (or anything with the same
+            run() method) of the exported denoiser.
+        :param tables: the schedule tables, {name: 1-D array}.
+        """
+        self.session = session
+        self.tables = {name: np.asarray(table) for name, table in tables.items()}
+        self.num_timesteps = len(self.tables["timestep_map"])
+
+    @classmethod
+    def load(cls, onnx_file, tables_file=None, num_threads=None):
+        """Open an exported graph and its tables (by default, next to the graph)."""
+        import onnxruntime as ort
+
+        if tables_file is None:  # onnx_denoiser.diffusion_tables_file(), without torch
+            tables_file = f"{os.path.splitext(onnx_file)[0]}_diffusion.npz"
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(
+            onnx_file, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        with np.load(tables_file) as tables:
+            return cls(session, dict(tables))
+
+    def _table(self, name, step, ndim):
+        value = self.tables[name][step].astype(np.float32)
+        return value.reshape(-1, *([1] * (ndim - 1)))
+
+    def _denoise(self, x, step, pos):
+        t = np.full(x.shape[0], self.tables["timestep_map"][step], dtype=np.int64)
+        (out,) = self.session.run(
+            None, {"x": x.astype(np.float32), "t": t, "pos": pos.astype(np.float32)}
+        )
+        eps, var_values = np.split(out.astype(np.float32), 2, axis=1)
+        pred_xstart = (
+            self._table("sqrt_recip_alphas_cumprod", step, x.ndim) * x
+            - self._table("sqrt_recipm1_alphas_cumprod", step, x.ndim) * eps
+        )
+        return eps, var_values, pred_xstart
+
+    def ddpm_step(self, x, step, pos, rng):
+        eps, var_values, pred_xstart = self._denoise(x, step, pos)
+        min_log = self._table("posterior_log_variance_clipped", step, x.ndim)
+        max_log = self._table("log_betas", step, x.ndim)
+        # The model_var_values is [-1, 1] for [min_var, max_var].
+        frac = (var_values + 1) / 2
+        log_variance = frac * max_log + (1 - frac) * min_log
+        mean = (
+            self._table("posterior_mean_coef1", step, x.ndim) * pred_xstart
+            + self._table("posterior_mean_coef2", step, x.ndim) * x
+        )
+        if step == 0:  # no noise at the last step
+            return mean
+        noise = rng.standard_normal(x.shape, dtype=np.float32)
+        return mean + np.exp(0.5 * log_variance) * noise
+
+    def ddim_step(self, x, step, pos, rng, eta=0.0):
+        eps, _, pred_xstart = self._denoise(x, step, pos)
+        alpha_bar = self._table("alphas_cumprod", step, x.ndim)
+        alpha_bar_prev = self._table("alphas_cumprod_prev", step, x.ndim)
+        sigma = (
+            eta
+            * np.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
+            * np.sqrt(1 - alpha_bar / alpha_bar_prev)
+        )
+        # Equation 12.
+        sample = (
+            pred_xstart * np.sqrt(alpha_bar_prev)
+            + np.sqrt(1 - alpha_bar_prev - sigma**2) * eps
+        )
+        if step == 0 or eta == 0:
+            return sample
+        return sample + sigma * rng.standard_normal(x.shape, dtype=np.float32)
+
+    def sample(self, pos, noise=None, sampler="ddpm", eta=0.0, seed=None):
+        """
+        Sample flows for a batch of point clouds.
+        :param pos: the point clouds, (N, 3, L).
+        :param noise: the initial noise, (N, 3, L), drawn from seed if None.
+        :param sampler: "ddpm" or "ddim" (dpm_solver++ is torch only).
+        :return: the sampled flows, (N, 3, L).
+        """
+        if sampler not in ["ddpm", "ddim"]:
+            raise ValueError(f"Unsupported sampler for the ONNX runtime: {sampler}")
+        rng = np.random.default_rng(seed)
+        x = (
+            rng.standard_normal(pos.shape, dtype=np.float32)
+            if noise is None
+            else np.asarray(noise, dtype=np.float32)
+        )
+        for step in reversed(range(self.num_timesteps)):
+            if sampler == "ddpm":
+                x = self.ddpm_step(x, step, pos, rng)
+            else:
+                x = self.ddim_step(x, step, pos, rng, eta=eta)
+        return x
+
+    def predict(self, P_world, sampler="ddpm", seed=None):
+        """
+        The flow of one point cloud (L, 3), like
+        FlowTrajectoryDiffuserInferenceModule_DiT.predict(): (L, 1, 3), with the
+        longest flow scaled to norm 1.
+        """
+        pos = np.asarray(P_world, dtype=np.float32).T[None]
+        flow = self.sample(pos, sampler=sampler, seed=seed)[0].T[:, None, :]
+        norm = np.linalg.norm(flow, axis=-1, keepdims=True)
+        return flow / (norm.max(axis=0, keepdims=True) + 1e-6)
@@ -1,13 +1,14 @@
 from dataclasses import dataclass
-from typing import Literal
+from typing import Literal, Optional
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from rpad.pyg.nets import pointnet2 as pnp_bn
 from rpad.pyg.nets.mlp import MLP, MLPParams
 from torch_geometric.data import Data
-from torch_geometric.nn import PointConv, fps, global_max_pool, knn_interpolate, radius
+from torch_geometric.nn import PointConv, fps, global_max_pool, knn, radius
 
 
 @dataclass
@@ -51,33 +52,88 @@ class SAModule(nn.Module):
             MLP(in_chan, out_chan, p.net_params), add_self_loops=False
         )
 
-    def forward(self, x, pos, batch):
-        if self.ratio == 1.0:
-            selected_pos = pos
-            selected_batch = batch
-        else:
-            # Select the points using "Farthest Point Sampling".
-            idx = fps(pos, batch, ratio=self.ratio)
-
-            selected_pos = pos[idx]
-            selected_batch = batch[idx]
-
-        # Perform a ball query around each of the points.
-        row, col = radius(
-            pos,
-            selected_pos,
-            self.r,
-            batch,
-            selected_batch,
-            max_num_neighbors=self.max_num_neighbors,
+    def forward(self, x, pos, batch, geometry: Optional["SAGeometry"] = None):
+        return sa_forward(self, x, pos, batch, geometry)
+
+
+@dataclass
+class SAGeometry:
+    """The sampling and grouping of a Set Aggregation layer.
+
+    It only depends on the input positions, so it can be computed once per point cloud
+    and reused while only the features change (e.g. across denoising steps).
+    """
+
+    # Ball query edges, from input points to the selected points.
+    edge_index: torch.Tensor
+
+    # The selected points.
+    pos: torch.Tensor
+    batch: torch.Tensor
+
+    def repeat(self, n: int, num_points: int, num_graphs: int) -> "SAGeometry":
+        """The geometry of n stacked copies of the input, see PN2DenseGeometry.repeat().
+
+        Args:
+            n: Number of copies.
+            num_points: Number of input points of one copy.
+            num_graphs: Number of point clouds in one copy.
+        """
+        col, row = self.edge_index
+        return SAGeometry(
+            edge_index=torch.stack(
+                [
+                    repeat_index(col, n, num_points),
+                    repeat_index(row, n, self.pos.size(0)),
+                ],
+                dim=0,
+            ),
+            pos=self.pos.repeat(n, 1),
+            batch=repeat_index(self.batch, n, num_graphs),
         )
 
-        # Run PointNet on each point set independently.
-        edge_index = torch.stack([col, row], dim=0)
-        x = self.conv(x, (pos, selected_pos), edge_index)
-        pos, batch = selected_pos, selected_batch
 
-        return x, pos, batch
+def repeat_index(index: torch.Tensor, n: int, size: int) -> torch.Tensor:
+    """Tile a 1-D index tensor n times, offsetting the k-th copy by k * size."""
+    offsets = torch.arange(n, device=index.device) * size
+    return (index.unsqueeze(0) + offsets.unsqueeze(1)).reshape(-1)
+
+
+def sa_geometry(sa, pos, batch) -> SAGeometry:
+    """Compute the sampling and grouping of a SAModule for the given points."""
+    if sa.ratio == 1.0:
+        selected_pos = pos
+        selected_batch = batch
+    else:
+        # Select the points using "Farthest Point Sampling".
+        idx = fps(pos, batch, ratio=sa.ratio)
+
+        selected_pos = pos[idx]
+        selected_batch = batch[idx]
+
+    # Perform a ball query around each of the points.
+    row, col = radius(
+        pos,
+        selected_pos,
+        sa.r,
+        batch,
+        selected_batch,
+        max_num_neighbors=sa.max_num_neighbors,
+    )
+    edge_index = torch.stack([col, row], dim=0)
+
+    return SAGeometry(edge_index, selected_pos, selected_batch)
+
+
+def sa_forward(sa, x, pos, batch, geometry: Optional[SAGeometry] = None):
+    """SAModule forward pass, reusing a precomputed geometry if given."""
+    if geometry is None:
+        geometry = sa_geometry(sa, pos, batch)
+
+    # Run PointNet on each point set independently.
+    x = sa.conv(x, (pos, geometry.pos), geometry.edge_index)
+
+    return x, geometry.pos, geometry.batch
 
 
 @dataclass
@@ -135,21 +191,198 @@ class FPModule(torch.nn.Module):
         self.k = params.k
         self.net = MLP(in_channels, out_channels, params.net_params)
 
-    def forward(self, x, pos, batch, x_skip, pos_skip, batch_skip):
-        # If we need to interpolate, interpolate.
-        # Otherwise (i.e. when the sampling ratio is 1.0, we don't need to.
-        if pos.shape[0] != pos_skip.shape[0]:
-            # Perform the interpolation.
-            x = knn_interpolate(x, pos, pos_skip, batch, batch_skip, k=self.k)
+    def forward(
+        self,
+        x,
+        pos,
+        batch,
+        x_skip,
+        pos_skip,
+        batch_skip,
+        geometry: Optional["FPGeometry"] = None,
+    ):
+        return fp_forward(self, x, pos, batch, x_skip, pos_skip, batch_skip, geometry)
+
+
+@dataclass
+class FPGeometry:
+    """The knn_interpolate neighbors and weights of a Feature Propagation layer.
+
+    Like SAGeometry, it only depends on the positions. All fields are None when no
+    interpolation is needed.
+    """
 
-        # If we have skip connections concatenate them.
-        if x_skip is not None:
-            x = torch.cat([x, x_skip], dim=1)
+    # Interpolated (skip) point and source point of each neighbor pair.
+    y_idx: Optional[torch.Tensor] = None
+    x_idx: Optional[torch.Tensor] = None
 
-        # Run them
-        x = self.net(x)
+    # Inverse squared distance of each pair, and their sum for each skip point.
+    weights: Optional[torch.Tensor] = None
+    norm: Optional[torch.Tensor] = None
 
-        return x, pos_skip, batch_skip
+    def repeat(self, n: int, num_points: int, num_skip_points: int) -> "FPGeometry":
+        """The geometry of n stacked copies of the input, see PN2DenseGeometry.repeat().
+
+        Args:
+            n: Number of copies.
+            num_points: Number of interpolated-from points of one copy.
+            num_skip_points: Number of interpolated (skip) points of one copy.
+        """
+        if self.weights is None:
+            return self
+        return FPGeometry(
+            y_idx=repeat_index(self.y_idx, n, num_skip_points),
+            x_idx=repeat_index(self.x_idx, n, num_points),
+            weights=self.weights.repeat(n, 1),
+            norm=self.norm.repeat(n, 1),
+        )
+
+
+def fp_geometry(fp, pos, batch, pos_skip, batch_skip) -> FPGeometry:
+    """Compute the interpolation of a FPModule, as done by knn_interpolate."""
+    # If we need to interpolate, interpolate.
+    # Otherwise (i.e. when the sampling ratio is 1.0, we don't need to.
+    if pos.shape[0] == pos_skip.shape[0]:
+        return FPGeometry()
+
+    with torch.no_grad():
+        y_idx, x_idx = knn(pos, pos_skip, fp.k, batch_x=batch, batch_y=batch_skip)
+        diff = pos[x_idx] - pos_skip[y_idx]
+        squared_distance = (diff * diff).sum(dim=-1, keepdim=True)
+        weights = 1.0 / torch.clamp(squared_distance, min=1e-16)
+        norm = weights.new_zeros((pos_skip.size(0), 1)).index_add_(0, y_idx, weights)
+
+    return FPGeometry(y_idx, x_idx, weights, norm)
+
+
+def fp_forward(
+    fp,
+    x,
+    pos,
+    batch,
+    x_skip,
+    pos_skip,
+    batch_skip,
+    geometry: Optional[FPGeometry] = None,
+):
+    """FPModule forward pass, reusing a precomputed geometry if given."""
+    if geometry is None:
+        geometry = fp_geometry(fp, pos, batch, pos_skip, batch_skip)
+
+    if geometry.weights is not None:
+        # Perform the interpolation.
+        weighted = x[geometry.x_idx] * geometry.weights
+        x = (
+            weighted.new_zeros((pos_skip.size(0), x.size(1))).index_add_(
+                0, geometry.y_idx, weighted
+            )
+            / geometry.norm
+        )
+
+    # If we have skip connections concatenate them.
+    if x_skip is not None:
+        x = torch.cat([x, x_skip], dim=1)
+
+    # Run them
+    x = fp.net(x)
+
+    return x, pos_skip, batch_skip
+
+
+@dataclass
+class PN2DenseGeometry:
+    """All the position-only computation of a PointNet++ dense network (PN2Dense or
+    PN2DenseLatentEncodingEverywhere), see dense_geometry().
+    """
+
+    # The input point cloud(s).
+    pos: torch.Tensor
+    batch: torch.Tensor
+    num_graphs: int
+
+    sa1: SAGeometry
+    sa2: SAGeometry
+    fp3: FPGeometry
+    fp2: FPGeometry
+    fp1: FPGeometry
+
+    def repeat(self, n: int) -> "PN2DenseGeometry":
+        """The geometry of n stacked copies of the input point cloud(s), ordered like
+        Batch.from_data_list(data_list * n). It tiles the indices instead of sampling
+        again, so all copies share the same sampling hierarchy.
+        """
+        n_pos, n_sa1, n_sa2 = (
+            self.pos.size(0),
+            self.sa1.pos.size(0),
+            self.sa2.pos.size(0),
+        )
+        return PN2DenseGeometry(
+            pos=self.pos.repeat(n, 1),
+            batch=repeat_index(self.batch, n, self.num_graphs),
+            num_graphs=self.num_graphs * n,
+            sa1=self.sa1.repeat(n, n_pos, self.num_graphs),
+            sa2=self.sa2.repeat(n, n_sa1, self.num_graphs),
+            fp3=self.fp3.repeat(n, self.num_graphs, n_sa2),
+            fp2=self.fp2.repeat(n, n_sa2, n_sa1),
+            fp1=self.fp1.repeat(n, n_sa1, n_pos),
+        )
+
+
+def dense_geometry(net, pos, batch) -> PN2DenseGeometry:
+    """Compute the sampling hierarchy of a PointNet++ dense network for a (batched)
+    point cloud: FPS indices, ball query edges and interpolation weights.
+
+    Works for the networks in this module as well as rpad's PN2Dense, whose layers
+    have the same structure.
+
+    Args:
+        net: The dense network.
+        pos: [N x 3] positions.
+        batch: [N] batch assignment of the points.
+    """
+    sa1 = sa_geometry(net.sa1, pos, batch)
+    sa2 = sa_geometry(net.sa2, sa1.pos, sa1.batch)
+
+    # Output of the global SA module.
+    num_graphs = int(batch.max()) + 1
+    pos3 = pos.new_zeros((num_graphs, 3))
+    batch3 = torch.arange(num_graphs, device=batch.device)
+
+    return PN2DenseGeometry(
+        pos=pos,
+        batch=batch,
+        num_graphs=num_graphs,
+        sa1=sa1,
+        sa2=sa2,
+        fp3=fp_geometry(net.fp3, pos3, batch3, sa2.pos, sa2.batch),
+        fp2=fp_geometry(net.fp2, sa2.pos, sa2.batch, sa1.pos, sa1.batch),
+        fp1=fp_geometry(net.fp1, sa1.pos, sa1.batch, pos, batch),
+    )
+
+
+def dense_forward(net, x, pos, batch, geometry: PN2DenseGeometry):
+    """PN2Dense forward pass with a precomputed geometry, see dense_geometry()."""
+    sa0_out = (x, pos, batch)
+
+    # Encode.
+    sa1_out = sa_forward(net.sa1, *sa0_out, geometry=geometry.sa1)
+    sa2_out = sa_forward(net.sa2, *sa1_out, geometry=geometry.sa2)
+    sa3_out = net.sa3(*sa2_out)
+
+    # Decode.
+    fp3_out = fp_forward(net.fp3, *sa3_out, *sa2_out, geometry=geometry.fp3)
+    fp2_out = fp_forward(net.fp2, *fp3_out, *sa1_out, geometry=geometry.fp2)
+    x, _, _ = fp_forward(net.fp1, *fp2_out, *sa0_out, geometry=geometry.fp1)
+
+    # Final layers.
+    x = F.leaky_relu(net.lin1(x))
+    x = F.leaky_relu(net.lin2(x))
+    x = net.lin3(x)
+
+    if net.out_act != "none":
+        raise ValueError()
+
+    return x
 
 
 @dataclass
@@ -354,29 +587,56 @@ class PN2DenseLatentEncodingEverywhere(nn.Module):
         self.lin3 = torch.nn.Linear(p.lin2_dim, out_channels)
         self.out_act = p.out_act
 
-    def forward(self, data: Data, latents):
+        # Recompute the SA / FP activations in backward instead of storing them.
+        self.grad_checkpointing = False
+
+    def stage(self, module, *args, **kwargs):
+        """Run an SA / FP module, under activation checkpointing if enabled."""
+        if self.grad_checkpointing and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(
+                module, *args, use_reentrant=False, **kwargs
+            )
+        return module(*args, **kwargs)
+
+    def forward(self, data: Data, latents, geometry: Optional[PN2DenseGeometry] = None):
+        """
+        Args:
+            data: The point cloud, with features in `x`.
+            latents: [B x history_embed_dim] latent of each point cloud.
+            geometry: If given, the precomputed sampling hierarchy of `data`, see
+                      dense_geometry().
+        """
+        if geometry is None:
+            geometry = dense_geometry(self, data.pos, data.batch)
+
         sa0_out = (data.x, data.pos, data.batch)
         # Encode.
-        sa1_out = self.sa1(*sa0_out)
-        sa2_out = self.sa2(*sa1_out)
-        x3, pos3, batch3 = self.sa3(*sa2_out)
+        sa1_out = self.stage(self.sa1, *sa0_out, geometry=geometry.sa1)
+        sa2_out = self.stage(self.sa2, *sa1_out, geometry=geometry.sa2)
+        x3, pos3, batch3 = self.stage(self.sa3, *sa2_out)
 
         # No concatenation! just hadamard!
         x3 = self.global_linear(latents) * x3
         sa3_out = x3, pos3, batch3
 
         # Decode.
-        x_fp3, pos_fp3, batch_fp3 = self.fp3(*sa3_out, *sa2_out)
+        x_fp3, pos_fp3, batch_fp3 = self.stage(
+            self.fp3, *sa3_out, *sa2_out, geometry=geometry.fp3
+        )
         fp3_latents = self.fp3_embedding_linear(latents)
         x_fp3 = fp3_latents.repeat_interleave(torch.bincount(batch_fp3), dim=0) * x_fp3
         fp3_out = x_fp3, pos_fp3, batch_fp3
 
-        x_fp2, pos_fp2, batch_fp2 = self.fp2(*fp3_out, *sa1_out)
+        x_fp2, pos_fp2, batch_fp2 = self.stage(
+            self.fp2, *fp3_out, *sa1_out, geometry=geometry.fp2
+        )
         fp2_latents = self.fp2_embedding_linear(latents)
         x_fp2 = fp2_latents.repeat_interleave(torch.bincount(batch_fp2), dim=0) * x_fp2
         fp2_out = x_fp2, pos_fp2, batch_fp2
 
-        x, _, batch_fp1 = self.fp1(*fp2_out, *sa0_out)
+        x, _, batch_fp1 = self.stage(
+            self.fp1, *fp2_out, *sa0_out, geometry=geometry.fp1
+        )
         fp1_latents = self.fp1_embedding_linear(latents)
         x = fp1_latents.repeat_interleave(torch.bincount(batch_fp1), dim=0) * x
 
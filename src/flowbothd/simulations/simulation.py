@@ -8,9 +8,7 @@ import rpad.pyg.nets.pointnet2 as pnp
 import torch
 from rpad.partnet_mobility_utils.data import PMObject
 
-from flowbothd.models.flow_trajectory_predictor import (
-    FlowSimulationInferenceModule,
-)
+from flowbothd.models.flow_trajectory_predictor import FlowSimulationInferenceModule
 from flowbothd.simulations.suction import (  # compute_flow,; run_trial_with_history,
     GTFlowModel,
     GTTrajectoryModel,
@@ -180,7 +178,7 @@ def create_network(traj_len=15, ckpt_file=None):
     network = pnp.PN2Dense(
         in_channels=1, out_channels=3 * traj_len, p=pnp.PN2DenseParams()
     )
-    ckpt = torch.load(ckpt_file)
+    ckpt = torch.load(ckpt_file, map_location="cpu")
     network.load_state_dict(
         {k.partition(".")[2]: v for k, v, in ckpt["state_dict"].items()}
     )
@@ -367,6 +365,7 @@ def trial_with_diffuser_history(  # Always use sgp.... (Have already proved it's
     consistency_check=True,
     history_filter=True,
     analysis=False,
+    n_pts=1200,  # Points per observation, the history models take any count
 ):
     # pm_dir = os.path.expanduser("~/datasets/partnet-mobility/raw")
     pm_dir = os.path.expanduser("~/datasets/partnet-mobility/convex")
@@ -418,6 +417,7 @@ def trial_with_diffuser_history(  # Always use sgp.... (Have already proved it's
             history_model,
             gt_model=None,  # Don't need mask
             n_steps=n_step,
+            n_pts=n_pts,
             save_name=f"{obj_id}_{joint_name}",
             website=website,
             gui=gui,
@@ -14,9 +14,7 @@ from rpad.partnet_mobility_utils.render.pybullet import PMRenderEnv
 from rpad.pybullet_envs.suction_gripper import FloatingSuctionGripper
 from scipy.spatial.transform import Rotation as R
 
-from flowbothd.datasets.flow_trajectory_dataset import (
-    compute_flow_trajectory,
-)
+from flowbothd.datasets.flow_trajectory_dataset import compute_flow_trajectory
 from flowbothd.metrics.trajectory import normalize_trajectory
 
 
@@ -906,7 +904,8 @@ def run_trial(
         segmented_flow[link_ixs] = pred_flow[link_ixs]
         segmented_flow = np.array(
             normalize_trajectory(
-                torch.from_numpy(np.expand_dims(segmented_flow, 1))
+                torch.from_numpy(np.expand_dims(segmented_flow, 1)),
+                n_points=len(segmented_flow),
             ).squeeze()
         )
         animation.add_trace(
@@ -1133,7 +1132,8 @@ def run_trial(
                         segmented_flow[link_ixs] = pred_flow[link_ixs]
                         segmented_flow = np.array(
                             normalize_trajectory(
-                                torch.from_numpy(np.expand_dims(segmented_flow, 1))
+                                torch.from_numpy(np.expand_dims(segmented_flow, 1)),
+                                n_points=len(segmented_flow),
                             ).squeeze()
                         )
                         animation.add_trace(
@@ -1237,7 +1237,8 @@ def run_trial(
                 segmented_flow[link_ixs] = pred_flow[link_ixs]
                 segmented_flow = np.array(
                     normalize_trajectory(
-                        torch.from_numpy(np.expand_dims(segmented_flow, 1))
+                        torch.from_numpy(np.expand_dims(segmented_flow, 1)),
+                        n_points=len(segmented_flow),
                     ).squeeze()
                 )
                 animation.add_trace(
@@ -1282,7 +1283,7 @@ def run_trial(
                     sim_trajectory[left_step] = sim_trajectory[global_step]
                 break
 
-            pc_obs = env.render(filter_nonobj_pts=True, n_pts=1200)
+            pc_obs = env.render(filter_nonobj_pts=True, n_pts=n_pts)
             this_step_trial = 0  # This step is executed!
 
         if success:
@@ -1551,7 +1552,8 @@ def run_trial_with_history_filter(
         segmented_flow[link_ixs] = pred_flow[link_ixs]
         segmented_flow = np.array(
             normalize_trajectory(
-                torch.from_numpy(np.expand_dims(segmented_flow, 1))
+                torch.from_numpy(np.expand_dims(segmented_flow, 1)),
+                n_points=len(segmented_flow),
             ).squeeze()
         )
         animation.add_trace(
@@ -1826,7 +1828,8 @@ def run_trial_with_history_filter(
                     segmented_flow[link_ixs] = pred_flow[link_ixs]
                     segmented_flow = np.array(
                         normalize_trajectory(
-                            torch.from_numpy(np.expand_dims(segmented_flow, 1))
+                            torch.from_numpy(np.expand_dims(segmented_flow, 1)),
+                            n_points=len(segmented_flow),
                         ).squeeze()
                     )
                     animation.add_trace(
@@ -1961,7 +1964,8 @@ def run_trial_with_history_filter(
             segmented_flow[link_ixs] = pred_flow[link_ixs]
             segmented_flow = np.array(
                 normalize_trajectory(
-                    torch.from_numpy(np.expand_dims(segmented_flow, 1))
+                    torch.from_numpy(np.expand_dims(segmented_flow, 1)),
+                    n_points=len(segmented_flow),
                 ).squeeze()
             )
             animation.add_trace(
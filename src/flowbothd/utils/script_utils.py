@@ -1,6 +1,9 @@
 import abc
+import copy
 import os
 import pathlib
+import resource
+import time
 from typing import Dict, List, Literal, Protocol, Sequence, Union, cast
 
 import lightning.pytorch as pl
@@ -10,6 +13,10 @@ import torch.utils._pytree as pytree
 import torch_geometric.data as tgd
 from lightning.pytorch import Callback
 from lightning.pytorch.loggers import WandbLogger
+from lightning.pytorch.strategies import DDPStrategy
+
+from flowbothd.datasets.augmentation import augment_batch
+from flowbothd.metrics.trajectory import flow_metrics, normalize_trajectory
 
 PROJECT_ROOT = str(pathlib.Path(__file__).parent.parent.parent.parent.resolve())
 
@@ -45,6 +52,181 @@ def flatten_outputs(outputs: List[TorchTree]) -> TorchTree:
     return cast(TorchTree, output_dict)
 
 
+def setup_inference_device(resources) -> torch.device:
+    """Pick the inference device from the resources config and tune CPU threading.
+
+    resources.device is "cuda" (default) or "cpu". On CPU, intra-op threads default
+    to the cores this process may run on, and inter-op threads to 1: the denoising
+    loop is a chain of dependent steps, so there is little to run side by side.
+    """
+    device = torch.device(resources.get("device", "cuda"))
+    if device.type == "cpu":
+        if hasattr(os, "sched_getaffinity"):
+            n_cores = len(os.sched_getaffinity(0))
+        else:
+            n_cores = os.cpu_count() or 1
+        num_threads = resources.get("num_threads", None) or n_cores
+        num_interop_threads = resources.get("num_interop_threads", None) or 1
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work has started.
+            pass
+    return device
+
+
+def setup_training_devices(resources) -> Dict[str, object]:
+    """Trainer accelerator / devices / strategy from the resources config.
+
+    resources.accelerator is "gpu" (default, one rank per entry of resources.gpus) or
+    "cpu" (resources.cpu_processes ranks). More than one rank trains with DDP, over
+    nccl on GPU and gloo on CPU unless resources.ddp_backend is set. On CPU, every
+    rank gets an equal share of the cores. Returns the Trainer kwargs, plus the
+    number of ranks as "world_size" (pop it before passing them on).
+    """
+    accelerator = resources.get("accelerator", "gpu")
+    if accelerator == "gpu":
+        devices = resources.gpus
+        world_size = len(devices)
+    else:
+        devices = world_size = resources.get("cpu_processes", 1)
+        if hasattr(os, "sched_getaffinity"):
+            n_cores = len(os.sched_getaffinity(0))
+        else:
+            n_cores = os.cpu_count() or 1
+        torch.set_num_threads(max(1, n_cores // world_size))
+
+    strategy: Union[str, DDPStrategy] = "auto"
+    if world_size > 1:
+        backend = resources.get("ddp_backend", None)
+        strategy = DDPStrategy(
+            process_group_backend=backend
+            or ("nccl" if accelerator == "gpu" else "gloo"),
+            # The DiTs keep an unused label embedder.
+            find_unused_parameters=True,
+        )
+    return dict(
+        accelerator=accelerator,
+        devices=devices,
+        strategy=strategy,
+        world_size=world_size,
+    )
+
+
+@torch.no_grad()
+def predict_latency_report(
+    model: pl.LightningModule, batch: tgd.Batch, n_warmup: int = 1, n_runs: int = 5
+) -> Dict[str, Union[str, float]]:
+    """Time model.predict_step on one batch, in milliseconds per call."""
+    batch = batch.to(model.device)
+    for _ in range(n_warmup):
+        model.predict_step(batch, 0)
+    times = []
+    for _ in range(n_runs):
+        if model.device.type == "cuda":
+            torch.cuda.synchronize(model.device)
+        start = time.perf_counter()
+        model.predict_step(batch, 0)
+        if model.device.type == "cuda":
+            torch.cuda.synchronize(model.device)
+        times.append((time.perf_counter() - start) * 1000)
+    times_np = np.asarray(times)
+    return {
+        "device": str(model.device),
+        "num_threads": torch.get_num_threads(),
+        "num_interop_threads": torch.get_num_interop_threads(),
+        "mean_ms": float(times_np.mean()),
+        "std_ms": float(times_np.std()),
+        "min_ms": float(times_np.min()),
+    }
+
+
+def _flow_target(batch: tgd.Batch):
+    """The ground truth the modules score against: the per-cloud normalized flow,
+    and the mask of the points with flow."""
+    return normalize_trajectory(batch.delta, batch.batch), batch.mask.bool()
+
+
+@torch.no_grad()
+def precision_parity_report(
+    model: pl.LightningModule, batch: tgd.Batch, precision: str = "bf16", seed: int = 0
+) -> Dict[str, float]:
+    """Compare predict_step at the given precision against fp32, from the same noise.
+
+    Reports flow_metrics RMSE / cosine similarity of the reduced-precision flow
+    against the fp32 flow, and of both against the ground truth on the masked
+    points, like the modules' predict().
+    """
+    batch = batch.to(model.device)
+    orig_precision = model.inference_precision
+    preds = {}
+    for p in ["32", precision]:
+        model.inference_precision = p
+        torch.manual_seed(seed)
+        preds[p] = model.predict_step(batch, 0).float()
+    model.inference_precision = orig_precision
+
+    gt, f_ix = _flow_target(batch)
+    rmse, cos, _ = flow_metrics(preds[precision], preds["32"])
+    rmse_32, cos_32, _ = flow_metrics(preds["32"][f_ix], gt[f_ix])
+    rmse_lp, cos_lp, _ = flow_metrics(preds[precision][f_ix], gt[f_ix])
+    return {
+        "rmse_vs_fp32": rmse.item(),
+        "cos_vs_fp32": cos.item(),
+        "rmse_fp32": rmse_32.item(),
+        f"rmse_{precision}": rmse_lp.item(),
+        "cos_fp32": cos_32.item(),
+        f"cos_{precision}": cos_lp.item(),
+    }
+
+
+@torch.no_grad()
+def quantization_report(
+    model: pl.LightningModule, dataloader, n_batches: int = 8, seed: int = 0
+) -> Dict[str, float]:
+    """Compare a dynamic int8 copy of an fp32 inference module against the module.
+
+    Runs predict_step on the first n_batches of a (held-out) dataloader, from the
+    same noise for both, and averages the flow_metrics RMSE / cosine similarity of
+    the int8 flows against the fp32 flows, and of both against the ground truth on
+    the masked points, like the modules' predict().
+    """
+    assert not model.quantize, "Pass the fp32 module (inference.quantize=False)"
+    quantized = copy.deepcopy(model)
+    quantized.quantize_backbone()
+
+    names = [
+        "rmse_vs_fp32",
+        "cos_vs_fp32",
+        "rmse_fp32",
+        "rmse_int8",
+        "cos_fp32",
+        "cos_int8",
+    ]
+    totals = {name: 0.0 for name in names}
+    n = 0
+    for batch in dataloader:
+        if n == n_batches:
+            break
+        batch = batch.to(model.device)
+        torch.manual_seed(seed)
+        pred_32 = model.predict_step(batch, 0)
+        torch.manual_seed(seed)
+        pred_int8 = quantized.predict_step(batch, 0)
+
+        gt, f_ix = _flow_target(batch)
+        rmse, cos, _ = flow_metrics(pred_int8, pred_32)
+        rmse_32, cos_32, _ = flow_metrics(pred_32[f_ix], gt[f_ix])
+        rmse_int8, cos_int8, _ = flow_metrics(pred_int8[f_ix], gt[f_ix])
+        for name, value in zip(
+            names, [rmse, cos, rmse_32, rmse_int8, cos_32, cos_int8]
+        ):
+            totals[name] += value.item()
+        n += 1
+    return {name: total / max(n, 1) for name, total in totals.items()}
+
+
 class CanMakePlots(Protocol):
     @staticmethod
     @abc.abstractmethod
@@ -112,3 +294,55 @@ class LogPredictionSamplesCallback(Callback):
         name = dataloader_names[dataloader_idx]
         if (pl_module.current_epoch + 1) % self.eval_per_n_epoch == 0:
             self.eval_log_random_sample(trainer, pl_module, outputs, batch, name)
+
+
+class StepStatsCallback(Callback):
+    """Log the wall time, the data wait and the peak memory of every training step.
+
+    train/step_time_ms covers the whole step (forward, backward, optimizer step).
+    train/data_wait_ms is the time between two steps, i.e. waiting on the loader.
+    train/peak_memory_mb is the peak CUDA memory allocated during the step, or on
+    CPU the peak resident memory of the process (a high-water mark over the run).
+    """
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.last_end = None
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        if pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+            torch.cuda.reset_peak_memory_stats(pl_module.device)
+        self.start = time.perf_counter()
+        # Time spent waiting for the loader (fetch, collation, transfer) since the
+        # previous step ended, not measured for the first batch of an epoch.
+        self.data_wait = None if self.last_end is None else self.start - self.last_end
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+            peak_mb = torch.cuda.max_memory_allocated(pl_module.device) / 2**20
+        else:
+            # ru_maxrss is in KiB on Linux.
+            peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+        self.last_end = time.perf_counter()
+        stats = {
+            "train/step_time_ms": (self.last_end - self.start) * 1000,
+            "train/peak_memory_mb": peak_mb,
+        }
+        if self.data_wait is not None:
+            stats["train/data_wait_ms"] = self.data_wait * 1000
+        pl_module.log_dict(stats, batch_size=batch.num_graphs)
+
+
+class BatchAugmentationCallback(Callback):
+    """Augment every training batch on device, see flowbothd.datasets.augmentation.
+
+    Validation / prediction batches are left as they are.
+    """
+
+    def __init__(self, flip=True, random_size=False):
+        self.flip = flip
+        self.random_size = random_size
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        augment_batch(batch, flip=self.flip, random_size=self.random_size)
@@ -0,0 +1,75 @@
+import pytest
+import torch
+import torch_geometric.data as tgd
+
+from flowbothd.datasets.dense_batch import collate_dense
+
+
+def make_data_list(n_points=(6, 6, 6), history=True):
+    generator = torch.Generator().manual_seed(0)
+    data_list = []
+    for i, n in enumerate(n_points):
+        data = tgd.Data(
+            id=f"obj_{i}",
+            pos=torch.randn(n, 3, generator=generator),
+            delta=torch.randn(n, 1, 3, generator=generator),
+            point=torch.randn(n, 1, 3, generator=generator),
+            mask=(torch.rand(n, generator=generator) > 0.5).float(),
+            K=i,
+        )
+        if history:
+            data.history = torch.randn(2 * n, 3, generator=generator)
+            data.flow_history = torch.randn(2 * n, 3, generator=generator)
+            data.lengths = torch.tensor(2)
+        data_list.append(data)
+    return data_list
+
+
+def assert_same_value(actual, expected):
+    if torch.is_tensor(expected):
+        assert torch.is_tensor(actual)
+        assert actual.dtype == expected.dtype
+        assert torch.equal(actual, expected)
+    else:
+        assert actual == expected
+
+
+def assert_same_batch(actual, expected):
+    assert type(actual) is type(expected)
+    assert sorted(actual.keys()) == sorted(expected.keys())
+    for key in expected.keys():
+        assert_same_value(actual[key], expected[key])
+    assert actual.num_graphs == expected.num_graphs
+    assert actual._slice_dict.keys() == expected._slice_dict.keys()
+    for key, slices in expected._slice_dict.items():
+        assert torch.equal(actual._slice_dict[key], slices)
+    assert actual._inc_dict.keys() == expected._inc_dict.keys()
+    for key, incs in expected._inc_dict.items():
+        assert_same_value(actual._inc_dict[key], incs)
+
+
+@pytest.mark.parametrize("history", [False, True])
+def test_collate_dense_matches_from_data_list(history):
+    data_list = make_data_list(history=history)
+    batch = collate_dense(data_list)
+    expected = tgd.Batch.from_data_list(data_list)
+    assert_same_batch(batch, expected)
+    for data, separated in zip(batch.to_data_list(), expected.to_data_list()):
+        assert sorted(data.keys()) == sorted(separated.keys())
+        for key in separated.keys():
+            assert_same_value(data[key], separated[key])
+
+
+def test_collate_dense_clouds_of_different_sizes():
+    data_list = make_data_list(n_points=(6, 4, 5))
+    assert_same_batch(collate_dense(data_list), tgd.Batch.from_data_list(data_list))
+
+
+def test_collate_dense_falls_back_for_incremented_fields():
+    data_list = make_data_list(history=False)
+    for data in data_list:
+        data.edge_index = torch.tensor([[0, 1], [1, 2]])
+    batch = collate_dense(data_list)
+    expected = tgd.Batch.from_data_list(data_list)
+    assert_same_batch(batch, expected)
+    assert torch.equal(batch.edge_index[:, 2:4], data_list[1].edge_index + 6)
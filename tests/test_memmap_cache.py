@@ -0,0 +1,63 @@
+import torch
+import torch_geometric.data as tgd
+
+from flowbothd.datasets.memmap_cache import memmap_cache
+
+FIELDS = ["pos", "delta", "mask", "K"]
+
+
+def make_samples(n=5, n_points=8):
+    generator = torch.Generator().manual_seed(0)
+    return [
+        tgd.Data(
+            id=f"obj_{i}",
+            pos=torch.randn(n_points, 3, generator=generator),
+            delta=torch.randn(n_points, 1, 3, generator=generator),
+            mask=(torch.rand(n_points, generator=generator) > 0.5).float(),
+            K=i,
+        )
+        for i in range(n)
+    ]
+
+
+def open_cache(tmp_path, make_dset, seed=42):
+    return memmap_cache(
+        make_dset,
+        root=str(tmp_path),
+        processed_dirname="processed",
+        split="train-train",
+        n_repeat=1,
+        seed=seed,
+        params=dict(history=False),
+        fields=FIELDS,
+    )
+
+
+def test_memmap_cache_round_trip(tmp_path):
+    samples = make_samples()
+    dset = open_cache(tmp_path, lambda: samples)
+    assert len(dset) == len(samples)
+    for sample, data in zip(samples, dset):
+        assert data.id == sample.id
+        assert data.K == sample.K
+        for field in ["pos", "delta", "mask"]:
+            assert torch.equal(data[field], sample[field])
+
+
+def test_memmap_cache_opens_from_manifest(tmp_path):
+    samples = make_samples()
+    calls = []
+
+    def make_dset():
+        calls.append(1)
+        return samples
+
+    open_cache(tmp_path, make_dset)
+    dset = open_cache(tmp_path, make_dset)
+    # The second open doesn't build (or load) the pickled dataset.
+    assert len(calls) == 1
+    assert torch.equal(dset[2].pos, samples[2].pos)
+
+    # Other parameters are a different entry, written from the dataset.
+    open_cache(tmp_path, make_dset, seed=0)
+    assert len(calls) == 2
@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from flowbothd.models.dit_utils import create_diffusion
+from flowbothd.models.modules.onnx_denoiser import save_diffusion_tables
+from flowbothd.models.modules.onnx_sampler import OnnxFlowSampler
+
+SHAPE = (2, 3, 16)
+
+
+class ToyDenoiser(nn.Module):
+    """Deterministic (eps, variance) model with the inputs of the exported graph."""
+
+    def forward(self, x, t, pos):
+        eps = 0.3 * torch.tanh(x + pos) * torch.cos(t.float() / 50).view(-1, 1, 1)
+        return torch.cat([eps, torch.tanh(pos)], dim=1)
+
+
+class ToySession:
+    """Stands in for the onnxruntime session of the exported ToyDenoiser."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def run(self, output_names, inputs):
+        out = self.model(*(torch.from_numpy(inputs[k]) for k in ["x", "t", "pos"]))
+        return [out.numpy()]
+
+
+def load_sampler(diffusion, tmp_path):
+    tables_file = save_diffusion_tables(diffusion, str(tmp_path / "tables.npz"))
+    with np.load(tables_file) as tables:
+        return OnnxFlowSampler(ToySession(ToyDenoiser()), dict(tables))
+
+
+def inputs(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(*SHAPE, generator=generator), torch.randn(
+        *SHAPE, generator=generator
+    )
+
+
+@torch.no_grad()
+def test_ddim_matches_torch_sampling_loop(tmp_path):
+    diffusion = create_diffusion(timestep_respacing="10", diffusion_steps=100)
+    noise, pos = inputs()
+    expected, _ = diffusion.sample_loop(
+        ToyDenoiser(),
+        SHAPE,
+        noise=noise,
+        sampler="ddim",
+        clip_denoised=False,
+        model_kwargs=dict(pos=pos),
+        device="cpu",
+    )
+    sampler = load_sampler(diffusion, tmp_path)
+    sample = sampler.sample(pos.numpy(), noise=noise.numpy(), sampler="ddim")
+    assert np.allclose(sample, expected.numpy(), atol=1e-5)
+
+
+@torch.no_grad()
+def test_ddpm_last_step_matches_torch_mean(tmp_path):
+    diffusion = create_diffusion(timestep_respacing="10", diffusion_steps=100)
+    x, pos = inputs()
+    t = torch.zeros(SHAPE[0], dtype=torch.long)
+    expected = diffusion.p_mean_variance(
+        ToyDenoiser(), x, t, clip_denoised=False, model_kwargs=dict(pos=pos)
+    )["mean"]
+    sampler = load_sampler(diffusion, tmp_path)
+    sample = sampler.ddpm_step(x.numpy(), 0, pos.numpy(), np.random.default_rng(0))
+    assert np.allclose(sample, expected.numpy(), atol=1e-5)
+
+
+def test_predict_is_normalized(tmp_path):
+    diffusion = create_diffusion(timestep_respacing="10", diffusion_steps=100)
+    sampler = load_sampler(diffusion, tmp_path)
+    flow = sampler.predict(np.random.default_rng(0).standard_normal((16, 3)), seed=0)
+    assert flow.shape == (16, 1, 3)
+    assert np.isclose(np.linalg.norm(flow, axis=-1).max(), 1.0, atol=1e-4)
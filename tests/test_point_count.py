@@ -0,0 +1,70 @@
+import pytest
+import torch
+import torch_geometric.data as tgd
+
+from flowbothd.metrics.trajectory import normalize_trajectory
+from flowbothd.models.dit_utils import (
+    has_uniform_point_count,
+    predict_by_point_count,
+    split_by_point_count,
+    uniform_point_count,
+)
+
+
+def make_batch(counts):
+    return tgd.Batch.from_data_list(
+        [tgd.Data(pos=torch.randn(n, 3) * (i + 1)) for i, n in enumerate(counts)]
+    )
+
+
+def test_normalize_trajectory_per_cloud():
+    counts = [5, 3, 5]
+    pred = torch.randn(sum(counts), 1, 3)
+    batch = torch.arange(len(counts)).repeat_interleave(torch.tensor(counts))
+    normalized = normalize_trajectory(pred, batch)
+    for cloud in normalized.split(counts):
+        assert torch.isclose(cloud.norm(dim=-1).max(), torch.tensor(1.0), atol=1e-5)
+
+
+def test_normalize_trajectory_single_cloud():
+    pred = torch.randn(7, 1, 3)
+    normalized = normalize_trajectory(pred, n_points=len(pred))
+    expected = pred / (pred.norm(dim=-1).max() + 1e-6)
+    assert torch.allclose(normalized, expected)
+
+
+def test_predict_by_point_count_keeps_point_order():
+    batch = make_batch([4, 2, 4, 3])
+    assert not has_uniform_point_count(batch)
+    group_sizes = []
+
+    def predict_step(group, batch_idx, scale=1.0):
+        assert has_uniform_point_count(group)
+        group_sizes.append(group.num_graphs)
+        return group.pos * scale
+
+    preds = predict_by_point_count(predict_step, batch, scale=2.0)
+    assert torch.equal(preds, batch.pos * 2.0)
+    # One sampling loop per distinct point count.
+    assert sorted(group_sizes) == [1, 1, 2]
+
+
+def test_uniform_point_count():
+    assert uniform_point_count(make_batch([4, 4])) == 4
+    assert uniform_point_count(make_batch([4, 4]), 4) == 4
+    with pytest.raises(ValueError):
+        uniform_point_count(make_batch([4, 2]))
+    with pytest.raises(ValueError):
+        uniform_point_count(make_batch([4, 4]), 1200)
+
+
+def test_split_by_point_count():
+    batch = make_batch([4, 4])
+    (group,) = split_by_point_count(batch)
+    assert group is batch
+    groups = list(split_by_point_count(make_batch([4, 2, 4, 3])))
+    assert [(uniform_point_count(g), g.num_graphs) for g in groups] == [
+        (2, 1),
+        (3, 1),
+        (4, 2),
+    ]
@@ -0,0 +1,173 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from flowbothd.models.dit_utils import create_diffusion
+
+SHAPE = (2, 3, 16, 1)
+
+
+class ToyDenoiser(nn.Module):
+    """Deterministic epsilon model with the (eps, variance) output of the DiTs."""
+
+    def __init__(self):
+        super().__init__()
+        self.scale = nn.Parameter(torch.tensor(0.3))
+
+    def forward(self, x, t):
+        eps = self.scale * torch.tanh(x) * torch.cos(t.float() / 50).view(-1, 1, 1, 1)
+        return torch.cat([eps, torch.zeros_like(x)], dim=1)
+
+
+class GaussianDenoiser(nn.Module):
+    """Exact epsilon model of N(0, 1) data on the base schedule (no learned error)."""
+
+    def __init__(self, diffusion_steps=1000):
+        super().__init__()
+        base = create_diffusion(timestep_respacing="", diffusion_steps=diffusion_steps)
+        self.register_buffer("alphas_cumprod", torch.from_numpy(base.alphas_cumprod))
+        self.dummy = nn.Parameter(torch.zeros(()))
+
+    def forward(self, x, t):
+        # x_t ~ N(0, 1) for every t, so E[eps | x_t] = sqrt(1 - alpha_bar) * x_t.
+        alpha_bar = self.alphas_cumprod[t].float().view(-1, 1, 1, 1)
+        return torch.cat([(1 - alpha_bar).sqrt() * x, torch.zeros_like(x)], dim=1)
+
+    def ode_solution(self, x):
+        """Where the probability flow ODE takes x, from the last to the first
+        timestep, followed by the final data prediction."""
+        alpha_bar = self.alphas_cumprod[0].double()
+        return (alpha_bar.sqrt() * x.double()).float()
+
+
+class MixtureDenoiser(nn.Module):
+    """Exact epsilon model of data split between N(-mean, std^2) and N(mean, std^2)."""
+
+    def __init__(self, diffusion_steps=100, mean=1.0, std=0.1):
+        super().__init__()
+        base = create_diffusion(timestep_respacing="", diffusion_steps=diffusion_steps)
+        alphas_cumprod = torch.from_numpy(base.alphas_cumprod).float()
+        self.register_buffer("alphas_cumprod", alphas_cumprod)
+        self.mean, self.std = mean, std
+        self.dummy = nn.Parameter(torch.zeros(()))
+
+    def forward(self, x, t):
+        alpha_bar = self.alphas_cumprod[t].view(-1, 1, 1, 1)
+        alpha, sigma = alpha_bar.sqrt(), (1 - alpha_bar).sqrt()
+        var = alpha_bar * self.std**2 + sigma**2
+        # Posterior weight of the +mean component, then E[x_0 | x_t].
+        weight = torch.sigmoid(2 * alpha * self.mean * x / var)
+        mean = self.mean * (2 * weight - 1)
+        pred_xstart = mean + alpha * self.std**2 * (x - alpha * mean) / var
+        eps = (x - alpha * pred_xstart) / sigma
+        return torch.cat([eps, torch.zeros_like(x)], dim=1)
+
+
+@pytest.fixture
+def model():
+    return ToyDenoiser().eval()
+
+
+def noise(seed=0):
+    return torch.randn(*SHAPE, generator=torch.Generator().manual_seed(seed))
+
+
+def reference_ddim(model, x, n_steps=10, diffusion_steps=100):
+    """Plain eta=0 DDIM over the respaced timesteps, in float64."""
+    base = create_diffusion(timestep_respacing="", diffusion_steps=diffusion_steps)
+    timestep_map = create_diffusion(
+        timestep_respacing=str(n_steps), diffusion_steps=diffusion_steps
+    ).timestep_map
+    alphas_cumprod = torch.from_numpy(base.alphas_cumprod)
+    x = x.double()
+    for i in reversed(range(n_steps)):
+        t = timestep_map[i]
+        alpha = alphas_cumprod[t]
+        alpha_prev = alphas_cumprod[timestep_map[i - 1]] if i > 0 else 1.0
+        ts = torch.full((x.shape[0],), t, dtype=torch.long)
+        eps = model(x.float(), ts)[:, : x.shape[1]].double()
+        x0 = (x - (1 - alpha).sqrt() * eps) / alpha.sqrt()
+        x = (
+            x0 * torch.as_tensor(alpha_prev).sqrt()
+            + (1 - torch.as_tensor(alpha_prev)).sqrt() * eps
+        )
+    return x.float()
+
+
+@torch.no_grad()
+def test_ddim_eta0_matches_reference(model):
+    diffusion = create_diffusion(timestep_respacing="10", diffusion_steps=100)
+    sample, _ = diffusion.sample_loop(
+        model, SHAPE, noise=noise(), sampler="ddim", eta=0.0, clip_denoised=False
+    )
+    expected = reference_ddim(model, noise())
+    assert torch.allclose(sample, expected, atol=1e-5)
+
+
+@torch.no_grad()
+def test_ddim_eta0_is_deterministic(model):
+    diffusion = create_diffusion(timestep_respacing="10", diffusion_steps=100)
+    torch.manual_seed(0)
+    first, _ = diffusion.sample_loop(model, SHAPE, noise=noise(), sampler="ddim")
+    torch.manual_seed(1)
+    second, _ = diffusion.sample_loop(model, SHAPE, noise=noise(), sampler="ddim")
+    assert torch.equal(first, second)
+
+
+@torch.no_grad()
+def test_unrespaced_ddpm_matches_base_diffusion(model):
+    respaced = create_diffusion(timestep_respacing="100", diffusion_steps=100)
+    base = create_diffusion(timestep_respacing="", diffusion_steps=100)
+    torch.manual_seed(0)
+    expected, _ = base.p_sample_loop(model, SHAPE, noise=noise())
+    torch.manual_seed(0)
+    sample, _ = respaced.sample_loop(model, SHAPE, noise=noise(), sampler="ddpm")
+    assert torch.allclose(sample, expected)
+
+
+@pytest.mark.parametrize("sampler", ["ddim", "dpm_solver++"])
+@torch.no_grad()
+def test_samplers_return_ddpm_output_layout(model, sampler):
+    diffusion = create_diffusion(timestep_respacing="10", diffusion_steps=100)
+    reference, reference_kept = diffusion.sample_loop(
+        model, SHAPE, noise=noise(), sampler="ddpm", intermediate_stride=5
+    )
+    sample, kept = diffusion.sample_loop(
+        model, SHAPE, noise=noise(), sampler=sampler, intermediate_stride=5
+    )
+    assert type(sample) is type(reference)
+    assert sample.shape == reference.shape == SHAPE
+    assert sample.dtype == reference.dtype
+    assert len(kept) == len(reference_kept)
+    assert all(k.shape == SHAPE for k in kept)
+
+
+@pytest.mark.parametrize("n_steps", [10, 20])
+@torch.no_grad()
+def test_dpm_solver_beats_ddim_on_exact_model(n_steps):
+    model = GaussianDenoiser(diffusion_steps=1000).eval()
+    diffusion = create_diffusion(timestep_respacing=str(n_steps), diffusion_steps=1000)
+    expected = model.ode_solution(noise())
+    errors = {}
+    for sampler in ["ddim", "dpm_solver++"]:
+        sample, _ = diffusion.sample_loop(
+            model, SHAPE, noise=noise(), sampler=sampler, clip_denoised=False
+        )
+        errors[sampler] = (sample - expected).pow(2).mean().sqrt().item()
+    assert errors["dpm_solver++"] < 0.5 * errors["ddim"]
+
+
+@pytest.mark.parametrize("n_steps, max_rmse", [(10, 0.2), (20, 0.1)])
+@torch.no_grad()
+def test_respaced_ddim_is_close_to_full_ddim(n_steps, max_rmse):
+    model = MixtureDenoiser(diffusion_steps=100).eval()
+    full = create_diffusion(timestep_respacing="100", diffusion_steps=100)
+    respaced = create_diffusion(timestep_respacing=str(n_steps), diffusion_steps=100)
+    expected, _ = full.sample_loop(
+        model, SHAPE, noise=noise(), sampler="ddim", clip_denoised=False
+    )
+    sample, _ = respaced.sample_loop(
+        model, SHAPE, noise=noise(), sampler="ddim", clip_denoised=False
+    )
+    assert (sample - expected).pow(2).mean().sqrt() < max_rmse
+    assert torch.cosine_similarity(sample.flatten(), expected.flatten(), dim=0) > 0.99